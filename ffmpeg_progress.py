@@ -0,0 +1,163 @@
+"""读取ffmpeg的 -progress 输出
+
+ffmpeg加上 `-progress pipe:1 -nostats` 后，每个统计周期（约0.5秒）向stdout输出一组key=value，
+以 progress=continue（最后一组为 progress=end）结束：
+    frame=1234
+    fps=48.50
+    bitrate=2345.6kbits/s
+    total_size=12345678
+    out_time_us=51234567
+    speed=1.95x
+    progress=continue
+stdout和stderr分别由读取线程阻塞读取，stderr只保留最后若干行，用于获取时长和报错。
+"""
+import re
+import queue
+import logging
+import threading
+import subprocess
+from collections import deque
+
+PROGRESS_ARGS = '-nostdin -progress pipe:1 -nostats'
+DURATION_RE = re.compile(r'Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)')
+
+class FFmpegProgress:
+    """一组进度数据，ffmpeg尚未给出的值为None"""
+    FIELDS = ('frame', 'fps', 'bitrate', 'total_size', 'out_time_us', 'speed')
+
+    def __init__(self):
+        self.frame = None
+        self.fps = None
+        self.bitrate = None  # 已输出部分的平均码率（kbps）
+        self.total_size = None  # 已输出的字节数
+        self.out_time_us = None  # 已输出的时长（微秒）
+        self.speed = None  # 编码速度，相对实时的倍数
+        self.done = False  # 收到 progress=end
+
+    @property
+    def out_time(self):
+        """已输出的时长（秒）"""
+        return self.out_time_us / 1000000 if self.out_time_us is not None else None
+
+    def update(self, key, value):
+        """解析一行key=value，返回是否为一组数据的结尾"""
+        value = value.strip()
+        if key == 'progress':
+            self.done = value == 'end'
+            return True
+        if key not in self.FIELDS or not value or value == 'N/A':
+            return False
+        try:
+            if key in ('frame', 'total_size', 'out_time_us'):
+                setattr(self, key, int(value))
+            elif key == 'bitrate':
+                self.bitrate = float(value.replace('kbits/s', ''))
+            elif key == 'speed':
+                self.speed = float(value.rstrip('x'))
+            else:
+                self.fps = float(value)
+        except ValueError:
+            pass
+        return False
+
+    def copy(self):
+        progress = FFmpegProgress()
+        progress.__dict__.update(self.__dict__)
+        return progress
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+def add_progress_args(cmd):
+    """在ffmpeg命令的可执行文件之后加上 -progress pipe:1 -nostats"""
+    if isinstance(cmd, (list, tuple)):
+        return [cmd[0]] + PROGRESS_ARGS.split() + list(cmd[1:])
+    if '-progress ' in cmd:
+        return cmd
+    index = cmd.find(' -')
+    if index < 0:
+        return '%s %s' % (cmd, PROGRESS_ARGS)
+    return '%s %s%s' % (cmd[:index], PROGRESS_ARGS, cmd[index:])
+
+class FFmpegRunner:
+    def __init__(self, cmd, stderr_lines=200):
+        """
+        Args:
+            cmd: 已包含 -progress pipe:1 的ffmpeg命令（字符串时通过shell执行）
+            stderr_lines: 保留的stderr行数
+        """
+        self.cmd = cmd
+        self.process = None
+        self.duration = None  # 从stderr的Duration行解析出的输入时长（秒）
+        self.stderr = deque(maxlen=stderr_lines)
+        self._progress = queue.Queue()
+        self._threads = []
+
+    def start(self):
+        self.process = subprocess.Popen(self.cmd, shell=isinstance(self.cmd, str), stdin=subprocess.DEVNULL,
+                                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        for target in (self._read_progress, self._read_stderr):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self.process
+
+    def _read_progress(self):
+        current = FFmpegProgress()
+        try:
+            for raw in self.process.stdout:
+                key, sep, value = raw.decode('utf-8', errors='replace').partition('=')
+                if sep and current.update(key.strip(), value):
+                    self._progress.put(current)
+                    current = current.copy()
+        except Exception as e:
+            logging.warning(f"读取ffmpeg进度时出错: {str(e)}")
+        finally:
+            self._progress.put(None)
+
+    def _read_stderr(self):
+        try:
+            for raw in self.process.stderr:
+                line = raw.decode('utf-8', errors='replace').rstrip()
+                if not line:
+                    continue
+                self.stderr.append(line)
+                if self.duration is None and 'Duration:' in line:
+                    match = DURATION_RE.search(line)
+                    if match:
+                        h, m, s = match.groups()
+                        self.duration = int(h) * 3600 + int(m) * 60 + float(s)
+        except Exception as e:
+            logging.warning(f"读取ffmpeg输出时出错: {str(e)}")
+
+    def iter_progress(self):
+        """逐组产出进度数据直到ffmpeg关闭stdout，处理不及时的中间数据直接丢弃"""
+        while True:
+            progress = self._progress.get()
+            while progress is not None:
+                try:
+                    latest = self._progress.get_nowait()
+                except queue.Empty:
+                    break
+                if latest is None:
+                    self._progress.put(None)
+                    break
+                progress = latest
+            if progress is None:
+                return
+            yield progress
+
+    def wait(self):
+        """等待ffmpeg退出和读取线程结束，返回退出码"""
+        returncode = self.process.wait()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        return returncode
+
+    def kill(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.wait()
+
+    def stderr_tail(self, lines=20):
+        return '\n'.join(list(self.stderr)[-lines:])
@@ -0,0 +1,204 @@
+import os
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.avi', '.flv')
+
+_DONE = object()
+
+class DirectoryWalker:
+    """基于os.scandir的并发流式目录遍历器
+
+    每个扫描路径的顶层目录作为独立单元在线程池中遍历，
+    找到的视频文件以 (scan_path, path, size, mtime) 的形式边遍历边产出，
+    文件大小和修改时间来自 DirEntry.stat() 的缓存，无需再次os.stat
+    """
+
+    def __init__(self, manifest, dir_index, relative_dir, workers=4, queue_size=10000, stats=None):
+        """
+        Args:
+            manifest: DirectoryManifest 目录清单
+            dir_index: {rel_dir: [video_id, ...]} 按目录分组的已有记录
+            relative_dir: 将绝对目录转换为相对目录的函数
+            workers: 遍历线程数
+            queue_size: 结果队列长度上限，限制遍历领先处理的距离
+            stats: ScanStats，记录每个目录的列目录和获取状态耗时
+        """
+        self.manifest = manifest
+        self.dir_index = dir_index
+        self.relative_dir = relative_dir
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.stats = stats
+        self.errors = {}  # {scan_path: [OSError, ...]}
+        self._unchanged_ids = []
+        self._lock = threading.Lock()
+        self._outstanding = 0
+        self._stopped = threading.Event()
+
+    def take_unchanged_ids(self):
+        """取出目前为止清单未变化目录下直接确认存在的记录id"""
+        with self._lock:
+            ids, self._unchanged_ids = self._unchanged_ids, []
+        return ids
+
+    def walk(self, scan_paths):
+        """并发遍历所有扫描路径，产出 (scan_path, path, size, mtime)"""
+        results = queue.Queue(maxsize=self.queue_size)
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='walk')
+
+        def submit(func, *args):
+            with self._lock:
+                self._outstanding += 1
+            executor.submit(run, func, *args)
+
+        def run(func, *args):
+            try:
+                if not self._stopped.is_set():
+                    func(*args)
+            except Exception as e:
+                logger.error(f"遍历目录时出错: {str(e)}")
+                self._record_error(args[0], e)
+            finally:
+                release()
+
+        def release():
+            with self._lock:
+                self._outstanding -= 1
+                finished = self._outstanding == 0
+            if finished:
+                self._put(results, _DONE)
+
+        def walk_root(scan_path):
+            try:
+                root_mtime = os.stat(scan_path).st_mtime
+            except OSError as e:
+                self._record_error(scan_path, e)
+                return
+            # 顶层目录交给其他线程并发遍历
+            for subdir in self._scan_dir(scan_path, scan_path, root_mtime, results):
+                submit(walk_subtree, scan_path, subdir)
+
+        def walk_subtree(scan_path, top):
+            stack = [top]
+            while stack and not self._stopped.is_set():
+                path, mtime = stack.pop()
+                stack.extend(self._scan_dir(scan_path, path, mtime, results))
+
+        for scan_path in scan_paths:
+            self.errors[scan_path] = []
+        # 提交期间持有一个计数，避免第一个扫描路径提前遍历完就结束
+        with self._lock:
+            self._outstanding += 1
+        for scan_path in scan_paths:
+            submit(walk_root, scan_path)
+        release()
+
+        try:
+            while True:
+                item = results.get()
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            self._stopped.set()
+            executor.shutdown(wait=False)
+
+    def _put(self, results, item):
+        while not self._stopped.is_set():
+            try:
+                results.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _record_error(self, scan_path, error):
+        with self._lock:
+            self.errors.setdefault(scan_path, []).append(error)
+
+    def _scan_dir(self, scan_path, path, mtime, results):
+        """列出单个目录，产出视频文件，返回需要继续遍历的子目录 [(path, mtime)]"""
+        list_start = time.monotonic()
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError as e:
+            self._record_error(scan_path, e)
+            return []
+        walk_seconds = time.monotonic() - list_start
+        stat_seconds = 0.0
+
+        dirs = []
+        files = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry)
+                else:
+                    files.append(entry)
+            except OSError as e:
+                self._record_error(scan_path, e)
+
+        rel_dir = self.relative_dir(path)
+        names = [entry.name for entry in entries]
+        unchanged = self.manifest.check(rel_dir, mtime, names, len(dirs))
+
+        subdirs = []
+        for entry in dirs:
+            child_rel = rel_dir + '\\' + entry.name if rel_dir else self.relative_dir(entry.path)
+            stat_start = time.monotonic()
+            try:
+                child_mtime = entry.stat(follow_symlinks=False).st_mtime
+            except OSError as e:
+                self._record_error(scan_path, e)
+                continue
+            finally:
+                stat_seconds += time.monotonic() - stat_start
+            # 跳过未变化的叶子目录
+            if self.manifest.is_leaf_candidate(child_rel) and self.manifest.is_unchanged_leaf(child_rel, child_mtime):
+                self._add_unchanged(child_rel)
+                continue
+            subdirs.append((entry.path, child_mtime))
+
+        if unchanged:
+            self.manifest.count_skipped()
+            self._add_unchanged(rel_dir)
+            self._record_dir(scan_path, path, walk_seconds, stat_seconds, 0)
+            return subdirs
+
+        file_count = 0
+        for entry in files:
+            name = entry.name
+            if not name.endswith(VIDEO_EXTENSIONS):
+                continue
+            if '-trailer' in name.lower():
+                logger.debug(f"跳过预告片: {name}")
+                continue
+            stat_start = time.monotonic()
+            try:
+                st = entry.stat()
+            except OSError as e:
+                self.manifest.mark_dirty(rel_dir)
+                logger.error(f"获取文件状态出错 {entry.path}: {str(e)}")
+                continue
+            finally:
+                stat_seconds += time.monotonic() - stat_start
+            file_count += 1
+            self._put(results, (scan_path, entry.path, st.st_size, st.st_mtime))
+        self._record_dir(scan_path, path, walk_seconds, stat_seconds, file_count)
+        return subdirs
+
+    def _record_dir(self, scan_path, path, walk_seconds, stat_seconds, file_count):
+        if self.stats is not None:
+            self.stats.record_dir(scan_path, path, walk_seconds, stat_seconds, file_count)
+
+    def _add_unchanged(self, rel_dir):
+        ids = self.dir_index.get(rel_dir)
+        if ids:
+            with self._lock:
+                self._unchanged_ids.extend(ids)
@@ -0,0 +1,151 @@
+"""数据库的一次性维护命令
+
+master启动时只做可以自动完成、失败时可以整体回滚的升级；会删除数据的操作由运维人员确认后手动执行：
+
+    python migrate.py dedupe                  # 列出video_info中路径重复的记录
+    python migrate.py dedupe --yes            # 每组只保留一条，删除其余记录
+    python migrate.py drop-video-path         # 核对拆分后的路径与旧video_path列是否一致
+    python migrate.py drop-video-path --yes   # 核对无误后删除旧video_path列
+
+不加 --yes 时只检查并输出结果，不修改数据库。
+"""
+import sys
+import argparse
+import logging
+from flask import Flask
+from sqlalchemy import bindparam, inspect, text
+from models import db, VideoInfo, find_duplicate_keys
+from config import Config
+from video_dir import get_dir_resolver
+
+logger = logging.getLogger(__name__)
+
+# 重复记录中优先保留的转码状态：运行中和已创建任务的记录不能删除，其次是已完成和失败的
+KEEP_PRIORITY = {3: 4, 2: 3, 4: 2, 5: 1}
+
+def create_migrate_app(config):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = config.database_uri
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    return app
+
+def _video_info_columns():
+    return {column['name'] for column in inspect(db.engine).get_columns(VideoInfo.__tablename__)}
+
+def _duplicate_key():
+    """重复记录的判断依据：还有未拆分的旧路径时按video_path，否则按唯一索引的 (dir_id, file_name)"""
+    columns = _video_info_columns()
+    if 'video_path' in columns:
+        where = 'dir_id IS NULL' if 'dir_id' in columns else None
+        if db.session.execute(text(
+            f'SELECT COUNT(*) FROM video_info WHERE video_path IS NOT NULL{" AND " + where if where else ""}'
+        )).scalar():
+            return ['video_path'], where
+    return ['dir_id', 'file_name'], None
+
+def dedupe(apply=False):
+    """每组重复记录只保留一条（按KEEP_PRIORITY，其次id最大），转码任务改为指向保留的记录
+
+    Returns:
+        int: 删除（apply为False时为将要删除）的记录数
+    """
+    key_columns, where = _duplicate_key()
+    groups = find_duplicate_keys('video_info', key_columns, where=where)
+    if not groups:
+        logger.info(f"video_info中没有 {key_columns} 重复的记录")
+        return 0
+
+    condition = ' AND '.join(f'{column} = :{column}' for column in key_columns)
+    if where:
+        condition += f' AND {where}'
+    removed = 0
+    for key, count in groups:
+        params = dict(zip(key_columns, key))
+        rows = db.session.execute(text(
+            f'SELECT id, transcode_status FROM video_info WHERE {condition} ORDER BY id'
+        ), params).fetchall()
+        keep_id = max(rows, key=lambda row: (KEEP_PRIORITY.get(row[1], 0), row[0]))[0]
+        drop_ids = [row[0] for row in rows if row[0] != keep_id]
+        logger.info(f"{key}: 共 {count} 条，保留 id={keep_id}，删除 id={drop_ids}")
+        if apply:
+            params = {'keep_id': keep_id, 'drop_ids': drop_ids}
+            db.session.execute(
+                text('UPDATE transcode_task SET video_id = :keep_id WHERE video_id IN :drop_ids')
+                .bindparams(bindparam('drop_ids', expanding=True)), params
+            )
+            db.session.execute(
+                text('DELETE FROM video_info WHERE id IN :drop_ids')
+                .bindparams(bindparam('drop_ids', expanding=True)), params
+            )
+        removed += len(drop_ids)
+
+    if apply:
+        db.session.commit()
+        logger.info(f"已删除 {removed} 条重复记录")
+    else:
+        logger.info(f"共 {len(groups)} 组重复，将删除 {removed} 条记录；确认后加 --yes 执行")
+    return removed
+
+def drop_video_path(apply=False):
+    """核对每条记录由目录字典拼接的路径与旧video_path列一致后删除该列
+
+    Returns:
+        bool: 是否可以（或已经）删除
+    """
+    if 'video_path' not in _video_info_columns():
+        logger.info("video_info.video_path列已不存在")
+        return True
+
+    unmigrated = db.session.execute(text(
+        'SELECT COUNT(*) FROM video_info WHERE dir_id IS NULL AND video_path IS NOT NULL'
+    )).scalar()
+    if unmigrated:
+        logger.error(f"还有 {unmigrated} 条记录未拆分路径，请先启动一次master完成迁移")
+        return False
+
+    resolver = get_dir_resolver()
+    checked = 0
+    mismatches = []
+    result = db.session.execute(text(
+        'SELECT id, dir_id, file_name, video_path FROM video_info WHERE video_path IS NOT NULL'
+    )).yield_per(5000)
+    for video_id, dir_id, file_name, video_path in result:
+        checked += 1
+        full_path = resolver.full_path(dir_id, file_name)
+        if full_path != video_path:
+            mismatches.append((video_id, video_path, full_path))
+    if mismatches:
+        for video_id, video_path, full_path in mismatches[:20]:
+            logger.error(f"id={video_id}: video_path={video_path}，拼接的路径={full_path}")
+        logger.error(f"{len(mismatches)}/{checked} 条记录的路径不一致，保留video_path列")
+        return False
+
+    logger.info(f"已核对 {checked} 条记录，路径全部一致")
+    if not apply:
+        logger.info("确认后加 --yes 删除video_path列（删除后不能恢复，请先备份数据库）")
+        return True
+    if db.engine.dialect.name == 'sqlite':
+        db.session.execute(text('DROP INDEX IF EXISTS ix_video_info_video_path'))
+    db.session.execute(text('ALTER TABLE video_info DROP COLUMN video_path'))
+    db.session.commit()
+    logger.info("已删除video_info.video_path列")
+    return True
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
+    parser = argparse.ArgumentParser(description='数据库维护命令')
+    parser.add_argument('command', choices=['dedupe', 'drop-video-path'],
+                        help='dedupe: 删除video_info中路径重复的记录; drop-video-path: 删除已拆分的旧video_path列')
+    parser.add_argument('--yes', action='store_true', help='确认修改数据库，不加时只检查')
+    args = parser.parse_args()
+
+    app = create_migrate_app(Config())
+    with app.app_context():
+        if args.command == 'dedupe':
+            dedupe(apply=args.yes)
+        elif not drop_video_path(apply=args.yes):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
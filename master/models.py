@@ -1,13 +1,30 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect, text
 from datetime import datetime
+import os
+import logging
+
+logger = logging.getLogger(__name__)
 
 db = SQLAlchemy()
 
+class VideoDir(db.Model):
+    __tablename__ = 'video_dir'
+    __table_args__ = (db.UniqueConstraint('parent_id', 'name', name='uq_video_dir_parent_name'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    parent_id = db.Column(db.Integer, nullable=False, default=0)  # 上级目录id，0表示顶层
+    name = db.Column(db.String(255), nullable=False)  # 目录名
+    updatetime = db.Column(db.DateTime, default=datetime.utcnow, index=True)  # 创建或移动的时间，其他进程据此刷新路径缓存
+
 class VideoInfo(db.Model):
     __tablename__ = 'video_info'
+    # 唯一索引，扫描结果按目录和文件名upsert
+    __table_args__ = (db.Index('uq_video_info_dir_file', 'dir_id', 'file_name', unique=True),)
     
     id = db.Column(db.Integer, primary_key=True)
-    video_path = db.Column(db.String(255), nullable=False)
+    dir_id = db.Column(db.Integer)  # 所在目录 video_dir.id
+    file_name = db.Column(db.String(255))
     identi = db.Column(db.String(255))
     codec = db.Column(db.String(255))
     bitrate_k = db.Column(db.Integer)
@@ -21,7 +38,54 @@ class VideoInfo(db.Model):
     file_mtime = db.Column(db.DateTime)  # 文件修改时间
     transcode_status = db.Column(db.Integer, default=0)  # 0:not_transcode, 1:wait_transcode, 2:created, 3:running, 4:completed, 5:failed
     transcode_task_id = db.Column(db.Integer)
+    task_type = db.Column(db.String(16))  # 等待的任务类型: transcode（重新编码，为空时同）, remux（只转封装）
     exist = db.Column(db.Boolean, default=True)  # 文件是否存在
+    last_seen_scan = db.Column(db.Integer, index=True)  # 最后一次扫描到该文件的扫描代数
+    fingerprint = db.Column(db.String(40), index=True)  # 文件字节数+首尾各4MB的sha1，用于识别被移动的文件
+    probe_data = db.deferred(db.Column(db.LargeBinary))  # zlib压缩的探测结果JSON，随任务下发给worker
+
+    @property
+    def video_path(self):
+        """相对路径（Windows格式的分隔符），由目录字典拼接"""
+        from video_dir import get_dir_resolver
+        return get_dir_resolver().full_path(self.dir_id, self.file_name)
+
+    # 只需转封装为mkv的旧容器格式
+    REMUX_EXTENSIONS = ('.avi', '.flv')
+
+    def bitrate_limit(self) -> int:
+        """HEVC在该分辨率和帧率下的目标码率（kbps）"""
+        # 根据总像素数和帧率计算目标码率
+        # 基准: 1080p@30fps约需3500kbps
+        # 计算公式: br_limit = (像素数比例 * 帧率比例 * 基准码率 * 0.8)
+        # 0.8是HEVC相对于H264的压缩效率提升
+        base_pixels = 1920 * 1080
+        base_fps = 30
+        base_bitrate = 3500
+
+        # 计算像素数和帧率的比例
+        pixels_ratio = self.resolutionall / base_pixels
+        fps_ratio = self.fps / base_fps
+        
+        # 计算目标码率
+        br_limit = int(pixels_ratio * fps_ratio * base_bitrate)
+        
+        # 设置一些合理的上下限
+        return max(2000, min(br_limit, 25000))
+
+    def should_remux(self) -> bool:
+        """
+        判断视频是否只需转封装（直接复制流到mkv，不重新编码）
+        旧容器（avi/flv）中不需要转码的HEVC/AV1，以及码率已不高于HEVC目标码率的H.264
+        返回:
+            bool: True表示只需转封装
+        """
+        if os.path.splitext(self.file_name or '')[1].lower() not in self.REMUX_EXTENSIONS:
+            return False
+        if self.codec == 'h264':
+            # 重新编码后很难达到原码率75%的要求
+            return self.bitrate_k is not None and self.bitrate_k < self.bitrate_limit()
+        return self.codec in ['hevc', 'av1'] and not self.should_transcode()
 
     def should_transcode(self) -> bool:
         """
@@ -31,30 +95,11 @@ class VideoInfo(db.Model):
         """
         # 如果是hevc或av1编码
         if self.codec in ['hevc', 'av1']:
-            # 根据分辨率和帧率判断码率限制
-            # 根据总像素数和帧率计算目标码率
-            # 基准: 1080p@30fps约需3500kbps
-            # 计算公式: br_limit = (像素数比例 * 帧率比例 * 基准码率 * 0.8)
-            # 0.8是HEVC相对于H264的压缩效率提升
-            base_pixels = 1920 * 1080
-            base_fps = 30
-            base_bitrate = 3500
-
             if self.is_vr:
                 return False
-            
-            # 计算像素数和帧率的比例
-            pixels_ratio = self.resolutionall / base_pixels
-            fps_ratio = self.fps / base_fps
-            
-            # 计算目标码率
-            br_limit = int(pixels_ratio * fps_ratio * base_bitrate)
-            
-            # 设置一些合理的上下限
-            br_limit = max(2000, min(br_limit, 25000))
 
             # 如果码率低于限制，不需要转码
-            return self.bitrate_k >= br_limit
+            return self.bitrate_k >= self.bitrate_limit()
 
         # 如果是h264编码，需要转码
         if self.codec == 'h264':
@@ -63,6 +108,67 @@ class VideoInfo(db.Model):
         # 其他编码不需要转码
         return False
 
+class ScanDirectory(db.Model):
+    __tablename__ = 'scan_directory'
+
+    id = db.Column(db.Integer, primary_key=True)
+    dir_path = db.Column(db.String(255), unique=True, nullable=False)  # 目录相对路径
+    mtime = db.Column(db.Float)  # 目录修改时间
+    child_count = db.Column(db.Integer)  # 子项数量
+    entries_hash = db.Column(db.String(40))  # 排序后子项名称的sha1
+    subdir_count = db.Column(db.Integer)  # 子目录数量，0表示叶子目录
+    updatetime = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ScanRun(db.Model):
+    __tablename__ = 'scan_run'
+
+    id = db.Column(db.Integer, primary_key=True)
+    pid = db.Column(db.Integer)  # 执行扫描的进程号
+    status = db.Column(db.Integer, default=0)  # 0:running, 1:completed, 2:failed, 3:interrupted
+    phase = db.Column(db.String(32))  # 当前阶段: walk, relink, probe, finalize
+    generation = db.Column(db.Integer)  # 扫描代数
+    scope = db.Column(db.String(16), default='full')  # full: 全量扫描, partial: 监听或轮询触发的局部扫描
+    forced = db.Column(db.Boolean, default=False)  # 是否忽略目录清单（强制全量扫描）
+    processed_count = db.Column(db.Integer, default=0)  # 已处理文件数
+    probed_count = db.Column(db.Integer, default=0)  # 已探测文件数
+    start_time = db.Column(db.DateTime, default=datetime.utcnow)
+    end_time = db.Column(db.DateTime)
+    last_update = db.Column(db.DateTime)  # 最后一次上报进度的时间
+    message = db.Column(db.String(1023))  # 完成摘要或错误信息
+    stats = db.Column(db.Text)  # 耗时统计（JSON），只保留最近若干次扫描
+
+class ScanSchedule(db.Model):
+    __tablename__ = 'scan_schedule'
+    __table_args__ = (db.UniqueConstraint('scan_path', 'top_dir', name='uq_scan_schedule_dir'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    scan_path = db.Column(db.String(255), nullable=False)  # 扫描路径
+    top_dir = db.Column(db.String(255), nullable=False)  # 扫描路径下的顶层目录名
+    interval = db.Column(db.Integer)  # 当前扫描间隔（秒）
+    change_rate = db.Column(db.Float, default=0)  # 平均每小时新增或修改的文件数（指数移动平均）
+    total_changes = db.Column(db.Integer, default=0)  # 累计新增或修改的文件数
+    scan_count = db.Column(db.Integer, default=0)  # 扫描次数
+    last_change = db.Column(db.DateTime)  # 最后一次发现变化的时间
+    last_scan = db.Column(db.DateTime)  # 最后一次扫描的时间
+    next_scan = db.Column(db.DateTime, index=True)  # 下次扫描的时间
+
+class ProbeJob(db.Model):
+    __tablename__ = 'probe_job'
+
+    id = db.Column(db.Integer, primary_key=True)
+    video_path = db.Column(db.String(255), nullable=False, unique=True, index=True)  # 相对路径，与video_info一致
+    st_size = db.Column(db.BigInteger)  # 入队时的文件字节数，探测结果的大小不一致时丢弃
+    file_size = db.Column(db.Float)  # 文件大小（MB）
+    file_mtime = db.Column(db.DateTime)
+    generation = db.Column(db.Integer)  # 入队时的扫描代数
+    status = db.Column(db.Integer, default=0, index=True)  # 0:pending, 1:dispatched, 2:failed
+    batch_id = db.Column(db.String(64), index=True)  # 分发批次，作为probe任务的task_id
+    worker_id = db.Column(db.Integer)
+    attempts = db.Column(db.Integer, default=0)  # 已分发次数
+    error = db.Column(db.String(1023))
+    create_time = db.Column(db.DateTime, default=datetime.utcnow)
+    dispatch_time = db.Column(db.DateTime)
+
 class TranscodeTask(db.Model):
     __tablename__ = 'transcode_task'
     
@@ -81,6 +187,7 @@ class TranscodeTask(db.Model):
     elapsed_time = db.Column(db.Integer, default=0)  # 已用时间（秒）
     remaining_time = db.Column(db.Integer, nullable=True)  # 预计剩余时间（秒）
     last_update_time = db.Column(db.DateTime, nullable=True)  # 最后更新时间
+    task_type = db.Column(db.String(16), default='transcode')  # transcode: 重新编码, remux: 只转封装
 
 class TranscodeWorker(db.Model):
     __tablename__ = 'transcode_worker'
@@ -101,4 +208,65 @@ class TranscodeLog(db.Model):
     task_id = db.Column(db.Integer, db.ForeignKey('transcode_task.id'))
     log_time = db.Column(db.DateTime, default=datetime.utcnow)
     log_level = db.Column(db.Integer)  # 0:debug, 1:info, 2:warning, 3:error
-    log_message = db.Column(db.String(1023)) 
\ No newline at end of file
+    log_message = db.Column(db.String(1023)) 
+
+def find_duplicate_keys(table_name, columns, where=None, limit=None):
+    """查找columns取值重复的记录（忽略含NULL的行）
+
+    Returns:
+        list: [(取值元组, 记录数)]，最多limit组
+    """
+    column_list = ', '.join(columns)
+    conditions = [f'{column} IS NOT NULL' for column in columns]
+    if where:
+        conditions.append(where)
+    sql = (f'SELECT {column_list}, COUNT(*) FROM {table_name} WHERE {" AND ".join(conditions)} '
+           f'GROUP BY {column_list} HAVING COUNT(*) > 1')
+    if limit:
+        sql += f' LIMIT {int(limit)}'
+    with db.engine.connect() as conn:
+        return [(tuple(row[:-1]), row[-1]) for row in conn.execute(text(sql))]
+
+def upgrade_schema():
+    """为已存在的表补齐新增的列和索引
+
+    db.create_all() 只会创建缺失的表，不会修改已有表结构
+    """
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            logger.info(f"为表 {table.name} 添加列: {column.name} {column_type}")
+            with db.engine.begin() as conn:
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing_indexes:
+                continue
+            if index.unique:
+                # 唯一索引建不起来时upsert无法识别已有记录，不能继续启动
+                columns = [column.name for column in index.columns]
+                duplicates = find_duplicate_keys(table.name, columns, limit=5)
+                if duplicates:
+                    examples = ', '.join(f"{key} ({count}条)" for key, count in duplicates)
+                    hint = '请先执行 python migrate.py dedupe 查看并删除重复记录' if table.name == 'video_info' else '请先删除重复记录'
+                    raise RuntimeError(f"表 {table.name} 的 {columns} 有重复的记录（例如 {examples}），"
+                                       f"无法创建唯一索引 {index.name}；{hint}")
+            try:
+                logger.info(f"为表 {table.name} 创建索引: {index.name}")
+                index.create(db.engine)
+            except Exception as e:
+                if index.unique:
+                    raise RuntimeError(f"创建唯一索引 {index.name} 失败: {str(e)}") from e
+                logger.error(f"创建索引 {index.name} 失败: {str(e)}")
+
+def has_index(table_name, index_name):
+    """数据库中是否已有该索引"""
+    return any(index['name'] == index_name for index in inspect(db.engine).get_indexes(table_name))
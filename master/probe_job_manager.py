@@ -0,0 +1,154 @@
+import os
+import sys
+import uuid
+import base64
+import logging
+from datetime import datetime, timedelta
+from models import db, ProbeJob, ScanRun, VideoInfo
+from video_upsert import VideoUpsertBuffer, build_video_row
+from video_dir import get_dir_resolver
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from video import Video
+from probe_cache import decompress_probe
+
+logger = logging.getLogger(__name__)
+
+class ProbeJobManager:
+    """分发给worker的探测任务
+
+    开启 scan.distributed_probe 后，扫描只列出新文件和已修改文件并写入probe_job表，
+    声明接受探测任务的worker请求任务时领取一批路径，按自己的prefix_path在本地探测后批量回传结果
+    """
+
+    def __init__(self, batch_size=20, max_batch_size=200, dispatch_timeout=600, max_attempts=3):
+        """
+        Args:
+            batch_size: worker未指定时每批的路径数
+            max_batch_size: 每批路径数上限
+            dispatch_timeout: 已分发的批次超过多少秒未回传结果时重新排队
+            max_attempts: 最多分发次数，超过后标记为失败，由扫描进程在本地探测
+        """
+        self.batch_size = batch_size
+        self.max_batch_size = max_batch_size
+        self.dispatch_timeout = dispatch_timeout
+        self.max_attempts = max_attempts
+
+    def dispatch_batch(self, worker, batch_size=None):
+        """为worker领取一批待探测的路径，没有待探测的路径时返回None"""
+        batch_size = max(1, min(batch_size or self.batch_size, self.max_batch_size))
+        job_ids = [
+            job_id for job_id, in db.session.query(ProbeJob.id)
+            .filter(ProbeJob.status == 0)
+            .order_by(ProbeJob.id)
+            .limit(batch_size)
+        ]
+        if not job_ids:
+            return None
+
+        # 条件更新领取，并发请求的worker不会拿到同一路径
+        batch_id = str(uuid.uuid4())
+        ProbeJob.query.filter(ProbeJob.id.in_(job_ids), ProbeJob.status == 0).update({
+            ProbeJob.status: 1,
+            ProbeJob.batch_id: batch_id,
+            ProbeJob.worker_id: worker.id,
+            ProbeJob.dispatch_time: datetime.utcnow(),
+            ProbeJob.attempts: ProbeJob.attempts + 1
+        }, synchronize_session=False)
+        db.session.commit()
+
+        jobs = ProbeJob.query.filter(ProbeJob.batch_id == batch_id).all()
+        if not jobs:
+            return None
+        logger.info(f"向worker {worker.worker_name} 分发探测任务 {batch_id}: {len(jobs)} 个文件")
+        return {
+            'task_type': 'probe',
+            'task_id': batch_id,
+            'paths': [{'id': job.id, 'video_path': job.video_path, 'size': job.st_size} for job in jobs]
+        }
+
+    def apply_results(self, batch_id, results):
+        """写入worker回传的探测结果，返回 (成功数, 失败数)
+
+        Args:
+            batch_id: 分发时的task_id
+            results: [{'id': 任务id, 'probe': base64编码的压缩探测结果} 或 {'id': 任务id, 'error': 错误信息}]
+        """
+        jobs = {job.id: job for job in ProbeJob.query.filter(ProbeJob.batch_id == batch_id, ProbeJob.status == 1)}
+        if not jobs:
+            return 0, 0
+        resolver = get_dir_resolver()
+        video_ids = {}
+        path_condition = resolver.path_condition([job.video_path for job in jobs.values()])
+        if path_condition is not None:
+            rows = db.session.query(VideoInfo.dir_id, VideoInfo.file_name, VideoInfo.id).filter(path_condition)
+            video_ids = {resolver.full_path(dir_id, file_name): video_id for dir_id, file_name, video_id in rows}
+
+        # 按最近一次扫描的代数写入：结果可能在下一次扫描期间才回传，沿用入队时的代数会被该次扫描标记为缺失
+        latest_generation = db.session.query(db.func.max(ScanRun.generation)).scalar() or 0
+
+        upsert_buffer = VideoUpsertBuffer(max_rows=len(jobs))
+        applied = 0
+        failed = 0
+        for result in results:
+            job = jobs.pop(result.get('id'), None)
+            if job is None:
+                continue
+            error = result.get('error')
+            if not error:
+                try:
+                    probe = decompress_probe(base64.b64decode(result['probe']))
+                    probe_size = int(probe['format']['size'])
+                    if job.st_size is not None and probe_size != job.st_size:
+                        # 入队后文件又有变化，由下次扫描重新入队
+                        logger.info(f"探测期间文件大小已变化({job.st_size} -> {probe_size})，丢弃结果: {job.video_path}")
+                        db.session.delete(job)
+                        continue
+                    video_obj = Video.from_probe(job.video_path.replace('\\', os.sep), probe)
+                    upsert_buffer.add(build_video_row({
+                        'relative_path': job.video_path,
+                        'file_size': job.file_size,
+                        'file_mtime': job.file_mtime,
+                        'generation': max(job.generation or 0, latest_generation),
+                        'video_id': video_ids.get(job.video_path)
+                    }, video_obj))
+                    db.session.delete(job)
+                    applied += 1
+                    continue
+                except Exception as e:
+                    error = f"探测结果无效: {str(e)}"
+            failed += 1
+            self._release(job, error)
+
+        # 没有回传结果的路径重新排队
+        for job in jobs.values():
+            self._release(job, '未回传探测结果')
+
+        upsert_buffer.flush()
+        db.session.commit()
+        if failed:
+            logger.warning(f"探测任务 {batch_id}: 成功 {applied} 个，失败 {failed} 个")
+        else:
+            logger.info(f"探测任务 {batch_id}: 成功 {applied} 个")
+        return applied, failed
+
+    def requeue_stale(self):
+        """已分发但超时未回传结果的路径重新排队，返回处理的路径数"""
+        deadline = datetime.utcnow() - timedelta(seconds=self.dispatch_timeout)
+        stale_jobs = ProbeJob.query.filter(ProbeJob.status == 1, ProbeJob.dispatch_time < deadline).all()
+        for job in stale_jobs:
+            self._release(job, f"超过{self.dispatch_timeout}秒未回传探测结果")
+        if stale_jobs:
+            db.session.commit()
+            logger.warning(f"{len(stale_jobs)} 个探测任务超时，已重新排队")
+        return len(stale_jobs)
+
+    def _release(self, job, error):
+        """探测失败的路径重新排队，超过最大次数时标记为失败（不提交）"""
+        job.error = error[:1023]
+        job.batch_id = None
+        job.worker_id = None
+        if (job.attempts or 0) >= self.max_attempts:
+            job.status = 2
+            logger.error(f"探测 {job.video_path} 失败 {job.attempts} 次，交由扫描进程本地探测: {error}")
+        else:
+            job.status = 0
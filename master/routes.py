@@ -1,10 +1,13 @@
 from flask import Blueprint, request, jsonify
-from models import db, VideoInfo, TranscodeTask, TranscodeWorker, TranscodeLog
+from models import db, VideoInfo, TranscodeTask, TranscodeWorker, TranscodeLog, ScanSchedule, ScanRun
 from datetime import datetime, timedelta
 from sqlalchemy import desc, asc
 import uuid
+import json
+import base64
 from flask_socketio import SocketIO, emit, join_room, leave_room
 import logging
+from probe_job_manager import ProbeJobManager
 
 # 配置日志
 logger = logging.getLogger(__name__)
@@ -13,10 +16,13 @@ worker_bp = Blueprint('worker', __name__)
 task_bp = Blueprint('task', __name__)
 video_bp = Blueprint('video', __name__)
 log_bp = Blueprint('log', __name__)
+scan_bp = Blueprint('scan', __name__)
 
 # 创建SocketIO实例
 socketio = None
 
+probe_job_manager = ProbeJobManager()
+
 # 初始化函数
 def init_app(app):
     global socketio
@@ -82,6 +88,7 @@ def init_app(app):
     app.register_blueprint(worker_bp, url_prefix='/api/v1/workers')
     app.register_blueprint(video_bp, url_prefix='/api/v1/videos')
     app.register_blueprint(log_bp, url_prefix='/api/v1/logs')
+    app.register_blueprint(scan_bp, url_prefix='/api/v1/scans')
 
     return socketio
 
@@ -506,11 +513,28 @@ def create_task():
                 }
             })
 
+        # 接受探测任务的worker优先领取待探测的路径：探测很快，新文件探测完才能进入转码队列
+        if data.get('accept_probe'):
+            batch = probe_job_manager.dispatch_batch(worker, data.get('probe_batch'))
+            if batch:
+                return jsonify({
+                    'code': 201,
+                    'message': '创建探测任务成功',
+                    'data': batch
+                }), 201
+
+        # 转封装只复制流，几秒就能完成，不区分worker类型和是否支持VR，优先分配
+        video = VideoInfo.query.filter(
+            VideoInfo.exist == True,
+            VideoInfo.task_type == 'remux',
+            VideoInfo.transcode_status == 1
+        ).order_by(VideoInfo.video_size.desc()).first()
+
         # 查找待转码的视频
         query = VideoInfo.query.filter(
             # VideoInfo.transcode_status.in_([1, 5]),  # 等待转码或转码失败
-            VideoInfo.exist == True  # 文件必须存在
-            
+            VideoInfo.exist == True,  # 文件必须存在
+            db.or_(VideoInfo.task_type.is_(None), VideoInfo.task_type != 'remux')
         )
         if worker_type == 0 or worker_type == 2:
             query = query.filter(VideoInfo.transcode_status.in_([1, 5]))
@@ -530,9 +554,10 @@ def create_task():
             query = query.filter(VideoInfo.codec == 'h264')
 
         # 按照码率降序排序
-        video = query.order_by(
-            VideoInfo.bitrate_k.desc()
-        ).first()
+        if not video:
+            video = query.order_by(
+                VideoInfo.bitrate_k.desc()
+            ).first()
 
         if not video:
             return jsonify({'code': 404, 'message': '没有待转码的视频'}), 404
@@ -549,7 +574,8 @@ def create_task():
             video_id=video.id,
             video_path=video.video_path,
             dest_path=dest_path,
-            task_status=1  # 设置为运行状态
+            task_status=1,  # 设置为运行状态
+            task_type=video.task_type or 'transcode'
         )
 
         # 更新视频状态为已创建任务
@@ -581,14 +607,42 @@ def create_task():
             'task': task_data
         }, room='tasks_room')
 
+        response_data = {
+            'task_id': task_id,
+            'task_type': task.task_type,
+            'video_path': video.video_path
+        }
+        # 附带扫描时的探测结果，worker校验文件大小后可直接使用，不必重新ffprobe
+        if video.probe_data:
+            response_data['probe'] = base64.b64encode(video.probe_data).decode('ascii')
+
         return jsonify({
             'code': 201,
             'message': '创建任务成功',
+            'data': response_data
+        }), 201
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'code': 500, 'message': str(e)}), 500
+
+@task_bp.route('/<string:task_id>/probe', methods=['POST'])
+def submit_probe_results(task_id):
+    """worker批量回传探测任务的结果"""
+    try:
+        data = request.get_json()
+        results = data.get('results')
+        if not isinstance(results, list):
+            return jsonify({'code': 400, 'message': '参数不完整'}), 400
+
+        applied, failed = probe_job_manager.apply_results(task_id, results)
+        return jsonify({
+            'code': 200,
+            'message': '提交成功',
             'data': {
-                'task_id': task_id,
-                'video_path': video.video_path
+                'applied': applied,
+                'failed': failed
             }
-        }), 201
+        })
     except Exception as e:
         db.session.rollback()
         return jsonify({'code': 500, 'message': str(e)}), 500
@@ -683,6 +737,26 @@ def get_task(task_id):
     except Exception as e:
         return jsonify({'code': 500, 'message': str(e)}), 500
 
+def _rename_remux_output(video, output_name):
+    """转封装的输出替换了源文件时把记录改为同目录下的mkv
+
+    之后的扫描把mkv当作已有记录更新探测字段，转码状态和task_type保持不变，不会再作为新文件排队转码
+    """
+    existing = VideoInfo.query.filter(
+        VideoInfo.dir_id == video.dir_id,
+        VideoInfo.file_name == output_name,
+        VideoInfo.id != video.id
+    ).first()
+    if existing is not None:
+        if existing.transcode_status not in (0, 1):
+            logger.warning(f"{output_name} 已有记录且已分配任务，不改写转封装记录的路径")
+            return
+        # 扫描在任务完成前已经把输出文件当作新文件入库
+        db.session.delete(existing)
+        db.session.flush()
+    logger.info(f"转封装完成: {video.file_name} -> {output_name}")
+    video.file_name = output_name
+
 @task_bp.route('/<string:task_id>', methods=['PATCH'])
 def update_task(task_id):
     try:
@@ -720,6 +794,9 @@ def update_task(task_id):
                 task.remaining_time = 0  # 完成时剩余时间为0
                 video.transcode_status = 4  # completed
                 video.transcode_task_id = None
+                output_name = data.get('output_name')
+                if task.task_type == 'remux' and output_name and output_name != video.file_name:
+                    _rename_remux_output(video, output_name)
                 worker = TranscodeWorker.query.get(worker_id)
                 if worker:
                     worker.worker_status = 1  # pending
@@ -808,12 +885,15 @@ def list_videos():
         if max_size is not None:
             query = query.filter(VideoInfo.video_size <= max_size)
             
-        # 应用排序
-        sort_column = getattr(VideoInfo, sort_by, VideoInfo.updatetime)
+        # 应用排序，video_path不是数据库列，按目录id和文件名排序（同一目录的文件排在一起）
+        if sort_by == 'video_path':
+            sort_columns = [VideoInfo.dir_id, VideoInfo.file_name]
+        else:
+            sort_columns = [getattr(VideoInfo, sort_by, VideoInfo.updatetime)]
         if order == 'desc':
-            query = query.order_by(sort_column.desc())
+            query = query.order_by(*[column.desc() for column in sort_columns])
         else:
-            query = query.order_by(sort_column.asc())
+            query = query.order_by(*[column.asc() for column in sort_columns])
             
         # 执行分页查询
         pagination = query.paginate(page=page, per_page=per_page, error_out=False)
@@ -884,6 +964,140 @@ def get_video(video_id):
     except Exception as e:
         return jsonify({'code': 500, 'message': str(e)}), 500
 
+# 扫描相关路由
+@scan_bp.route('/schedule', methods=['GET'])
+def get_scan_schedule():
+    """各扫描路径和顶层目录的变化统计及下次扫描时间"""
+    try:
+        page = request.args.get('page', 1, type=int)
+        per_page = request.args.get('per_page', 100, type=int)
+        scan_path = request.args.get('scan_path')
+
+        # 按扫描路径汇总
+        root_rows = db.session.query(
+            ScanSchedule.scan_path,
+            db.func.count(ScanSchedule.id),
+            db.func.sum(ScanSchedule.change_rate),
+            db.func.sum(ScanSchedule.total_changes),
+            db.func.min(ScanSchedule.interval),
+            db.func.min(ScanSchedule.next_scan),
+            db.func.max(ScanSchedule.last_change)
+        ).group_by(ScanSchedule.scan_path).all()
+        roots = [{
+            'scan_path': path,
+            'dir_count': dir_count,
+            'change_rate': round(change_rate or 0, 3),
+            'total_changes': total_changes or 0,
+            'min_interval': min_interval,
+            'next_scan': next_scan.isoformat() if next_scan else None,
+            'last_change': last_change.isoformat() if last_change else None
+        } for path, dir_count, change_rate, total_changes, min_interval, next_scan, last_change in root_rows]
+
+        # 顶层目录按下次扫描时间排序
+        query = ScanSchedule.query
+        if scan_path:
+            query = query.filter(ScanSchedule.scan_path == scan_path)
+        pagination = query.order_by(ScanSchedule.next_scan.asc()).paginate(page=page, per_page=per_page, error_out=False)
+        dirs = [{
+            'scan_path': row.scan_path,
+            'top_dir': row.top_dir,
+            'interval': row.interval,
+            'change_rate': round(row.change_rate or 0, 3),
+            'total_changes': row.total_changes,
+            'scan_count': row.scan_count,
+            'last_change': row.last_change.isoformat() if row.last_change else None,
+            'last_scan': row.last_scan.isoformat() if row.last_scan else None,
+            'next_scan': row.next_scan.isoformat() if row.next_scan else None
+        } for row in pagination.items]
+
+        return jsonify({
+            'code': 200,
+            'message': '获取成功',
+            'data': {
+                'roots': roots,
+                'dirs': dirs,
+                'pagination': {
+                    'total': pagination.total,
+                    'pages': pagination.pages,
+                    'current_page': pagination.page,
+                    'per_page': pagination.per_page,
+                    'has_next': pagination.has_next,
+                    'has_prev': pagination.has_prev
+                }
+            }
+        })
+    except Exception as e:
+        return jsonify({'code': 500, 'message': str(e)}), 500
+
+def _scan_run_data(run):
+    return {
+        'id': run.id,
+        'pid': run.pid,
+        'status': run.status,
+        'phase': run.phase,
+        'scope': run.scope,
+        'forced': bool(run.forced),
+        'generation': run.generation,
+        'processed_count': run.processed_count,
+        'probed_count': run.probed_count,
+        'start_time': run.start_time.isoformat() if run.start_time else None,
+        'end_time': run.end_time.isoformat() if run.end_time else None,
+        'last_update': run.last_update.isoformat() if run.last_update else None,
+        'message': run.message,
+        'stats': json.loads(run.stats) if run.stats else None
+    }
+
+@scan_bp.route('/current', methods=['GET'])
+def get_current_scan():
+    """正在执行的扫描的进度和耗时统计，没有正在执行的扫描时返回最近一次扫描"""
+    try:
+        run = ScanRun.query.filter(ScanRun.status == 0).order_by(ScanRun.id.desc()).first()
+        running = run is not None
+        if run is None:
+            run = ScanRun.query.order_by(ScanRun.id.desc()).first()
+        if run is None:
+            return jsonify({'code': 404, 'message': '还没有扫描记录'}), 404
+
+        data = _scan_run_data(run)
+        data['running'] = running
+        return jsonify({'code': 200, 'message': '获取成功', 'data': data})
+    except Exception as e:
+        return jsonify({'code': 500, 'message': str(e)}), 500
+
+@scan_bp.route('', methods=['GET'])
+def list_scans():
+    """最近的扫描记录，按开始时间倒序"""
+    try:
+        page = request.args.get('page', 1, type=int)
+        per_page = request.args.get('per_page', 20, type=int)
+        scope = request.args.get('scope')
+        status = request.args.get('status', type=int)
+
+        query = ScanRun.query
+        if scope:
+            query = query.filter(ScanRun.scope == scope)
+        if status is not None:
+            query = query.filter(ScanRun.status == status)
+        pagination = query.order_by(ScanRun.id.desc()).paginate(page=page, per_page=per_page, error_out=False)
+
+        return jsonify({
+            'code': 200,
+            'message': '获取成功',
+            'data': {
+                'scans': [_scan_run_data(run) for run in pagination.items],
+                'pagination': {
+                    'total': pagination.total,
+                    'pages': pagination.pages,
+                    'current_page': pagination.page,
+                    'per_page': pagination.per_page,
+                    'has_next': pagination.has_next,
+                    'has_prev': pagination.has_prev
+                }
+            }
+        })
+    except Exception as e:
+        return jsonify({'code': 500, 'message': str(e)}), 500
+
 # 添加日志相关路由
 @log_bp.route('', methods=['GET'])
 def get_logs():
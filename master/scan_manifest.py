@@ -0,0 +1,117 @@
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from models import db, ScanDirectory
+
+logger = logging.getLogger(__name__)
+
+class DirectoryManifest:
+    """目录清单：记录每个目录的修改时间、子项数量和子项名称哈希
+
+    清单未变化的目录无需重新stat其中的文件，未变化的叶子目录连列目录都可以跳过
+    """
+
+    def __init__(self, force_full=False):
+        self.force_full = force_full
+        self.entries = {}  # {dir_path: (id, mtime, child_count, entries_hash, subdir_count)}
+        self.updates = {}  # {dir_path: (mtime, child_count, entries_hash, subdir_count)}
+        self.dirty = set()  # 本次有文件处理失败的目录，不更新清单以便下次重试
+        self.seen = set()  # 全量扫描时遍历到的目录
+        self.skipped_dirs = 0
+        self._lock = threading.Lock()  # 遍历线程并发访问
+
+    def load(self):
+        rows = db.session.query(
+            ScanDirectory.dir_path,
+            ScanDirectory.id,
+            ScanDirectory.mtime,
+            ScanDirectory.child_count,
+            ScanDirectory.entries_hash,
+            ScanDirectory.subdir_count
+        ).yield_per(5000)
+        for dir_path, dir_id, mtime, child_count, entries_hash, subdir_count in rows:
+            self.entries[dir_path] = (dir_id, mtime, child_count, entries_hash, subdir_count)
+        logger.info(f"已加载目录清单: {len(self.entries)} 个目录{' (本次强制全量扫描)' if self.force_full else ''}")
+        return self
+
+    @staticmethod
+    def hash_entries(names):
+        return hashlib.sha1('\n'.join(sorted(names)).encode('utf-8', errors='surrogateescape')).hexdigest()
+
+    def check(self, dir_path, mtime, names, subdir_count):
+        """记录目录的最新清单，返回目录内容是否与上次扫描一致"""
+        entries_hash = self.hash_entries(names)
+        current = (mtime, len(names), entries_hash, subdir_count)
+        with self._lock:
+            if self.force_full:
+                self.seen.add(dir_path)
+            stored = self.entries.get(dir_path)
+            if stored and stored[1:] == current:
+                return not self.force_full
+            self.updates[dir_path] = current
+            return False
+
+    def is_leaf_candidate(self, dir_path):
+        """该目录上次扫描时是否为叶子目录（可以只stat目录本身判断是否变化）"""
+        if self.force_full:
+            return False
+        stored = self.entries.get(dir_path)
+        return stored is not None and stored[4] == 0
+
+    def is_unchanged_leaf(self, dir_path, mtime):
+        stored = self.entries.get(dir_path)
+        if stored is not None and stored[4] == 0 and stored[1] == mtime:
+            self.count_skipped()
+            return True
+        return False
+
+    def count_skipped(self):
+        with self._lock:
+            self.skipped_dirs += 1
+
+    def mark_dirty(self, dir_path):
+        with self._lock:
+            self.dirty.add(dir_path)
+
+    def flush(self, chunk_size=1000):
+        """将变化的目录清单批量写入数据库"""
+        inserts = []
+        updates = []
+        now = datetime.utcnow()
+        for dir_path, (mtime, child_count, entries_hash, subdir_count) in self.updates.items():
+            if dir_path in self.dirty:
+                continue
+            values = {
+                'dir_path': dir_path,
+                'mtime': mtime,
+                'child_count': child_count,
+                'entries_hash': entries_hash,
+                'subdir_count': subdir_count,
+                'updatetime': now
+            }
+            stored = self.entries.get(dir_path)
+            if stored:
+                values['id'] = stored[0]
+                updates.append(values)
+            else:
+                inserts.append(values)
+        for i in range(0, len(inserts), chunk_size):
+            db.session.bulk_insert_mappings(ScanDirectory, inserts[i:i + chunk_size])
+        for i in range(0, len(updates), chunk_size):
+            db.session.bulk_update_mappings(ScanDirectory, updates[i:i + chunk_size])
+        self.updates = {}
+        self.dirty = set()
+        return len(inserts) + len(updates)
+
+    def prune(self, root_prefix, chunk_size=1000):
+        """全量扫描后删除已不存在的目录清单"""
+        if not self.force_full:
+            return 0
+        stale_ids = [
+            entry[0] for dir_path, entry in self.entries.items()
+            if dir_path.startswith(root_prefix) and dir_path not in self.seen
+        ]
+        for i in range(0, len(stale_ids), chunk_size):
+            ScanDirectory.query.filter(ScanDirectory.id.in_(stale_ids[i:i + chunk_size])).delete(synchronize_session=False)
+        return len(stale_ids)
@@ -0,0 +1,132 @@
+"""按变化频率自适应调度扫描
+
+每个扫描路径下的顶层目录（通常是演员目录）单独记录变化统计和扫描间隔：
+发现新增或修改文件的目录缩短扫描间隔，没有变化的目录逐次延长，间隔限制在
+[min_interval, max_interval] 之间。到期的顶层目录做局部扫描；距上次全量扫描超过
+max_interval时做一次全量扫描，用于识别移动文件、标记缺失文件和扫描路径根目录下的文件。
+"""
+import os
+import logging
+from datetime import datetime, timedelta
+from models import db, ScanRun, ScanSchedule
+
+logger = logging.getLogger(__name__)
+
+class AdaptiveScanSchedule:
+    def __init__(self, scan_paths, min_interval=900, max_interval=86400, smoothing=0.5):
+        """
+        Args:
+            scan_paths: 扫描路径列表
+            min_interval: 最短扫描间隔（秒）
+            max_interval: 最长扫描间隔（秒），同时也是全量扫描的间隔
+            smoothing: 变化率指数移动平均的权重，越大越偏向最近一次观测
+        """
+        self.scan_paths = scan_paths
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.smoothing = smoothing
+        self._last_sync = None
+
+    def compute_interval(self, change_rate, interval):
+        """按变化率计算扫描间隔：平均每个间隔发现约一个变化文件，每次最多延长一倍"""
+        grown = (interval or self.min_interval) * 2
+        target = 3600 / change_rate if change_rate > 0 else grown
+        return int(max(self.min_interval, min(self.max_interval, target, grown)))
+
+    def sync_top_dirs(self, now):
+        """列出各扫描路径的顶层目录，为新目录创建调度记录，删除已不存在的目录的记录"""
+        rows = {(row.scan_path, row.top_dir): row for row in ScanSchedule.query.all()}
+        configured = set(self.scan_paths)
+        for key, row in rows.items():
+            if key[0] not in configured:
+                db.session.delete(row)
+
+        for scan_path in self.scan_paths:
+            try:
+                with os.scandir(scan_path) as it:
+                    names = {entry.name for entry in it if entry.is_dir(follow_symlinks=False)}
+            except OSError as e:
+                logger.warning(f"列出 {scan_path} 的顶层目录失败，保留原有调度: {str(e)}")
+                continue
+
+            existing = {top_dir: row for (path, top_dir), row in rows.items() if path == scan_path}
+            # 首次建立调度时所有目录都刚被扫描过，推迟一个最短间隔；之后新出现的目录立即扫描
+            initial = not existing
+            for name in names - set(existing):
+                db.session.add(ScanSchedule(
+                    scan_path=scan_path,
+                    top_dir=name,
+                    interval=self.min_interval,
+                    change_rate=0,
+                    total_changes=0,
+                    scan_count=0,
+                    last_scan=now if initial else None,
+                    next_scan=now + timedelta(seconds=self.min_interval) if initial else now
+                ))
+            for name in set(existing) - names:
+                db.session.delete(existing[name])
+        db.session.commit()
+        self._last_sync = now
+
+    def full_scan_due(self, now):
+        """距上次成功的全量扫描是否已超过max_interval"""
+        last_full = db.session.query(db.func.max(ScanRun.start_time)).filter(
+            db.or_(ScanRun.scope == 'full', ScanRun.scope.is_(None)),
+            ScanRun.status == 1
+        ).scalar()
+        return last_full is None or (now - last_full).total_seconds() >= self.max_interval
+
+    def due_dirs(self, now):
+        return ScanSchedule.query.filter(ScanSchedule.next_scan <= now).order_by(ScanSchedule.next_scan).all()
+
+    def record(self, rows, changes, now):
+        """根据本次扫描发现的变化更新变化率和下次扫描时间
+
+        Args:
+            rows: 本次扫描覆盖的ScanSchedule记录
+            changes: {(scan_path, top_dir): 新增或修改的文件数}
+        """
+        for row in rows:
+            count = changes.get((row.scan_path, row.top_dir), 0)
+            if row.scan_count and row.last_scan:
+                observed = count * 3600 / max((now - row.last_scan).total_seconds(), 60)
+                row.change_rate = self.smoothing * observed + (1 - self.smoothing) * (row.change_rate or 0)
+            else:
+                # 首次扫描的变化数包含目录中原有的全部文件，只作为基线不计入变化率
+                row.change_rate = 0
+            row.interval = self.compute_interval(row.change_rate, row.interval)
+            row.total_changes = (row.total_changes or 0) + count
+            row.scan_count = (row.scan_count or 0) + 1
+            if count:
+                row.last_change = now
+            row.last_scan = now
+            row.next_scan = now + timedelta(seconds=row.interval)
+        db.session.commit()
+
+    def postpone(self, rows, now):
+        """扫描失败时推迟一个最短间隔后重试"""
+        for row in rows:
+            row.next_scan = now + timedelta(seconds=self.min_interval)
+        db.session.commit()
+
+    def run(self, video_manager):
+        """执行一次调度：需要时做全量扫描，否则局部扫描到期的顶层目录（需要在应用上下文中调用）"""
+        now = datetime.utcnow()
+        if self._last_sync is None or (now - self._last_sync).total_seconds() >= self.min_interval:
+            self.sync_top_dirs(now)
+
+        if self.full_scan_due(now):
+            rows = ScanSchedule.query.all()
+            logger.info(f"距上次全量扫描已超过 {self.max_interval}秒，执行全量扫描")
+            changes = video_manager.scan_videos()
+        else:
+            rows = self.due_dirs(now)
+            if not rows:
+                return
+            logger.info(f"按调度扫描 {len(rows)} 个顶层目录")
+            changes = video_manager.scan_videos(targets=[os.path.join(row.scan_path, row.top_dir) for row in rows])
+
+        if changes is None:
+            self.postpone(rows, datetime.utcnow())
+        else:
+            self.record(rows, changes, datetime.utcnow())
@@ -0,0 +1,163 @@
+"""扫描过程的耗时统计
+
+记录一次扫描在各阶段的耗时、最慢的目录和文件、探测耗时分布以及新增/修改/缺失文件数，
+随扫描进度写入scan_run.stats，用于调整遍历和探测并发数、发现变慢的共享。
+
+阶段耗时的含义：
+    walk: 遍历线程列目录（scandir）的累计耗时
+    stat: 遍历线程获取文件和子目录状态的累计耗时
+    probe: 探测线程解析流信息的累计耗时
+    fingerprint: 读取文件开头和结尾计算指纹的累计耗时
+    db: 调度线程读写数据库的耗时
+    wait_walk: 调度线程等待遍历结果的耗时，偏高说明遍历是瓶颈
+    wait_probe: 调度线程等待探测结果的耗时，偏高说明探测是瓶颈
+walk、stat、probe和fingerprint是多个线程的耗时之和，可能超过扫描的总耗时。
+"""
+import time
+import heapq
+import threading
+from contextlib import contextmanager
+
+PHASES = ('walk', 'stat', 'probe', 'fingerprint', 'db', 'wait_walk', 'wait_probe')
+# 探测耗时直方图的分桶上限（秒），最后一个桶统计超过最大上限的探测
+PROBE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+
+class ScanStats:
+    def __init__(self, top_n=10):
+        """
+        Args:
+            top_n: 记录最慢的目录和文件的数量
+        """
+        self.top_n = top_n
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.counts = {'new': 0, 'changed': 0, 'missing': 0, 'relinked': 0, 'deferred': 0, 'queued': 0,
+                       'queue_waiting': 0, 'probe_failed': 0}
+        self.roots = {}  # {scan_path: {'dirs', 'files', 'walk', 'stat', 'probed', 'probe'}}
+        self.probe_latencies = []
+        self._slow_dirs = []  # 小顶堆 [(耗时, 目录, 文件数)]
+        self._slow_files = []  # 小顶堆 [(耗时, 文件)]
+        self._lock = threading.Lock()
+
+    def add_time(self, phase, seconds):
+        with self._lock:
+            self.phases[phase] += seconds
+
+    @contextmanager
+    def timed(self, phase):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.monotonic() - start)
+
+    def timed_iter(self, iterable, phase):
+        """逐个产出iterable的元素，等待下一个元素的时间计入phase"""
+        iterator = iter(iterable)
+        while True:
+            start = time.monotonic()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(phase, time.monotonic() - start)
+                return
+            self.add_time(phase, time.monotonic() - start)
+            yield item
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counts[name] += value
+
+    def _root(self, scan_path):
+        return self.roots.setdefault(scan_path, {'dirs': 0, 'files': 0, 'walk': 0.0, 'stat': 0.0,
+                                                 'probed': 0, 'probe': 0.0})
+
+    def record_dir(self, scan_path, path, walk_seconds, stat_seconds, file_count):
+        """记录一个目录的列目录和获取状态耗时（在遍历线程中调用）"""
+        elapsed = walk_seconds + stat_seconds
+        with self._lock:
+            self.phases['walk'] += walk_seconds
+            self.phases['stat'] += stat_seconds
+            root = self._root(scan_path)
+            root['dirs'] += 1
+            root['files'] += file_count
+            root['walk'] += walk_seconds
+            root['stat'] += stat_seconds
+            item = (elapsed, path, file_count)
+            if len(self._slow_dirs) < self.top_n:
+                heapq.heappush(self._slow_dirs, item)
+            elif elapsed > self._slow_dirs[0][0]:
+                heapq.heapreplace(self._slow_dirs, item)
+
+    def record_probe(self, scan_path, path, seconds):
+        """记录一个文件的探测耗时（在调度线程中调用）"""
+        with self._lock:
+            self.phases['probe'] += seconds
+            self.probe_latencies.append(seconds)
+            root = self._root(scan_path)
+            root['probed'] += 1
+            root['probe'] += seconds
+            item = (seconds, path)
+            if len(self._slow_files) < self.top_n:
+                heapq.heappush(self._slow_files, item)
+            elif seconds > self._slow_files[0][0]:
+                heapq.heapreplace(self._slow_files, item)
+
+    def probe_percentiles(self):
+        """探测耗时的 p50/p90/p99/max（秒）"""
+        latencies = sorted(self.probe_latencies)
+        if not latencies:
+            return None
+        return {
+            'p50': _percentile(latencies, 50),
+            'p90': _percentile(latencies, 90),
+            'p99': _percentile(latencies, 99),
+            'max': latencies[-1]
+        }
+
+    def probe_histogram(self):
+        """探测耗时直方图 [{'le': 分桶上限, 'count': 文件数}]，le为None的桶统计超过最大上限的探测"""
+        counts = [0] * (len(PROBE_BUCKETS) + 1)
+        for seconds in self.probe_latencies:
+            for i, bound in enumerate(PROBE_BUCKETS):
+                if seconds <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+        return [{'le': bound, 'count': count} for bound, count in zip(PROBE_BUCKETS + (None,), counts)]
+
+    def to_dict(self, processed_count, elapsed):
+        """生成写入scan_run.stats的统计数据"""
+        with self._lock:
+            percentiles = self.probe_percentiles()
+            return {
+                'elapsed': round(elapsed, 3),
+                'files_per_sec': round(processed_count / elapsed, 1) if elapsed > 0 else 0,
+                'phases': {phase: round(seconds, 3) for phase, seconds in self.phases.items()},
+                'counts': dict(self.counts),
+                'roots': {
+                    scan_path: {key: round(value, 3) if isinstance(value, float) else value
+                                for key, value in root.items()}
+                    for scan_path, root in self.roots.items()
+                },
+                'probe': {
+                    'count': len(self.probe_latencies),
+                    'percentiles': {key: round(value, 3) for key, value in percentiles.items()} if percentiles else None,
+                    'histogram': self.probe_histogram()
+                },
+                'slowest_dirs': [
+                    {'path': path, 'seconds': round(seconds, 3), 'files': file_count}
+                    for seconds, path, file_count in sorted(self._slow_dirs, reverse=True)
+                ],
+                'slowest_files': [
+                    {'path': path, 'seconds': round(seconds, 3)}
+                    for seconds, path in sorted(self._slow_files, reverse=True)
+                ]
+            }
+
+def _percentile(sorted_values, pct):
+    """计算已排序列表的百分位数（最近秩法）"""
+    if not sorted_values:
+        return 0
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
@@ -0,0 +1,257 @@
+"""扫描路径的文件监听
+
+本地磁盘上的扫描路径通过watchdog（Linux上为inotify）监听文件变化，新文件在大小稳定后
+立即交给VideoManager做局部扫描，不必等待每小时一次的全量扫描。
+无法监听的扫描路径（SMB/NFS等网络共享，或未安装watchdog）按固定间隔轮询做局部扫描。
+全量扫描保持不变，用于核对监听遗漏的变化、识别移动文件和标记缺失文件。
+"""
+import os
+import re
+import time
+import logging
+import threading
+from models import db
+from dir_walker import VIDEO_EXTENSIONS
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+logger = logging.getLogger(__name__)
+
+# 不支持inotify的网络文件系统类型
+NETWORK_FS_TYPES = {'cifs', 'smb3', 'smbfs', 'nfs', 'nfs4', 'sshfs', 'fuse.sshfs', '9p'}
+# GetDriveTypeW 返回的网络驱动器类型
+DRIVE_REMOTE = 4
+
+def is_video_file(path):
+    name = os.path.basename(path)
+    return name.endswith(VIDEO_EXTENSIONS) and '-trailer' not in name.lower()
+
+def _mount_fstype(path):
+    """从/proc/mounts中找到路径所在挂载点的文件系统类型"""
+    real_path = os.path.realpath(path)
+    best_mount, best_type = '', None
+    try:
+        with open('/proc/mounts', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                # 挂载点中的空格等字符以八进制转义
+                mount_point = re.sub(r'\\(\d{3})', lambda m: chr(int(m.group(1), 8)), fields[1])
+                if real_path == mount_point or real_path.startswith(mount_point.rstrip('/') + '/'):
+                    if len(mount_point) >= len(best_mount):
+                        best_mount, best_type = mount_point, fields[2]
+    except OSError:
+        return None
+    return best_type
+
+def is_watchable(path):
+    """扫描路径是否可以用文件系统事件监听（网络共享只能轮询）"""
+    if path.replace('\\', '/').startswith('//'):
+        return False
+    if os.name == 'nt':
+        import ctypes
+        drive = os.path.splitdrive(os.path.abspath(path))[0] + '\\'
+        return ctypes.windll.kernel32.GetDriveTypeW(drive) != DRIVE_REMOTE
+    fstype = _mount_fstype(path)
+    return fstype is None or fstype not in NETWORK_FS_TYPES
+
+class _EventHandler(FileSystemEventHandler):
+    """把watchdog事件转交给ScanWatcher（在watchdog的线程中调用）"""
+
+    def __init__(self, watcher):
+        super().__init__()
+        self.watcher = watcher
+
+    def on_created(self, event):
+        if event.is_directory:
+            self.watcher.add_directory(event.src_path)
+        elif is_video_file(event.src_path):
+            self.watcher.add_file(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory and is_video_file(event.src_path):
+            self.watcher.add_file(event.src_path)
+
+    def on_moved(self, event):
+        self.watcher.add_move(event.src_path, event.dest_path, event.is_directory)
+
+class ScanWatcher:
+    """监听本地扫描路径，文件大小稳定后做局部扫描；无法监听的扫描路径按间隔轮询"""
+
+    def __init__(self, video_manager, app, debounce=10, poll_interval=300, tick=1):
+        """
+        Args:
+            video_manager: VideoManager
+            app: 提供数据库连接的Flask应用
+            debounce: 文件最后一次变化后等待的秒数，连续两次检查大小一致才入库
+            poll_interval: 无法监听的扫描路径的轮询间隔（秒）
+            tick: 检查待处理文件的间隔（秒）
+        """
+        self.video_manager = video_manager
+        self.app = app
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.tick = tick
+        self.observer = None
+        self.watched_roots = []
+        self.polled_roots = {}  # {scan_path: 下次轮询时间}
+        self._pending_files = {}  # {path: {'due': 检查时间, 'size': 上次检查到的大小}}
+        self._pending_dirs = {}  # {path: 检查时间}
+        self._moves = []  # [(src_path, dest_path, is_directory)]
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        unwatched_local = []  # 因未安装watchdog而改为轮询的本地扫描路径
+        for scan_path in self.video_manager.scan_paths:
+            if not is_watchable(scan_path):
+                logger.info(f"{scan_path} 是网络共享，不能监听，改为轮询")
+            elif Observer is None:
+                unwatched_local.append(scan_path)
+            else:
+                try:
+                    if self.observer is None:
+                        self.observer = Observer()
+                    self.observer.schedule(_EventHandler(self), scan_path, recursive=True)
+                    self.watched_roots.append(scan_path)
+                    continue
+                except Exception as e:
+                    # 例如超出inotify监听数量上限（fs.inotify.max_user_watches）
+                    logger.warning(f"无法监听 {scan_path}，改为轮询: {str(e)}")
+            # 首次轮询留给启动后的第一次定时全量扫描之后
+            self.polled_roots[scan_path] = time.monotonic() + self.poll_interval
+
+        if unwatched_local:
+            logger.warning(f"导入watchdog失败，本地扫描路径 {unwatched_local} 无法监听，改为每 {self.poll_interval}秒轮询；"
+                           f"请执行 pip install -r requirements.txt 安装watchdog")
+        if self.observer is not None:
+            self.observer.start()
+        if self.watched_roots:
+            logger.info(f"文件监听已启动: {self.watched_roots} (稳定等待 {self.debounce}秒)")
+        if self.polled_roots:
+            logger.info(f"以下扫描路径每 {self.poll_interval}秒轮询一次: {list(self.polled_roots)}")
+
+        self._thread = threading.Thread(target=self._run, name='scan-watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        self._stopped.set()
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join(timeout)
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def add_file(self, path):
+        """文件有变化，推迟检查时间（保留上次检查到的大小）"""
+        with self._lock:
+            entry = self._pending_files.setdefault(path, {'due': 0, 'size': None})
+            entry['due'] = time.monotonic() + self.debounce
+
+    def add_directory(self, path):
+        """新目录（包括从扫描路径外移入的目录）在防抖后展开为其中的视频文件"""
+        with self._lock:
+            self._pending_dirs[path] = time.monotonic() + self.debounce
+
+    def add_move(self, src_path, dest_path, is_directory):
+        with self._lock:
+            self._moves.append((src_path, dest_path, is_directory))
+
+    def _take_moves(self):
+        with self._lock:
+            moves, self._moves = self._moves, []
+        return moves
+
+    def _expand_due_directories(self, now):
+        with self._lock:
+            due = [path for path, due_time in self._pending_dirs.items() if due_time <= now]
+            for path in due:
+                del self._pending_dirs[path]
+        for path in due:
+            self._add_directory_files(path)
+
+    def _add_directory_files(self, path):
+        for root, _, files in os.walk(path):
+            for name in files:
+                file_path = os.path.join(root, name)
+                if is_video_file(file_path):
+                    self.add_file(file_path)
+
+    def _take_stable_files(self, now):
+        """检查到期的待处理文件，返回大小已经稳定的文件"""
+        with self._lock:
+            due = [(path, entry['size']) for path, entry in self._pending_files.items() if entry['due'] <= now]
+
+        stable = []
+        for path, last_size in due:
+            try:
+                size = os.stat(path).st_size
+            except OSError:
+                size = None
+            with self._lock:
+                entry = self._pending_files.get(path)
+                if entry is None or entry['due'] > now:
+                    # 检查期间又有新事件
+                    continue
+                if size is None:
+                    del self._pending_files[path]
+                elif size > 0 and size == last_size:
+                    del self._pending_files[path]
+                    stable.append(path)
+                else:
+                    entry['size'] = size
+                    entry['due'] = now + self.debounce
+        return stable
+
+    def _apply_moves(self, moves):
+        """扫描路径内的移动直接改写记录路径，改写不了的按新文件处理"""
+        for src_path, dest_path, is_directory in moves:
+            if self.video_manager.get_scan_root(dest_path) is None:
+                continue
+            relinked = 0
+            if self.video_manager.get_scan_root(src_path) is not None and (is_directory or is_video_file(src_path)):
+                try:
+                    relinked = self.video_manager.relink_path(src_path, dest_path, is_directory)
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"更新移动文件的路径失败 {src_path} -> {dest_path}: {str(e)}")
+            if relinked:
+                logger.info(f"文件已移动: {src_path} -> {dest_path} ({relinked} 条记录)")
+            elif is_directory:
+                self.add_directory(dest_path)
+            elif is_video_file(dest_path):
+                self.add_file(dest_path)
+
+    def _run(self):
+        while not self._stopped.wait(self.tick):
+            try:
+                self._process(time.monotonic())
+            except Exception as e:
+                logger.error(f"处理文件监听事件时出错: {str(e)}")
+
+    def _process(self, now):
+        moves = self._take_moves()
+        self._expand_due_directories(now)
+        stable = self._take_stable_files(now)
+        due_roots = [root for root, next_poll in self.polled_roots.items() if next_poll <= now]
+        if not (moves or stable or due_roots):
+            return
+
+        with self.app.app_context():
+            if moves:
+                with self.video_manager.scan_lock:
+                    self._apply_moves(moves)
+            if stable:
+                logger.info(f"监听到 {len(stable)} 个新文件或已修改文件")
+                self.video_manager.scan_videos(targets=stable)
+            for root in due_roots:
+                self.video_manager.scan_videos(targets=[root])
+                self.polled_roots[root] = time.monotonic() + self.poll_interval
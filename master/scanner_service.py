@@ -0,0 +1,229 @@
+"""独立的视频扫描进程
+
+master以子进程方式启动本模块并监督其运行（退出后自动重启）。
+扫描进程使用自己的Flask应用和数据库连接池，按计划执行VideoManager.scan_videos，
+进度写入scan_run表。启用文件监听时，本地扫描路径的新文件由ScanWatcher即时做局部扫描。
+master关闭子进程的stdin（包括master异常退出）时扫描进程随之退出。
+
+也可以单独运行一次扫描：
+    python scanner_service.py --once
+"""
+import os
+import sys
+import time
+import argparse
+import logging
+import subprocess
+import threading
+from datetime import datetime
+from flask import Flask
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.cron import CronTrigger
+from models import db, ScanRun, TranscodeLog
+from config import Config
+from video_manager import VideoManager
+from scan_watcher import ScanWatcher
+from scan_schedule import AdaptiveScanSchedule
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from probe_cache import configure_default_cache
+
+logger = logging.getLogger(__name__)
+
+SCRIPT_PATH = os.path.abspath(__file__)
+
+class ScannerProcess:
+    """在master中启动并监督扫描进程"""
+
+    def __init__(self, restart_delay=10, max_restart_delay=600):
+        self.process = None
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self._current_delay = restart_delay
+        self._next_start = 0
+        self._stopped = False
+
+    def start(self):
+        """启动扫描进程，stdin保持为管道用于感知master退出"""
+        self.process = subprocess.Popen(
+            [sys.executable, SCRIPT_PATH],
+            stdin=subprocess.PIPE
+        )
+        logger.info(f"扫描进程已启动，PID: {self.process.pid}")
+
+    def check(self):
+        """检查扫描进程是否存活，退出时按退避间隔重启"""
+        if self._stopped:
+            return
+        if self.process is not None:
+            exit_code = self.process.poll()
+            if exit_code is None:
+                self._current_delay = self.restart_delay
+                return
+            logger.error(f"扫描进程已退出，退出码: {exit_code}，{self._current_delay}秒后重启")
+            self.process = None
+            self._next_start = time.monotonic() + self._current_delay
+            self._current_delay = min(self._current_delay * 2, self.max_restart_delay)
+            return
+        if time.monotonic() >= self._next_start:
+            try:
+                self.start()
+            except Exception as e:
+                logger.error(f"启动扫描进程失败: {str(e)}")
+                self._next_start = time.monotonic() + self._current_delay
+
+    def stop(self, timeout=10):
+        self._stopped = True
+        if self.process is None or self.process.poll() is not None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            logger.warning("扫描进程未按时退出，强制结束")
+            self.process.terminate()
+        except Exception as e:
+            logger.error(f"停止扫描进程失败: {str(e)}")
+        logger.info("扫描进程已停止")
+
+    @property
+    def pid(self):
+        return self.process.pid if self.process is not None else None
+
+def create_scanner_app(config):
+    """创建扫描进程使用的Flask应用（只用于数据库连接）"""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = config.database_uri
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_pre_ping': True, 'pool_recycle': 3600}
+    db.init_app(app)
+    return app
+
+def mark_interrupted_runs():
+    """将上一次扫描进程遗留的运行中记录标记为中断"""
+    count = ScanRun.query.filter(ScanRun.status == 0).update({
+        ScanRun.status: 3,
+        ScanRun.end_time: datetime.utcnow(),
+        ScanRun.message: '扫描进程退出，扫描中断'
+    }, synchronize_session=False)
+    db.session.commit()
+    if count:
+        logger.warning(f"{count} 次扫描因扫描进程退出而中断")
+
+def run_scan(app, video_manager):
+    with app.app_context():
+        try:
+            logger.info(f"开始扫描视频文件，路径: {video_manager.scan_paths}")
+            video_manager.scan_videos()
+        except Exception as e:
+            logger.error(f"扫描视频文件时出错: {str(e)}")
+            try:
+                db.session.rollback()
+                db.session.add(TranscodeLog(log_level=3, log_message=f"扫描视频文件时出错: {str(e)}"))
+                db.session.commit()
+            except Exception as log_error:
+                logger.error(f"记录错误日志失败: {str(log_error)}")
+
+def run_scheduled_scan(app, schedule, video_manager):
+    with app.app_context():
+        try:
+            schedule.run(video_manager)
+        except Exception as e:
+            logger.error(f"按调度扫描视频文件时出错: {str(e)}")
+            db.session.rollback()
+
+def run_pending_check(app, video_manager):
+    """复查暂缓探测的文件"""
+    with app.app_context():
+        try:
+            video_manager.ingest_pending()
+        except Exception as e:
+            logger.error(f"复查暂缓的文件时出错: {str(e)}")
+            db.session.rollback()
+
+def watch_parent(stop_event):
+    """stdin读到EOF说明master已经关闭管道或退出"""
+    try:
+        while sys.stdin.buffer.read(1024):
+            pass
+    except Exception:
+        pass
+    stop_event.set()
+
+def main():
+    parser = argparse.ArgumentParser(description='视频扫描进程')
+    parser.add_argument('--once', action='store_true', help='只执行一次扫描后退出')
+    args = parser.parse_args()
+
+    config = Config()
+    configure_default_cache(**config.probe_cache)
+    if not config.validate_paths():
+        logger.error("配置的扫描路径无效，请检查config.ini文件")
+        sys.exit(1)
+
+    app = create_scanner_app(config)
+    video_manager = VideoManager(config.scan_paths, **config.scan_options)
+    with app.app_context():
+        mark_interrupted_runs()
+
+    if args.once:
+        run_scan(app, video_manager)
+        return
+
+    scheduler = BackgroundScheduler()
+    schedule_options = config.scan_schedule
+    if schedule_options['enabled']:
+        schedule = AdaptiveScanSchedule(config.scan_paths, schedule_options['min_interval'],
+                                        schedule_options['max_interval'])
+        scheduler.add_job(
+            func=run_scheduled_scan,
+            args=(app, schedule, video_manager),
+            trigger='interval',
+            seconds=60,
+            id='scan_videos',
+            name='按调度扫描视频文件',
+            max_instances=1,
+            replace_existing=True
+        )
+        schedule_desc = f"按目录变化频率调度，间隔 {schedule.min_interval}~{schedule.max_interval}秒"
+    else:
+        scheduler.add_job(
+            func=run_scan,
+            args=(app, video_manager),
+            trigger=CronTrigger(minute=5),  # 每小时的第5分钟执行
+            id='scan_videos',
+            name='扫描视频文件',
+            max_instances=1,
+            replace_existing=True
+        )
+        schedule_desc = "每小时05分执行"
+    if video_manager.stable_seconds > 0:
+        scheduler.add_job(
+            func=run_pending_check,
+            args=(app, video_manager),
+            trigger='interval',
+            seconds=max(10, video_manager.stable_seconds // 2),
+            id='check_pending_files',
+            name='复查暂缓探测的文件',
+            max_instances=1,
+            replace_existing=True
+        )
+    scheduler.start()
+    logger.info(f"扫描进程已就绪 (PID: {os.getpid()})，视频扫描任务：{schedule_desc}")
+
+    watcher = None
+    watch = config.watch
+    if watch['enabled']:
+        watcher = ScanWatcher(video_manager, app, debounce=watch['debounce'], poll_interval=watch['poll_interval'])
+        watcher.start()
+
+    stop_event = threading.Event()
+    threading.Thread(target=watch_parent, args=(stop_event,), name='watch-parent', daemon=True).start()
+    stop_event.wait()
+    logger.info("master已退出，扫描进程停止")
+    if watcher is not None:
+        watcher.stop()
+    scheduler.shutdown(wait=False)
+
+if __name__ == '__main__':
+    main()
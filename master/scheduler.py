@@ -7,27 +7,73 @@ import logging
 from worker_manager import WorkerManager
 from video_manager import VideoManager
 from task_manager import TaskManager
+from probe_job_manager import ProbeJobManager
+from scanner_service import ScannerProcess
+from scan_schedule import AdaptiveScanSchedule
 from video import Video
 
 logger = logging.getLogger(__name__)
 
 class TaskScheduler:
-    def __init__(self, app: Flask, scan_paths: list, scan_interval: int = None):
+    def __init__(self, app: Flask, scan_paths: list, scan_interval: int = None,
+                 scan_mode: str = 'inline', scan_options: dict = None, scan_schedule: dict = None):
         self.app = app
         self.scan_paths = scan_paths
+        self.scan_mode = scan_mode
         self.scheduler = BackgroundScheduler()
         self.worker_manager = WorkerManager()
-        self.video_manager = VideoManager(scan_paths)
         self.task_manager = TaskManager(app, app.socketio)
-        
-        # 使用 cron trigger 设置每小时05分执行视频扫描
-        self.scheduler.add_job(
-            func=self.scan_videos,
-            trigger=CronTrigger(minute=5),  # 每小时的第5分钟执行
-            id='scan_videos',
-            name='扫描视频文件',
-            replace_existing=True
-        )
+        self.probe_job_manager = ProbeJobManager()
+        self.video_manager = None
+        self.scanner_process = None
+        self.scan_schedule = None
+
+        if scan_mode == 'process':
+            # 扫描在独立进程中执行，这里只负责启动和监督
+            self.scanner_process = ScannerProcess()
+            self.scheduler.add_job(
+                func=self.scanner_process.check,
+                trigger='interval',
+                seconds=30,
+                id='check_scanner',
+                name='检查扫描进程',
+                replace_existing=True
+            )
+        else:
+            self.video_manager = VideoManager(scan_paths, **(scan_options or {}))
+            if scan_schedule and scan_schedule.get('enabled'):
+                # 每分钟检查一次到期的目录，按目录变化频率调度扫描
+                self.scan_schedule = AdaptiveScanSchedule(scan_paths, scan_schedule['min_interval'],
+                                                          scan_schedule['max_interval'])
+                self.scheduler.add_job(
+                    func=self.scan_videos,
+                    trigger='interval',
+                    seconds=60,
+                    id='scan_videos',
+                    name='按调度扫描视频文件',
+                    max_instances=1,
+                    replace_existing=True
+                )
+            else:
+                # 使用 cron trigger 设置每小时05分执行视频扫描
+                self.scheduler.add_job(
+                    func=self.scan_videos,
+                    trigger=CronTrigger(minute=5),  # 每小时的第5分钟执行
+                    id='scan_videos',
+                    name='扫描视频文件',
+                    replace_existing=True
+                )
+            if self.video_manager.stable_seconds > 0:
+                # 复查还在写入而暂缓探测的文件
+                self.scheduler.add_job(
+                    func=self.check_pending_files,
+                    trigger='interval',
+                    seconds=max(10, self.video_manager.stable_seconds // 2),
+                    id='check_pending_files',
+                    name='复查暂缓探测的文件',
+                    max_instances=1,
+                    replace_existing=True
+                )
         
         # 添加检查worker状态的定时任务，每30秒执行一次
         self.scheduler.add_job(
@@ -51,9 +97,16 @@ class TaskScheduler:
 
     def start(self):
         try:
+            if self.scanner_process is not None:
+                self.scanner_process.start()
             self.scheduler.start()
             logger.info("定时任务调度器已启动")
-            logger.info("- 视频扫描任务：每小时05分执行")
+            if self.scanner_process is not None:
+                logger.info("- 视频扫描任务：由独立扫描进程执行，每30秒检查一次扫描进程")
+            elif self.scan_schedule is not None:
+                logger.info("- 视频扫描任务：每分钟检查一次，按目录变化频率调度")
+            else:
+                logger.info("- 视频扫描任务：每小时05分执行")
             logger.info("- Worker状态检查：每30秒执行一次")
             logger.info("- 任务状态检查：每30秒执行一次")
         except Exception as e:
@@ -61,6 +114,8 @@ class TaskScheduler:
 
     def stop(self):
         try:
+            if self.scanner_process is not None:
+                self.scanner_process.stop()
             self.scheduler.shutdown()
             logger.info("定时任务调度器已停止")
         except Exception as e:
@@ -79,6 +134,9 @@ class TaskScheduler:
         """扫描视频文件的定时任务"""
         with self.app.app_context():
             try:
+                if self.scan_schedule is not None:
+                    self.scan_schedule.run(self.video_manager)
+                    return
                 logger.info(f"开始扫描视频文件，路径: {self.scan_paths}")
                 # 使用 VideoManager 的 scan_videos 方法
                 self.video_manager.scan_videos()
@@ -96,11 +154,21 @@ class TaskScheduler:
                 except Exception as log_error:
                     logger.error(f"记录错误日志失败: {str(log_error)}")
 
+    def check_pending_files(self):
+        """复查暂缓探测的文件的定时任务"""
+        with self.app.app_context():
+            try:
+                self.video_manager.ingest_pending()
+            except Exception as e:
+                logger.error(f"复查暂缓的文件时出错: {str(e)}")
+
     def check_tasks(self):
         """检查任务状态的定时任务"""
         with self.app.app_context():
             try:
                 logger.debug("开始检查任务状态...")
                 self.task_manager.check_tasks_status()
+                # 超时未回传结果的探测任务重新排队
+                self.probe_job_manager.requeue_stale()
             except Exception as e:
                 logger.error(f"检查任务状态时出错: {str(e)}")
\ No newline at end of file
@@ -0,0 +1,332 @@
+"""video_info的目录字典
+
+video_info只保存所在目录的id（dir_id）和文件名，目录按父指针存放在video_dir表中：
+目录路径由目录名沿parent_id逐级拼接而成，顶层目录的parent_id为0。
+目录被移动或改名时只需改写一行video_dir。
+
+VideoDirResolver在进程内缓存整张video_dir表（目录数量远少于文件数量），
+按refresh_interval增量加载其他进程新建或改动的目录，拼接好的路径也一并缓存。
+新建和移动目录不单独提交，随调用方的事务（例如扫描的批量写入）一起提交；
+事务回滚时清空缓存，下次使用时从数据库重新加载。
+"""
+import re
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import event, inspect, text
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects import mysql, sqlite
+from models import db, VideoDir, VideoInfo, find_duplicate_keys
+
+logger = logging.getLogger(__name__)
+
+# 增量加载时多回看的时间，容忍进程之间的时钟和提交延迟
+REFRESH_MARGIN = timedelta(seconds=60)
+
+def split_path(video_path):
+    """把相对路径拆分为 (目录路径, 文件名)，不含分隔符的路径（扫描不会产生，只可能来自旧数据）目录为None"""
+    if '\\' not in video_path:
+        return None, video_path
+    return tuple(video_path.rsplit('\\', 1))
+
+class VideoDirResolver:
+    def __init__(self, refresh_interval=60):
+        """
+        Args:
+            refresh_interval: 增量加载其他进程改动的目录的最小间隔（秒）
+        """
+        self.refresh_interval = refresh_interval
+        self._parents = {}  # {dir_id: (parent_id, name)}
+        self._ids = {}  # {(parent_id, name): dir_id}
+        self._paths = {}  # {dir_id: 目录路径}
+        self._synced_at = None  # 上次加载时的数据库时间（utc）
+        self._last_check = 0
+        self._uncommitted = set()  # 新建或移动了目录但还未提交的会话
+        self._lock = threading.RLock()
+        event.listen(Session, 'after_commit', self._after_commit)
+        event.listen(Session, 'after_rollback', self._after_rollback)
+
+    def _after_commit(self, session):
+        with self._lock:
+            self._uncommitted.discard(id(session))
+
+    def _after_rollback(self, session):
+        with self._lock:
+            if id(session) in self._uncommitted:
+                logger.info("新建或移动目录的事务已回滚，重新加载目录字典")
+                self.reset()
+
+    def reset(self):
+        """清空缓存（数据库被重建或事务回滚时使用）"""
+        with self._lock:
+            self._uncommitted.clear()
+            self._parents.clear()
+            self._ids.clear()
+            self._paths.clear()
+            self._synced_at = None
+            self._last_check = 0
+
+    def refresh(self, force=False):
+        """加载上次加载之后新建或改动的目录（首次调用时加载全部目录）"""
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._synced_at is not None and now - self._last_check < self.refresh_interval:
+                return
+            self._last_check = now
+            synced_at = datetime.utcnow()
+            query = db.session.query(VideoDir.id, VideoDir.parent_id, VideoDir.name)
+            if self._synced_at is not None:
+                query = query.filter(VideoDir.updatetime >= self._synced_at - REFRESH_MARGIN)
+            changed = False
+            for dir_id, parent_id, name in query.yield_per(5000):
+                changed = self._put(dir_id, parent_id, name) or changed
+            if changed:
+                self._paths.clear()
+            self._synced_at = synced_at
+
+    def _put(self, dir_id, parent_id, name):
+        """记录一个目录，返回已有目录的位置是否有变化"""
+        old = self._parents.get(dir_id)
+        if old == (parent_id, name):
+            return False
+        if old is not None and self._ids.get(old) == dir_id:
+            del self._ids[old]
+        self._parents[dir_id] = (parent_id, name)
+        self._ids[(parent_id, name)] = dir_id
+        return old is not None
+
+    def dir_path(self, dir_id):
+        """目录id对应的相对路径，未知的目录返回None"""
+        with self._lock:
+            self.refresh()
+            path = self._paths.get(dir_id)
+            if path is not None:
+                return path
+            if dir_id not in self._parents:
+                self.refresh(force=True)
+            names = []
+            current = dir_id
+            while current:
+                entry = self._parents.get(current)
+                if entry is None or len(names) > 1000:
+                    return None
+                names.append(entry[1])
+                current = entry[0]
+            path = '\\'.join(reversed(names))
+            self._paths[dir_id] = path
+            return path
+
+    def full_path(self, dir_id, file_name):
+        """由目录id和文件名拼接出与原video_path一致的相对路径（dir_id为0时就是文件名）"""
+        if dir_id is None or file_name is None:
+            return None
+        if dir_id == 0:
+            return file_name
+        dir_path = self.dir_path(dir_id)
+        if dir_path is None:
+            return None
+        return dir_path + '\\' + file_name
+
+    def find_dir(self, rel_dir):
+        """查找目录的id，不存在时返回None（不创建）"""
+        with self._lock:
+            self.refresh()
+            dir_id = self._walk(rel_dir)
+            if dir_id is None:
+                # 可能是其他进程刚创建的目录
+                self.refresh(force=True)
+                dir_id = self._walk(rel_dir)
+            return dir_id
+
+    def _walk(self, rel_dir):
+        dir_id = 0
+        for name in rel_dir.split('\\'):
+            dir_id = self._ids.get((dir_id, name))
+            if dir_id is None:
+                return None
+        return dir_id
+
+    def ensure_dir(self, rel_dir):
+        """查找目录的id，不存在的各级目录逐级创建（不提交，随调用方的事务提交）"""
+        with self._lock:
+            self.refresh()
+            dir_id = 0
+            for name in rel_dir.split('\\'):
+                child_id = self._ids.get((dir_id, name))
+                if child_id is None:
+                    child_id = self._insert(dir_id, name)
+                dir_id = child_id
+            return dir_id
+
+    def _insert(self, parent_id, name):
+        """新建目录，已被其他进程创建时直接使用已有的记录"""
+        values = {'parent_id': parent_id, 'name': name, 'updatetime': datetime.utcnow()}
+        dialect = db.engine.dialect.name
+        if dialect == 'mysql':
+            db.session.execute(mysql.insert(VideoDir.__table__).values(values).prefix_with('IGNORE'))
+        elif dialect == 'sqlite':
+            db.session.execute(sqlite.insert(VideoDir.__table__).values(values).on_conflict_do_nothing())
+        elif not VideoDir.query.filter_by(parent_id=parent_id, name=name).count():
+            db.session.execute(VideoDir.__table__.insert().values(values))
+        dir_id = db.session.query(VideoDir.id).filter(VideoDir.parent_id == parent_id, VideoDir.name == name).scalar()
+        self._uncommitted.add(id(db.session()))
+        self._put(dir_id, parent_id, name)
+        return dir_id
+
+    def locate(self, video_path, create=True):
+        """相对路径对应的 (dir_id, 文件名)，create为False且目录不存在时dir_id为None"""
+        rel_dir, file_name = split_path(video_path)
+        if rel_dir is None:
+            return 0, file_name
+        dir_id = self.ensure_dir(rel_dir) if create else self.find_dir(rel_dir)
+        return dir_id, file_name
+
+    def descendant_ids(self, dir_id):
+        """目录自身及其下所有子目录的id"""
+        with self._lock:
+            self.refresh()
+            children = {}
+            for child_id, (parent_id, _) in self._parents.items():
+                children.setdefault(parent_id, []).append(child_id)
+        result = []
+        stack = [dir_id]
+        while stack:
+            current = stack.pop()
+            result.append(current)
+            stack.extend(children.get(current, ()))
+        return result
+
+    def prefix_dir_ids(self, prefix):
+        """路径以prefix（以反斜杠结尾）开头的记录所在的全部目录id"""
+        dir_id = self.find_dir(prefix[:-1] if prefix.endswith('\\') else prefix)
+        return self.descendant_ids(dir_id) if dir_id is not None else []
+
+    def path_condition(self, video_paths):
+        """匹配一组相对路径的查询条件，所有目录都不存在时返回None"""
+        by_dir = {}
+        for video_path in video_paths:
+            dir_id, file_name = self.locate(video_path, create=False)
+            if dir_id is not None:
+                by_dir.setdefault(dir_id, []).append(file_name)
+        if not by_dir:
+            return None
+        return db.or_(*[
+            db.and_(VideoInfo.dir_id == dir_id, VideoInfo.file_name.in_(names))
+            for dir_id, names in by_dir.items()
+        ])
+
+    def move_dir(self, dir_id, dest_dir):
+        """把目录移动到dest_dir（完整的相对路径），只改写一行video_dir（不提交）
+
+        Returns:
+            bool: 目标目录已存在时不移动，返回False
+        """
+        with self._lock:
+            parent_dir, name = split_path(dest_dir)
+            parent_id = self.ensure_dir(parent_dir) if '\\' in dest_dir else 0
+            if self._ids.get((parent_id, name)) is not None or parent_id in self.descendant_ids(dir_id):
+                return False
+            VideoDir.query.filter(VideoDir.id == dir_id).update({
+                VideoDir.parent_id: parent_id,
+                VideoDir.name: name,
+                VideoDir.updatetime: datetime.utcnow()
+            }, synchronize_session=False)
+            self._uncommitted.add(id(db.session()))
+            self._put(dir_id, parent_id, name)
+            self._paths.clear()
+            return True
+
+_default_resolver = None
+_default_lock = threading.Lock()
+
+def get_dir_resolver():
+    """进程内共用的目录解析器"""
+    global _default_resolver
+    with _default_lock:
+        if _default_resolver is None:
+            _default_resolver = VideoDirResolver()
+        return _default_resolver
+
+def _make_video_path_nullable(column_type):
+    """旧的video_path列为NOT NULL，改为可空，新记录不再写入该列"""
+    dialect = db.engine.dialect.name
+    with db.engine.begin() as conn:
+        if dialect == 'mysql':
+            conn.execute(text(f'ALTER TABLE video_info MODIFY COLUMN video_path {column_type} NULL'))
+        elif dialect == 'sqlite':
+            # SQLite不能修改列约束；去掉NOT NULL不影响已存储的数据，可以直接改写表定义
+            table_sql = conn.execute(text(
+                "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'video_info'"
+            )).scalar()
+            table_sql = re.sub(r'(\bvideo_path\s+[^,]*?)\s+NOT NULL', r'\1', table_sql, count=1, flags=re.IGNORECASE)
+            schema_version = conn.execute(text('PRAGMA schema_version')).scalar()
+            conn.execute(text('PRAGMA writable_schema = ON'))
+            conn.execute(text(
+                "UPDATE sqlite_master SET sql = :sql WHERE type = 'table' AND name = 'video_info'"
+            ), {'sql': table_sql})
+            conn.execute(text(f'PRAGMA schema_version = {schema_version + 1}'))
+            conn.execute(text('PRAGMA writable_schema = OFF'))
+        else:
+            conn.execute(text('ALTER TABLE video_info ALTER COLUMN video_path DROP NOT NULL'))
+    logger.info("video_info.video_path列已改为可空")
+
+def migrate_video_paths(chunk_size=5000):
+    """把旧版本video_info.video_path中的路径拆分为dir_id和file_name
+
+    需要在upgrade_schema()之后、扫描开始之前调用。全部记录在一个事务中迁移，失败时整体回滚，
+    下次启动重新执行。video_path列改为可空后保留作为备份，确认迁移结果无误后执行
+    python migrate.py drop-video-path 删除。
+
+    Raises:
+        RuntimeError: 存在路径重复的记录（拆分后会违反唯一索引），需要先执行 python migrate.py dedupe
+    """
+    inspector = inspect(db.engine)
+    if not inspector.has_table(VideoInfo.__tablename__):
+        return 0
+    columns = {column['name']: column for column in inspector.get_columns(VideoInfo.__tablename__)}
+    legacy_column = columns.get('video_path')
+    if legacy_column is None:
+        return 0
+    if not legacy_column['nullable']:
+        _make_video_path_nullable(legacy_column['type'].compile(dialect=db.engine.dialect))
+
+    pending = db.session.execute(text(
+        'SELECT COUNT(*) FROM video_info WHERE dir_id IS NULL AND video_path IS NOT NULL'
+    )).scalar()
+    if not pending:
+        return 0
+    # 写入之前检查，避免迁移到一半违反唯一索引
+    duplicates = find_duplicate_keys('video_info', ['video_path'], where='dir_id IS NULL', limit=5)
+    if duplicates:
+        examples = ', '.join(f"{key[0]} ({count}条)" for key, count in duplicates)
+        raise RuntimeError(f"video_info中有路径重复的记录（例如 {examples}），无法迁移到目录字典；"
+                           f"请先执行 python migrate.py dedupe 查看并删除重复记录")
+
+    resolver = get_dir_resolver()
+    migrated = 0
+    last_id = 0
+    logger.info(f"开始把video_info.video_path拆分为目录和文件名，共 {pending} 条记录")
+    try:
+        while True:
+            rows = db.session.execute(text(
+                'SELECT id, video_path FROM video_info '
+                'WHERE dir_id IS NULL AND video_path IS NOT NULL AND id > :last_id ORDER BY id LIMIT :limit'
+            ), {'last_id': last_id, 'limit': chunk_size}).fetchall()
+            if not rows:
+                break
+            updates = []
+            for video_id, video_path in rows:
+                dir_id, file_name = resolver.locate(video_path)
+                updates.append({'id': video_id, 'dir_id': dir_id, 'file_name': file_name})
+            db.session.execute(text('UPDATE video_info SET dir_id = :dir_id, file_name = :file_name WHERE id = :id'), updates)
+            last_id = rows[-1][0]
+            migrated += len(rows)
+            logger.info(f"已拆分 {migrated}/{pending} 条记录的路径")
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    logger.info(f"路径迁移完成: {migrated} 条记录，{len(resolver._parents)} 个目录；video_path列已保留，"
+                f"确认无误后执行 python migrate.py drop-video-path 删除")
+    return migrated
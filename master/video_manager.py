@@ -1,11 +1,22 @@
 import os,sys
+import time
+import json
 import logging
-from datetime import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
+from contextlib import ExitStack
+from datetime import datetime, timedelta
 import ffmpeg
 import hashlib
-from models import db, VideoInfo
+from models import db, VideoInfo, ScanRun, ProbeJob
+from scan_manifest import DirectoryManifest
+from dir_walker import DirectoryWalker
+from video_upsert import VideoUpsertBuffer, build_video_row
+from scan_stats import ScanStats
+from video_dir import get_dir_resolver, split_path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from video import Video
+from video import LazyVideo
+from probe_cache import get_default_cache
 os.makedirs('logs', exist_ok=True)
 # 配置日志
 logging.basicConfig(
@@ -18,10 +29,46 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 文件指纹读取开头和结尾的字节数
+FINGERPRINT_CHUNK = 4 * 1024 * 1024
+
 class VideoManager:
-    def __init__(self, scan_paths):
+    def __init__(self, scan_paths, probe_workers=None, full_rescan_hours=24, walk_workers=4, probe_backend='native',
+                 upsert_batch_rows=1000, upsert_batch_bytes=4 * 1024 * 1024, fingerprint_backfill=500,
+                 stable_seconds=120, max_pending_files=10000, distributed_probe=False, probe_job_fallback=3600,
+                 stats_history=50, stats_top=10):
         self.scan_paths = scan_paths
-        self.batch_size = 20  # 每100个文件提交一次
+        # 探测结果累积到行数或字节数上限时批量upsert并提交
+        self.upsert_batch_rows = upsert_batch_rows
+        self.upsert_batch_bytes = upsert_batch_bytes
+        # 每次扫描最多为多少条旧记录补算文件指纹
+        self.fingerprint_backfill = fingerprint_backfill
+        # 扫描进度写入scan_run表的最小间隔（秒）
+        self.progress_interval = 5
+        self._last_progress = 0
+        # 扫描耗时统计随进度写入scan_run.stats，只保留最近stats_history次扫描的统计
+        self.stats_history = stats_history
+        self.stats_top = stats_top
+        self._stats = None
+        self._scan_start = 0
+        # 每个扫描路径的ffprobe并发数 {scan_path: workers}
+        self.default_probe_workers = 4
+        self.probe_workers = probe_workers or {}
+        # 距上次强制全量扫描超过多少小时时忽略目录清单做一次全量扫描（与全量扫描的频率无关）
+        self.full_rescan_hours = max(1, full_rescan_hours)
+        # 目录遍历线程数
+        self.walk_workers = walk_workers
+        # 元数据解析方式，native只读取容器头，解析不了时回退到ffprobe
+        self.probe_backend = probe_backend
+        # 定时扫描和文件监听触发的局部扫描共用，同一时间只执行一个扫描
+        self.scan_lock = threading.Lock()
+        # 文件修改后至少稳定多少秒才探测入库，还在复制中的文件暂缓并记入待复查集合
+        self.stable_seconds = stable_seconds
+        self.max_pending_files = max_pending_files
+        self.pending_files = {}  # {video_file: (st_size, st_mtime, 首次观察到该大小和修改时间的monotonic时间)}
+        # 新文件和已修改文件写入probe_job表交给worker探测，超过probe_job_fallback秒未完成的改为本地探测
+        self.distributed_probe = distributed_probe
+        self.probe_job_fallback = probe_job_fallback
         if not os.path.exists('logs'):
             os.makedirs('logs')
 
@@ -52,133 +99,752 @@ class VideoManager:
                 
         return absolute_path
 
-    def check_file_changes(self, video_file, existing_video):
+    def get_relative_dir(self, absolute_dir):
+        """获取目录的相对路径，与get_relative_path得到的视频路径去掉文件名后一致"""
+        rel_dir = self.get_relative_path(absolute_dir).rstrip('\\')
+        return '' if rel_dir in ('\\.', '.') else rel_dir
+
+    def build_dir_index(self, path_index):
+        """按所在目录对路径索引分组 {rel_dir: [video_id, ...]}"""
+        dir_index = {}
+        for video_path, entry in path_index.items():
+            rel_dir = video_path.rsplit('\\', 1)[0] if '\\' in video_path else ''
+            dir_index.setdefault(rel_dir, []).append(entry[0])
+        return dir_index
+
+    def check_file_changes(self, video_file, file_size, indexed_size):
         """检查文件是否被修改
         仅使用文件大小来判断，因为远程挂载文件的修改时间可能不稳定
         """
+        # 只使用文件大小来判断是否被修改
+        if indexed_size is None or abs(file_size - indexed_size) > 0.1:  # 允许0.1MB的误差
+            logger.info(f"文件大小已改变: {video_file}")
+            return True
+        return False
+
+    def load_path_index(self, targets=None):
+        """用一次只查列的查询加载路径索引
+
+        Args:
+            targets: 局部扫描的文件和目录（绝对路径），为None时加载全部记录
+
+        Returns:
+            dict: {video_path: (id, video_size, file_mtime)}
+        """
+        path_index = {}
+        resolver = get_dir_resolver()
+        query = db.session.query(
+            VideoInfo.dir_id,
+            VideoInfo.file_name,
+            VideoInfo.id,
+            VideoInfo.video_size,
+            VideoInfo.file_mtime
+        )
+        if targets is not None:
+            conditions = []
+            dir_ids = []
+            file_paths = []
+            for target in targets:
+                if os.path.isdir(target):
+                    dir_ids.extend(resolver.prefix_dir_ids(self.get_relative_dir(target) + '\\'))
+                else:
+                    file_paths.append(self.get_relative_path(target))
+            if dir_ids:
+                conditions.append(VideoInfo.dir_id.in_(dir_ids))
+            file_condition = resolver.path_condition(file_paths)
+            if file_condition is not None:
+                conditions.append(file_condition)
+            if not conditions:
+                return path_index
+            query = query.filter(db.or_(*conditions))
+        rows = query.yield_per(5000)
+        for dir_id, file_name, video_id, video_size, file_mtime in rows:
+            path_index[resolver.full_path(dir_id, file_name)] = (video_id, video_size, file_mtime)
+        return path_index
+
+    def next_scan_generation(self):
+        """获取本次扫描的代数（已记录的最大代数+1）"""
+        current = db.session.query(db.func.max(VideoInfo.last_seen_scan)).scalar()
+        return (current or 0) + 1
+
+    def get_root_prefix(self, scan_path):
+        """获取扫描路径下所有记录共有的相对路径前缀"""
+        scan_path = scan_path.replace('/', '\\')
+        if scan_path.startswith('\\\\'):
+            return self.get_relative_path(scan_path).rstrip('\\') + '\\'
+        # 本地路径的相对路径统一以反斜杠开头，各扫描路径之间无法区分
+        return '\\'
+
+    def full_rescan_due(self):
+        """距上次成功的强制全量扫描是否已超过full_rescan_hours小时"""
+        last_forced = db.session.query(db.func.max(ScanRun.start_time)).filter(
+            ScanRun.forced.is_(True),
+            ScanRun.status == 1
+        ).scalar()
+        return last_forced is None or datetime.utcnow() - last_forced >= timedelta(hours=self.full_rescan_hours)
+
+    def _start_scan_run(self, generation, scope='full', forced=False):
+        """创建本次扫描的进度记录，返回记录id"""
+        now = datetime.utcnow()
+        run = ScanRun(pid=os.getpid(), status=0, phase='walk', generation=generation, scope=scope,
+                      forced=forced, start_time=now, last_update=now)
+        db.session.add(run)
+        db.session.commit()
+        self._last_progress = time.monotonic()
+        return run.id
+
+    def _report_progress(self, run_id, phase, processed_count, probed_count, force=False):
+        """按progress_interval节流更新扫描进度（会提交当前事务）"""
+        now = time.monotonic()
+        if not force and now - self._last_progress < self.progress_interval:
+            return
+        self._last_progress = now
+        with self._stats.timed('db'):
+            ScanRun.query.filter(ScanRun.id == run_id).update({
+                ScanRun.phase: phase,
+                ScanRun.processed_count: processed_count,
+                ScanRun.probed_count: probed_count,
+                ScanRun.stats: self._stats_json(processed_count),
+                ScanRun.last_update: datetime.utcnow()
+            }, synchronize_session=False)
+            db.session.commit()
+
+    def _stats_json(self, processed_count):
+        return json.dumps(self._stats.to_dict(processed_count, time.monotonic() - self._scan_start), ensure_ascii=False)
+
+    def _finish_scan_run(self, run_id, status, message, processed_count=None, probed_count=None):
+        values = {
+            ScanRun.status: status,
+            ScanRun.phase: 'done',
+            ScanRun.message: message[:1023],
+            ScanRun.end_time: datetime.utcnow(),
+            ScanRun.last_update: datetime.utcnow()
+        }
+        if processed_count is not None:
+            values[ScanRun.processed_count] = processed_count
+            values[ScanRun.probed_count] = probed_count
+            values[ScanRun.stats] = self._stats_json(processed_count)
+        ScanRun.query.filter(ScanRun.id == run_id).update(values, synchronize_session=False)
+        # 只保留最近stats_history次扫描的统计，扫描记录本身保留
+        cutoff = db.session.query(ScanRun.id).order_by(ScanRun.id.desc()).offset(self.stats_history).limit(1).scalar()
+        if cutoff is not None:
+            ScanRun.query.filter(ScanRun.id <= cutoff, ScanRun.stats.isnot(None)).update(
+                {ScanRun.stats: None}, synchronize_session=False)
+        db.session.commit()
+
+    def _stamp_seen(self, video_ids, generation, chunk_size=1000):
+        """批量为本次扫描到的记录写入扫描代数，并标记为存在"""
+        video_ids = list(video_ids)
+        for i in range(0, len(video_ids), chunk_size):
+            chunk = video_ids[i:i + chunk_size]
+            VideoInfo.query.filter(VideoInfo.id.in_(chunk)).update(
+                {VideoInfo.last_seen_scan: generation, VideoInfo.exist: True},
+                synchronize_session=False
+            )
+
+    def mark_missing(self, root_prefix, generation, chunk_size=1000):
+        """按目录分批用UPDATE将本次扫描未见到的记录标记为不存在，返回受影响行数"""
+        dir_ids = get_dir_resolver().prefix_dir_ids(root_prefix)
+        missing_count = 0
+        for i in range(0, len(dir_ids), chunk_size):
+            missing_count += VideoInfo.query.filter(
+                VideoInfo.dir_id.in_(dir_ids[i:i + chunk_size]),
+                db.or_(VideoInfo.last_seen_scan < generation, VideoInfo.last_seen_scan.is_(None)),
+                VideoInfo.exist == True
+            ).update({VideoInfo.exist: False}, synchronize_session=False)
+        return missing_count
+
+    @staticmethod
+    def compute_fingerprint(video_file, file_bytes=None, chunk_size=FINGERPRINT_CHUNK):
+        """计算文件指纹：文件字节数 + 开头和结尾各chunk_size字节的sha1
+
+        只做两次大块顺序读取，用于识别被移动或改名的文件
+        """
+        with open(video_file, 'rb') as f:
+            if file_bytes is None:
+                file_bytes = os.fstat(f.fileno()).st_size
+            sha1 = hashlib.sha1(str(file_bytes).encode('ascii'))
+            sha1.update(f.read(chunk_size))
+            if file_bytes > chunk_size:
+                f.seek(max(chunk_size, file_bytes - chunk_size))
+                sha1.update(f.read(chunk_size))
+        return sha1.hexdigest()
+
+    def _try_fingerprint(self, video_file, file_bytes):
+        start = time.monotonic()
         try:
-            file_stat = os.stat(video_file)
-            file_size = file_stat.st_size / (1024 * 1024)  # 转换为MB
-            
-            # 只使用文件大小来判断是否被修改
-            if abs(file_size - existing_video.video_size) > 0.1:  # 允许0.1MB的误差
-                logger.info(f"文件大小已改变: {video_file}")
+            return self.compute_fingerprint(video_file, file_bytes)
+        except OSError as e:
+            logger.warning(f"计算文件指纹失败 {video_file}: {str(e)}")
+            return None
+        finally:
+            if self._stats is not None:
+                self._stats.add_time('fingerprint', time.monotonic() - start)
+
+    def _probe_file(self, video_obj, file_bytes, fingerprint=None):
+        """在探测线程中解析LazyVideo的流信息并计算文件指纹，返回 (Video对象, 耗时秒数, 指纹)"""
+        probe_start = time.monotonic()
+        video_obj.load()
+        elapsed = time.monotonic() - probe_start
+        if fingerprint is None:
+            fingerprint = self._try_fingerprint(video_obj.video_path, file_bytes)
+        return video_obj, elapsed, fingerprint
+
+    def load_unfingerprinted_ids(self):
+        """还没有文件指纹的记录id"""
+        rows = db.session.query(VideoInfo.id).filter(VideoInfo.fingerprint.is_(None)).yield_per(5000)
+        return {video_id for video_id, in rows}
+
+    def find_moved_candidates(self, generation, root_prefixes):
+        """查找本次扫描未见到（即将标记为缺失）且有指纹的记录，作为被移动文件的原记录
+
+        Returns:
+            dict: {fingerprint: [(video_id, video_path), ...]}
+        """
+        candidates = {}
+        if not root_prefixes:
+            return candidates
+        # 遍历出错的扫描路径下的记录可能仍然存在，不作为候选
+        resolver = get_dir_resolver()
+        dir_ids = set()
+        for prefix in root_prefixes:
+            dir_ids.update(resolver.prefix_dir_ids(prefix))
+        rows = db.session.query(VideoInfo.id, VideoInfo.dir_id, VideoInfo.file_name, VideoInfo.fingerprint).filter(
+            VideoInfo.exist == True,
+            VideoInfo.fingerprint.isnot(None),
+            db.or_(VideoInfo.last_seen_scan < generation, VideoInfo.last_seen_scan.is_(None))
+        ).yield_per(5000)
+        for video_id, dir_id, file_name, fingerprint in rows:
+            if dir_id in dir_ids:
+                candidates.setdefault(fingerprint, []).append((video_id, resolver.full_path(dir_id, file_name)))
+        return candidates
+
+    def relink_video(self, video_id, job):
+        """将原记录指向文件的新路径，保留探测结果和转码状态"""
+        dir_id, file_name = get_dir_resolver().locate(job['relative_path'])
+        VideoInfo.query.filter(VideoInfo.id == video_id).update({
+            VideoInfo.dir_id: dir_id,
+            VideoInfo.file_name: file_name,
+            VideoInfo.file_mtime: job['file_mtime'],
+            VideoInfo.exist: True,
+            VideoInfo.last_seen_scan: job['generation'],
+            VideoInfo.updatetime: datetime.utcnow()
+        }, synchronize_session=False)
+
+    def relink_path(self, src_path, dest_path, is_directory=False):
+        """文件或目录在扫描路径内被移动（监听到移动事件）时直接改写记录的路径，返回受影响行数
+
+        目标路径已有记录时不改写，交给局部扫描处理；目录的移动只改写video_dir中的一行
+        """
+        resolver = get_dir_resolver()
+        if not is_directory:
+            src_condition = resolver.path_condition([self.get_relative_path(src_path)])
+            if src_condition is None or not VideoInfo.query.filter(src_condition).count():
+                return 0
+            dest_dir_id, dest_name = resolver.locate(self.get_relative_path(dest_path))
+            if VideoInfo.query.filter(VideoInfo.dir_id == dest_dir_id, VideoInfo.file_name == dest_name).count():
+                return 0
+            return VideoInfo.query.filter(src_condition).update({
+                VideoInfo.dir_id: dest_dir_id,
+                VideoInfo.file_name: dest_name,
+                VideoInfo.exist: True,
+                VideoInfo.updatetime: datetime.utcnow()
+            }, synchronize_session=False)
+
+        src_dir_id = resolver.find_dir(self.get_relative_dir(src_path))
+        if src_dir_id is None:
+            return 0
+        moved_count = VideoInfo.query.filter(VideoInfo.dir_id.in_(resolver.descendant_ids(src_dir_id))).count()
+        if not moved_count or not resolver.move_dir(src_dir_id, self.get_relative_dir(dest_path)):
+            return 0
+        return moved_count
+
+    def get_scan_root(self, path):
+        """文件或目录所属的扫描路径"""
+        normalized = os.path.normcase(os.path.abspath(path))
+        best = None
+        for scan_path in self.scan_paths:
+            root = os.path.normcase(os.path.abspath(scan_path))
+            if normalized == root or normalized.startswith(root.rstrip(os.sep) + os.sep):
+                if best is None or len(scan_path) > len(best):
+                    best = scan_path
+        return best
+
+    def check_stability(self, video_file, st_size, st_mtime):
+        """文件是否已经写入完成：修改时间早于稳定窗口，或多次观察到的大小和修改时间在窗口内都没有变化
+
+        不稳定的文件记入pending_files（只在持有scan_lock时调用）
+        """
+        if self.stable_seconds <= 0 or time.time() - st_mtime >= self.stable_seconds:
+            self.pending_files.pop(video_file, None)
+            return True
+        now = time.monotonic()
+        observed = self.pending_files.get(video_file)
+        if observed is not None and observed[:2] == (st_size, st_mtime):
+            if now - observed[2] >= self.stable_seconds:
+                del self.pending_files[video_file]
                 return True
-                
-            return False
-        except Exception as e:
-            logger.error(f"检查文件变化时出错: {str(e)}")
             return False
+        if observed is not None or len(self.pending_files) < self.max_pending_files:
+            self.pending_files[video_file] = (st_size, st_mtime, now)
+        return False
+
+    def ingest_pending(self):
+        """复查暂缓的文件，已经稳定的做局部扫描，返回扫描的文件数（只stat待复查的文件，不遍历目录）"""
+        if not self.pending_files:
+            return 0
+        with self.scan_lock:
+            ready = []
+            for video_file in list(self.pending_files):
+                try:
+                    st = os.stat(video_file)
+                except OSError:
+                    # 文件已被删除或改名（下载器的临时文件），不再跟踪
+                    del self.pending_files[video_file]
+                    continue
+                observed = self.pending_files[video_file]
+                if (st.st_size, st.st_mtime) != observed[:2]:
+                    self.pending_files[video_file] = (st.st_size, st.st_mtime, time.monotonic())
+                elif (time.time() - st.st_mtime >= self.stable_seconds
+                      or time.monotonic() - observed[2] >= self.stable_seconds):
+                    # 扫描时check_stability会通过并将其移出待复查集合
+                    ready.append(video_file)
+            if not ready:
+                return 0
+            logger.info(f"{len(ready)} 个暂缓的文件已写入完成，开始探测")
+            self._scan_videos(ready)
+        return len(ready)
+
+    def load_probe_jobs(self):
+        """加载未完成的探测任务 {video_path: (id, st_size, status, create_time)}"""
+        rows = db.session.query(ProbeJob.video_path, ProbeJob.id, ProbeJob.st_size, ProbeJob.status,
+                                ProbeJob.create_time).yield_per(5000)
+        return {video_path: (job_id, st_size, status, create_time)
+                for video_path, job_id, st_size, status, create_time in rows}
+
+    def _queue_probe_job(self, job, probe_jobs, new_jobs, expired_job_ids):
+        """把文件交给worker探测，返回False表示需要在本地探测
+
+        已在队列中且未变化的文件不重复入队；worker多次探测失败或长时间没有worker领取的文件改为本地探测
+        """
+        queued = probe_jobs.get(job['relative_path'])
+        if queued is not None:
+            job_id, st_size, status, create_time = queued
+            if st_size == job['st_size']:
+                waited = (datetime.utcnow() - create_time).total_seconds() if create_time else 0
+                if status != 2 and waited < self.probe_job_fallback:
+                    return True
+                expired_job_ids.append(job_id)
+                return False
+            # 文件在排队期间有变化，按新的大小重新入队
+            expired_job_ids.append(job_id)
+        new_jobs.append({
+            'video_path': job['relative_path'],
+            'st_size': job['st_size'],
+            'file_size': job['file_size'],
+            'file_mtime': job['file_mtime'],
+            'generation': job['generation'],
+            'status': 0,
+            'attempts': 0,
+            'create_time': datetime.utcnow()
+        })
+        return True
+
+    def _record_change(self, change_counts, stats, job, relinked=False):
+        """文件确实要探测、首次入队或被识别为移动时，计入所在顶层目录的变化数和new/changed统计"""
+        change_counts[job['change_key']] = change_counts.get(job['change_key'], 0) + 1
+        if not relinked:
+            stats.count('new' if job['video_id'] is None else 'changed')
+
+    def _flush_probe_jobs(self, new_jobs, expired_job_ids, chunk_size=1000):
+        for i in range(0, len(expired_job_ids), chunk_size):
+            ProbeJob.query.filter(ProbeJob.id.in_(expired_job_ids[i:i + chunk_size])).delete(synchronize_session=False)
+        for i in range(0, len(new_jobs), chunk_size):
+            db.session.bulk_insert_mappings(ProbeJob, new_jobs[i:i + chunk_size])
+
+    def get_top_dir(self, path, scan_path):
+        """文件所在的扫描路径下的顶层目录名，直接位于扫描路径下的文件返回空字符串"""
+        parts = os.path.relpath(path, scan_path).split(os.sep)
+        return parts[0] if len(parts) > 1 else ''
+
+    def _iter_targets(self, walker, targets):
+        """遍历局部扫描的目标：文件直接stat，目录交给DirectoryWalker，产出格式与walk一致"""
+        dirs = []
+        for target in targets:
+            try:
+                st = os.stat(target)
+            except OSError as e:
+                logger.warning(f"无法访问 {target}: {str(e)}")
+                continue
+            if os.path.isdir(target):
+                dirs.append(target)
+            else:
+                yield target, target, st.st_size, st.st_mtime
+        if dirs:
+            yield from walker.walk(dirs)
+
+    def _apply_probe_result(self, job, video_obj, upsert_buffer):
+        """将探测结果加入批量写入缓冲（只在调度线程中调用）"""
+        return upsert_buffer.add(build_video_row(job, video_obj))
+
+    def _collect_probe_results(self, pending, return_when, stats, manifest, upsert_buffer, cache=None):
+        """等待探测任务完成并在当前线程处理结果，返回处理成功的文件数"""
+        with stats.timed('wait_probe'):
+            done, _ = wait(pending.keys(), return_when=return_when)
+        applied = 0
+        should_flush = False
+        for future in done:
+            job = pending.pop(future)
+            try:
+                video_obj, elapsed, fingerprint = future.result()
+            except Exception as e:
+                # 探测失败的文件记入负缓存，文件大小不变时不再重试，也不必保持目录为脏；
+                # OSError（ffprobe不可用、共享暂时不可访问等）可能是暂时的，只标记目录下次重试
+                if cache is not None and not isinstance(e, OSError):
+                    cache.record_failure(job['video_file'], job['st_size'], e)
+                else:
+                    manifest.mark_dirty(job['rel_dir'])
+                stats.count('probe_failed')
+                logger.error(f"探测视频时出错 {job['video_file']}: {str(e)}")
+                continue
+            try:
+                stats.record_probe(job['scan_path'], job['video_file'], elapsed)
+                job['fingerprint'] = fingerprint
+                should_flush = self._apply_probe_result(job, video_obj, upsert_buffer) or should_flush
+                applied += 1
+            except Exception as e:
+                manifest.mark_dirty(job['rel_dir'])
+                logger.error(f"处理视频时出错 {job['video_file']}: {str(e)}")
+        if should_flush:
+            with stats.timed('db'):
+                upsert_buffer.flush()
+                db.session.commit()
+        return applied
+
+    def scan_videos(self, targets=None):
+        """扫描视频文件并更新video_info表
+
+        目录由DirectoryWalker并发遍历并流式产出文件，
+        新文件和已修改文件的ffprobe在有界线程池中并发执行，
+        数据库写入始终留在调用线程（调度线程）中完成，进度定期写入scan_run表
+
+        Args:
+            targets: 局部扫描的文件和目录（必须位于扫描路径下），为None时扫描全部扫描路径。
+                局部扫描只新增和更新记录，不识别移动文件，也不标记缺失文件，这些留给全量扫描
+
+        Returns:
+            dict: 各顶层目录新增或修改的文件数 {(scan_path, top_dir): count}，扫描失败时返回None
+        """
+        with self.scan_lock:
+            return self._scan_videos(targets)
 
-    def scan_videos(self):
-        """扫描视频文件并更新video_info表"""
+    def _scan_videos(self, targets):
+        run_id = None
+        partial = targets is not None
         try:
-            logger.info("开始扫描视频...")
+            logger.info(f"开始{'局部' if partial else ''}扫描视频...")
+            scan_start = time.monotonic()
+            stats = self._stats = ScanStats(self.stats_top)
+            self._scan_start = scan_start
             
-            # 获取所有数据库中的视频记录
-            all_videos = VideoInfo.query.all()
-            for video in all_videos:
-                video.exist = False  # 初始化所有记录为不存在
+            # 一次性加载路径索引，代替逐文件查询
+            with stats.timed('db'):
+                path_index = self.load_path_index(targets)
+                generation = self.next_scan_generation()
+            if partial:
+                # 局部扫描沿用当前代数，不影响全量扫描的代数
+                generation = max(1, generation - 1)
+            logger.info(f"已加载路径索引: {len(path_index)} 条记录，本次扫描代数: {generation}")
+            force_full = not partial and self.full_rescan_due()
+            run_id = self._start_scan_run(generation, 'partial' if partial else 'full', force_full)
+            dir_index = self.build_dir_index(path_index)
+            manifest = DirectoryManifest(force_full=force_full).load()
+            # 完整扫描成功的路径前缀 {root_prefix: 是否所有对应扫描路径都完整遍历}
+            root_complete = {}
             
             processed_count = 0  # 处理文件计数
+            probed_count = 0  # 探测文件计数
+            rejected_count = 0  # 文件名无法识别的文件计数
+            known_failure_count = 0  # 之前探测失败且未变化的文件计数
+            # 交给worker探测的文件
+            with stats.timed('db'):
+                probe_jobs = self.load_probe_jobs() if self.distributed_probe else {}
+            new_probe_jobs = []
+            expired_probe_job_ids = []
+            cache = get_default_cache()
+            seen_ids = []
+            pending = {}  # future -> job
+            upsert_buffer = VideoUpsertBuffer(self.upsert_batch_rows, self.upsert_batch_bytes)
+            # 大小与已有记录相同的新文件可能是被移动的文件，遍历结束后再按指纹匹配
+            # （数据库中的大小是单精度浮点数，按0.1MB取整比较）
+            indexed_sizes = set() if partial else {
+                round(entry[1], 1) for entry in path_index.values() if entry[1] is not None
+            }
+            held_files = []  # [(scan_path, job, video_obj)]
+            change_counts = {}  # {(scan_path, top_dir): 新增或修改的文件数}
+            # 旧记录补算指纹，每次扫描最多补算fingerprint_backfill个
+            with stats.timed('db'):
+                unfingerprinted_ids = self.load_unfingerprinted_ids() if self.fingerprint_backfill and not partial else set()
+            backfill_futures = {}  # future -> video_id
             
-            # 扫描所有路径
-            for scan_path in self.scan_paths:
-                logger.info(f"扫描目录: {scan_path}")
-                # 获取所有视频文件
-                video_files = []
-                for root, _, files in os.walk(scan_path):
-                    for file in files:
-                        if file.endswith(('.mp4', '.mkv', '.avi', '.flv')):
-                            if '-trailer' in file.lower():
-                                logger.debug(f"跳过预告片: {file}")
-                                continue
-                            video_files.append(os.path.join(root, file))
+            # 所有扫描路径并发遍历，找到的文件直接进入处理流程
+            walker = DirectoryWalker(manifest, dir_index, self.get_relative_dir, workers=self.walk_workers, stats=stats)
+            # 局部扫描的目标使用所属扫描路径的线程池 {目标: 扫描路径}
+            if partial:
+                scan_roots = {target: self.get_scan_root(target) for target in targets}
+                scan_roots = {target: root for target, root in scan_roots.items() if root is not None}
+                targets = list(scan_roots)
+            else:
+                scan_roots = {scan_path: scan_path for scan_path in self.scan_paths}
+            max_pending = 0
+            with ExitStack() as stack:
+                executors = {}
+                for scan_path in dict.fromkeys(scan_roots.values()):
+                    probe_workers = self.probe_workers.get(scan_path, self.default_probe_workers)
+                    logger.info(f"扫描目录: {scan_path} (ffprobe并发数: {probe_workers})")
+                    executors[scan_path] = stack.enter_context(
+                        ThreadPoolExecutor(max_workers=probe_workers, thread_name_prefix='probe')
+                    )
+                    max_pending += probe_workers * 2
+                for target, scan_path in scan_roots.items():
+                    executors[target] = executors[scan_path]
 
-                for video_file in video_files:
+                entries = self._iter_targets(walker, targets) if partial else walker.walk(self.scan_paths)
+                for scan_path, video_file, st_size, st_mtime in stats.timed_iter(entries, 'wait_walk'):
+                    rel_dir = self.get_relative_dir(os.path.dirname(video_file))
                     try:
-                        # 获取文件状态
-                        file_stat = os.stat(video_file)
-                        file_size = file_stat.st_size / (1024 * 1024)  # 转换为MB
-                        file_mtime = datetime.fromtimestamp(file_stat.st_mtime)
+                        file_size = st_size / (1024 * 1024)  # 转换为MB
+                        file_mtime = datetime.fromtimestamp(st_mtime)
                         
                         # 检查文件是否已存在于数据库
                         relative_path = self.get_relative_path(video_file)
-                        existing_video = VideoInfo.query.filter_by(video_path=relative_path).first()
+                        indexed = path_index.get(relative_path)
+                        video_id = None
+                        # 文件名字段立即解析，流信息留到探测线程中再获取
+                        video_obj = LazyVideo(video_file, probe_backend=self.probe_backend)
                         
-                        if existing_video:
+                        if indexed:
                             # 标记文件为存在
-                            existing_video.exist = True
-                            
-                            # 检查文件是否被修改
-                            if self.check_file_changes(video_file, existing_video):
-                                # 更新视频信息
-                                video_obj = Video(video_file)
-                                existing_video.codec = video_obj.video_codec
-                                existing_video.bitrate_k = int(video_obj.video_bitrate / 1000)
-                                existing_video.video_size = file_size
-                                existing_video.fps = video_obj.video_fps
-                                existing_video.resolutionx = video_obj.video_resolution[0]
-                                existing_video.resolutiony = video_obj.video_resolution[1]
-                                existing_video.resolutionall = video_obj.video_resolution[0] * video_obj.video_resolution[1]
-                                existing_video.updatetime = datetime.utcnow()
-                                existing_video.file_mtime = file_mtime
-                                logger.info(f"更新视频信息: {relative_path}")
-                            
-                            processed_count += 1
+                            video_id = indexed[0]
+                            seen_ids.append(video_id)
+
+                            # 未修改的文件无需重新探测；修改过的文件在探测结果写入后计数
+                            if not self.check_file_changes(video_file, file_size, indexed[1]):
+                                processed_count += 1
+                                if video_id in unfingerprinted_ids and len(backfill_futures) < self.fingerprint_backfill:
+                                    future = executors[scan_path].submit(self._try_fingerprint, video_file, st_size)
+                                    backfill_futures[future] = video_id
+                                continue
+                        elif video_obj.identi is None:
+                            # 文件名识别不出番号的新文件不做ffprobe
+                            rejected_count += 1
+                            logger.debug(f"无法从文件名识别番号，跳过: {video_file}")
                             continue
 
-                        # 处理新文件
-                        video_obj = Video(video_file)
-                        
-                        # 创建视频信息记录
-                        video = VideoInfo(
-                            video_path=relative_path,
-                            identi=video_obj.identi,
-                            codec=video_obj.video_codec,
-                            bitrate_k=int(video_obj.video_bitrate / 1000),
-                            video_size=file_size,
-                            fps=video_obj.video_fps,
-                            resolutionx=video_obj.video_resolution[0],
-                            resolutiony=video_obj.video_resolution[1],
-                            resolutionall=video_obj.video_resolution[0] * video_obj.video_resolution[1],
-                            is_vr=1 if video_obj.is_vr else 0,
-                            updatetime=datetime.utcnow(),
-                            file_mtime=file_mtime,
-                            transcode_status=0,  # 初始状态：未转码
-                            exist=True
-                        )
-
-                        # 判断是否需要转码
-                        if video.should_transcode():
-                            video.transcode_status = 1  # 等待转码
-                            logger.info(f"视频需要转码: {relative_path}")
-                        else:
-                            video.transcode_status = 0  # 不需要转码
-                            logger.info(f"视频不需要转码: {relative_path}")
+                        if cache is not None and cache.is_known_failure(video_file, st_size):
+                            known_failure_count += 1
+                            continue
 
-                        db.session.add(video)
-                        processed_count += 1
-                        
-                        # 每处理batch_size个文件就提交一次
-                        if processed_count % self.batch_size == 0:
-                            logger.info(f"批量提交 {self.batch_size} 个文件的更改")
-                            db.session.commit()
-                        
+                        job = {
+                            'video_file': video_file,
+                            'relative_path': relative_path,
+                            'file_size': file_size,
+                            'file_mtime': file_mtime,
+                            'st_size': st_size,
+                            'video_id': video_id,
+                            'generation': generation,
+                            'rel_dir': rel_dir,
+                            'scan_path': scan_roots[scan_path],
+                            'change_key': (scan_roots[scan_path], self.get_top_dir(video_file, scan_roots[scan_path]))
+                        }
+                        # 暂缓和仍在等待worker的文件不计为变化，否则每次扫描都会重复计数
+                        if not self.check_stability(video_file, st_size, st_mtime):
+                            # 还在复制中的文件暂缓探测，目录保持为脏以便之后的扫描重新列出
+                            stats.count('deferred')
+                            manifest.mark_dirty(rel_dir)
+                            logger.info(f"文件可能还在写入，暂缓探测: {video_file}")
+                            continue
+                        if video_id is None and round(file_size, 1) in indexed_sizes:
+                            held_files.append((scan_path, job, video_obj))
+                            continue
+                        queued_before = len(new_probe_jobs)
+                        if self.distributed_probe and self._queue_probe_job(job, probe_jobs, new_probe_jobs,
+                                                                            expired_probe_job_ids):
+                            # worker回传结果前目录保持为脏，以便超时后改为本地探测
+                            if len(new_probe_jobs) > queued_before:
+                                stats.count('queued')
+                                self._record_change(change_counts, stats, job)
+                            else:
+                                stats.count('queue_waiting')
+                            manifest.mark_dirty(rel_dir)
+                            continue
+                        if relative_path not in probe_jobs:
+                            # 等待worker超时后改为本地探测的文件在入队时已经计数
+                            self._record_change(change_counts, stats, job)
+                        pending[executors[scan_path].submit(self._probe_file, video_obj, st_size)] = job
+
+                        # 限制同时在途的探测任务数量
+                        if len(pending) >= max_pending:
+                            applied = self._collect_probe_results(pending, FIRST_COMPLETED, stats, manifest,
+                                                                  upsert_buffer, cache)
+                            probed_count += applied
+                            processed_count += applied
                     except Exception as e:
+                        manifest.mark_dirty(rel_dir)
                         logger.error(f"处理视频时出错 {video_file}: {str(e)}")
                         continue
-            
-            # 提交剩余的更改
-            db.session.commit()
-            
-            # 统计结果
-            deleted_count = VideoInfo.query.filter_by(exist=False).count()
+                    finally:
+                        unchanged_ids = walker.take_unchanged_ids()
+                        processed_count += len(unchanged_ids)
+                        seen_ids.extend(unchanged_ids)
+
+                        # 批量写入扫描代数
+                        if len(seen_ids) >= 1000:
+                            with stats.timed('db'):
+                                self._stamp_seen(seen_ids, generation)
+                                db.session.commit()
+                            seen_ids = []
+
+                        self._report_progress(run_id, 'walk', processed_count, probed_count)
+
+                # 清单未变化目录下的记录直接确认存在
+                unchanged_ids = walker.take_unchanged_ids()
+                processed_count += len(unchanged_ids)
+                with stats.timed('db'):
+                    self._stamp_seen(seen_ids + unchanged_ids, generation)
+                    db.session.commit()
+
+                for scan_path in ([] if partial else self.scan_paths):
+                    root_prefix = self.get_root_prefix(scan_path)
+                    walk_errors = walker.errors.get(scan_path)
+                    if walk_errors:
+                        logger.warning(f"遍历 {scan_path} 时出现 {len(walk_errors)} 个错误，本次不标记该路径下的缺失文件: {walk_errors[0]}")
+                    else:
+                        manifest.prune(root_prefix)
+                    root_complete[root_prefix] = root_complete.get(root_prefix, True) and not walk_errors
+
+                # 暂缓的新文件：指纹与本次未见到的记录一致时视为移动，直接改写原记录的路径
+                if held_files:
+                    self._report_progress(run_id, 'relink', processed_count, probed_count, force=True)
+                    complete_prefixes = [prefix for prefix, complete in root_complete.items() if complete]
+                    with stats.timed('db'):
+                        candidates = self.find_moved_candidates(generation, complete_prefixes)
+                    fingerprint_futures = []
+                    for scan_path, job, video_obj in held_files:
+                        future = None
+                        if candidates:
+                            future = executors[scan_path].submit(self._try_fingerprint, job['video_file'], job['st_size'])
+                        fingerprint_futures.append((scan_path, future, job, video_obj))
+                    for scan_path, future, job, video_obj in fingerprint_futures:
+                        fingerprint = future.result() if future is not None else None
+                        matches = candidates.get(fingerprint) if fingerprint else None
+                        if matches:
+                            video_id, old_path = matches.pop(0)
+                            self.relink_video(video_id, job)
+                            stats.count('relinked')
+                            self._record_change(change_counts, stats, job, relinked=True)
+                            processed_count += 1
+                            logger.info(f"文件已移动: {old_path} -> {job['relative_path']}")
+                            continue
+                        if job['relative_path'] in probe_jobs:
+                            # 计算过指纹的文件直接在本地探测，不再等待worker
+                            expired_probe_job_ids.append(probe_jobs[job['relative_path']][0])
+                        else:
+                            self._record_change(change_counts, stats, job)
+                        pending[executors[scan_path].submit(self._probe_file, video_obj, job['st_size'], fingerprint)] = job
+                        if len(pending) >= max_pending:
+                            applied = self._collect_probe_results(pending, FIRST_COMPLETED, stats, manifest,
+                                                                  upsert_buffer, cache)
+                            probed_count += applied
+                            processed_count += applied
+                    db.session.commit()
+
+                # 处理剩余的探测结果
+                self._report_progress(run_id, 'probe', processed_count, probed_count, force=True)
+                while pending:
+                    applied = self._collect_probe_results(pending, FIRST_COMPLETED, stats, manifest,
+                                                          upsert_buffer, cache)
+                    probed_count += applied
+                    processed_count += applied
+                    self._report_progress(run_id, 'probe', processed_count, probed_count)
+
+                # 写入补算的指纹
+                if backfill_futures:
+                    fingerprints = [
+                        {'id': video_id, 'fingerprint': future.result()}
+                        for future, video_id in backfill_futures.items()
+                    ]
+                    db.session.bulk_update_mappings(VideoInfo, [row for row in fingerprints if row['fingerprint']])
+
+            # 写入剩余的探测结果
+            with stats.timed('db'):
+                upsert_buffer.flush()
+                if new_probe_jobs or expired_probe_job_ids:
+                    self._flush_probe_jobs(new_probe_jobs, expired_probe_job_ids)
+            self._report_progress(run_id, 'finalize', processed_count, probed_count, force=True)
+
+            with stats.timed('db'):
+                # 所有文件处理完毕后再写入目录清单，处理失败的目录保留旧清单以便下次重试
+                manifest.flush()
+
+                # 提交剩余的更改
+                db.session.commit()
+
+                # 每个完整遍历的扫描路径用一条UPDATE标记缺失文件
+                for root_prefix, complete in root_complete.items():
+                    if not complete:
+                        continue
+                    missing_count = self.mark_missing(root_prefix, generation)
+                    if missing_count:
+                        stats.count('missing', missing_count)
+                        logger.info(f"{root_prefix} 下新增 {missing_count} 个缺失文件")
+                db.session.commit()
+
+                # 统计结果
+                deleted_count = VideoInfo.query.filter_by(exist=False).count()
             if deleted_count > 0:
                 logger.warning(f"发现 {deleted_count} 个文件已删除")
             
-            logger.info("视频扫描完成")
+            elapsed = time.monotonic() - scan_start
+            files_per_sec = processed_count / elapsed if elapsed > 0 else 0
+            summary = (f"处理 {processed_count} 个文件，探测 {probed_count} 个文件，"
+                       f"跳过 {manifest.skipped_dirs} 个未变化目录，"
+                       f"耗时 {elapsed:.1f}秒 ({files_per_sec:.1f} 文件/秒)")
+            logger.info(f"视频扫描完成: {summary}，"
+                        f"批量写入 {upsert_buffer.flushed_rows} 条记录 ({upsert_buffer.flush_count} 次)")
+            self._finish_scan_run(run_id, 1, summary, processed_count, probed_count)
+            counts = stats.counts
+            logger.info(f"新增 {counts['new']} 个文件，修改 {counts['changed']} 个文件，缺失 {counts['missing']} 个文件")
+            if counts['relinked'] or backfill_futures:
+                logger.info(f"识别出 {counts['relinked']} 个被移动的文件，补算 {len(backfill_futures)} 个文件指纹")
+            if counts['queued'] or counts['queue_waiting']:
+                logger.info(f"本次新入队 {counts['queued']} 个文件交给worker探测，"
+                            f"{counts['queue_waiting']} 个文件仍在等待worker的探测结果")
+            if counts['deferred']:
+                logger.info(f"{counts['deferred']} 个文件最近 {self.stable_seconds}秒内有修改，暂缓探测，"
+                            f"共 {len(self.pending_files)} 个文件等待复查")
+            if rejected_count or known_failure_count:
+                logger.info(f"跳过 {rejected_count} 个无法识别番号的文件，{known_failure_count} 个曾探测失败且未变化的文件")
+            percentiles = stats.probe_percentiles()
+            if percentiles:
+                logger.info("ffprobe耗时: p50=%.2fs p90=%.2fs p99=%.2fs max=%.2fs" % (
+                    percentiles['p50'], percentiles['p90'], percentiles['p99'], percentiles['max']
+                ))
+            logger.info("各阶段耗时: " + "，".join(f"{phase} {seconds:.1f}秒" for phase, seconds in stats.phases.items()))
+            if cache is not None:
+                cache_stats = cache.stats()
+                logger.info(f"ffprobe缓存: 命中 {cache_stats['hits']} 次，未命中 {cache_stats['misses']} 次，"
+                            f"共 {cache_stats['entries']} 条 ({cache_stats['bytes'] / 1024 / 1024:.1f}MB)，"
+                            f"失败记录 {cache_stats['failures']} 条")
+            return change_counts
                     
         except Exception as e:
             logger.error(f"扫描视频时出错: {str(e)}")
-            db.session.rollback()
\ No newline at end of file
+            db.session.rollback()
+            if run_id is not None:
+                try:
+                    self._finish_scan_run(run_id, 2, f"扫描视频时出错: {str(e)}")
+                except Exception as run_error:
+                    logger.error(f"更新扫描进度记录失败: {str(run_error)}")
+                    db.session.rollback()
+            return None
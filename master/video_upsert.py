@@ -0,0 +1,170 @@
+import os
+import sys
+import logging
+from datetime import datetime
+from sqlalchemy.dialects import mysql, sqlite
+from models import db, VideoInfo, has_index
+from video_dir import get_dir_resolver
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from probe_cache import compress_probe
+
+logger = logging.getLogger(__name__)
+
+# 已存在的记录只更新探测得到的字段，identi、is_vr、transcode_status、task_type等保持不变
+UPDATE_COLUMNS = (
+    'codec', 'bitrate_k', 'video_size', 'fps',
+    'resolutionx', 'resolutiony', 'resolutionall',
+    'updatetime', 'file_mtime', 'exist', 'last_seen_scan', 'probe_data', 'fingerprint'
+)
+
+# SQLite单条语句的参数上限（3.32之后为32766）
+SQLITE_MAX_VARIABLES = 32000
+
+# upsert依赖的唯一索引
+UNIQUE_INDEX = 'uq_video_info_dir_file'
+
+def build_video_row(job, video_obj):
+    """根据探测结果生成video_info的一行
+
+    Args:
+        job: 文件信息 relative_path, file_size, file_mtime, generation, video_id, fingerprint(可选)
+        video_obj: 已获取流信息的Video对象
+    """
+    relative_path = job['relative_path']
+    # 新目录会先写入video_dir并提交
+    dir_id, file_name = get_dir_resolver().locate(relative_path)
+    row = {
+        'dir_id': dir_id,
+        'file_name': file_name,
+        'identi': video_obj.identi,
+        'codec': video_obj.video_codec,
+        'bitrate_k': int(video_obj.video_bitrate / 1000),
+        'video_size': job['file_size'],
+        'fps': video_obj.video_fps,
+        'resolutionx': video_obj.video_resolution[0],
+        'resolutiony': video_obj.video_resolution[1],
+        'resolutionall': video_obj.video_resolution[0] * video_obj.video_resolution[1],
+        'is_vr': 1 if video_obj.is_vr else 0,
+        'updatetime': datetime.utcnow(),
+        'file_mtime': job['file_mtime'],
+        'transcode_status': 0,  # 初始状态：未转码
+        'task_type': None,
+        'exist': True,
+        'last_seen_scan': job['generation'],
+        'probe_data': compress_probe(video_obj.video_info),
+        'fingerprint': job.get('fingerprint')
+    }
+
+    if job['video_id'] is not None:
+        # 已有记录只更新探测字段，转码状态由upsert保持不变
+        logger.info(f"更新视频信息: {relative_path}")
+    elif VideoInfo(**row).should_remux():
+        # 判断是否需要转码（临时对象，不加入会话）
+        row['transcode_status'] = 1  # 等待转码
+        row['task_type'] = 'remux'
+        logger.info(f"视频只需转封装: {relative_path}")
+    elif VideoInfo(**row).should_transcode():
+        row['transcode_status'] = 1  # 等待转码
+        row['task_type'] = 'transcode'
+        logger.info(f"视频需要转码: {relative_path}")
+    else:
+        logger.info(f"视频不需要转码: {relative_path}")
+    return row
+
+class VideoUpsertBuffer:
+    """累积扫描结果，按行数或字节数达到上限时用一条多行upsert写入video_info
+
+    MySQL使用 INSERT ... ON DUPLICATE KEY UPDATE，SQLite使用 ON CONFLICT DO UPDATE，
+    依赖 (dir_id, file_name) 上的唯一索引，重复执行不会产生重复记录；
+    数据库中没有该索引时改为逐行先更新、没有更新到再插入
+    """
+
+    _unique_index_checked = {}  # {数据库url: 是否有唯一索引}，每个进程只检查一次
+
+    def __init__(self, max_rows=1000, max_bytes=4 * 1024 * 1024):
+        self.max_rows = max(1, max_rows)
+        self.max_bytes = max(1, max_bytes)
+        self.rows = []
+        self.pending_bytes = 0
+        self.flushed_rows = 0
+        self.flush_count = 0
+
+    def add(self, row):
+        """加入一行，返回是否已达到写入阈值"""
+        self.rows.append(row)
+        self.pending_bytes += self.estimate_size(row)
+        return len(self.rows) >= self.max_rows or self.pending_bytes >= self.max_bytes
+
+    @staticmethod
+    def estimate_size(row):
+        """估算一行在SQL语句中占用的字节数"""
+        size = 64
+        for value in row.values():
+            if isinstance(value, (str, bytes)):
+                size += len(value) * 2
+            else:
+                size += 16
+        return size
+
+    def flush(self):
+        """写入累积的行（不提交事务），返回写入行数"""
+        if not self.rows:
+            return 0
+        rows = self.rows
+        self.rows = []
+        self.pending_bytes = 0
+
+        dialect = db.engine.dialect.name
+        if not self._has_unique_index():
+            self._upsert_generic(rows)
+        elif dialect == 'mysql':
+            self._upsert_mysql(rows)
+        elif dialect == 'sqlite':
+            chunk_size = max(1, SQLITE_MAX_VARIABLES // len(rows[0]))
+            for i in range(0, len(rows), chunk_size):
+                self._upsert_sqlite(rows[i:i + chunk_size])
+        else:
+            self._upsert_generic(rows)
+
+        self.flushed_rows += len(rows)
+        self.flush_count += 1
+        logger.info(f"批量写入 {len(rows)} 条视频记录")
+        return len(rows)
+
+    @classmethod
+    def _has_unique_index(cls):
+        url = str(db.engine.url)
+        if url not in cls._unique_index_checked:
+            found = has_index(VideoInfo.__tablename__, UNIQUE_INDEX)
+            if not found:
+                logger.error(f"video_info缺少唯一索引 {UNIQUE_INDEX}，批量upsert会插入重复记录，改为逐行写入")
+            cls._unique_index_checked[url] = found
+        return cls._unique_index_checked[url]
+
+    def _upsert_mysql(self, rows):
+        stmt = mysql.insert(VideoInfo.__table__).values(rows)
+        stmt = stmt.on_duplicate_key_update({column: stmt.inserted[column] for column in UPDATE_COLUMNS})
+        db.session.execute(stmt)
+
+    def _upsert_sqlite(self, rows):
+        stmt = sqlite.insert(VideoInfo.__table__).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[VideoInfo.__table__.c.dir_id, VideoInfo.__table__.c.file_name],
+            set_={column: stmt.excluded[column] for column in UPDATE_COLUMNS}
+        )
+        db.session.execute(stmt)
+
+    def _upsert_generic(self, rows):
+        """其他数据库：先按目录和文件名更新，没有更新到的再插入"""
+        table = VideoInfo.__table__
+        new_rows = []
+        for row in rows:
+            result = db.session.execute(
+                table.update()
+                .where(table.c.dir_id == row['dir_id'], table.c.file_name == row['file_name'])
+                .values({column: row[column] for column in UPDATE_COLUMNS})
+            )
+            if result.rowcount == 0:
+                new_rows.append(row)
+        if new_rows:
+            db.session.execute(table.insert(), new_rows)
@@ -0,0 +1,467 @@
+"""纯Python的MP4/MKV容器头解析
+
+只读取容器头中需要的字节范围（MP4的moov，MKV的Info/Tracks/Tags），
+返回与ffprobe输出结构兼容的dict，供Video直接使用：
+streams[0]为视频流（codec_name/width/height/avg_frame_rate/duration/bit_rate/tags），
+format中包含duration/size/bit_rate/format_name。
+结果中没有音频流等其他流，以 probe_backend='native' 标记，需要完整流信息的调用方用is_partial判断后改用ffprobe。
+无法确定结果时抛出MediaHeaderError，由调用方回退到ffprobe。
+"""
+import os
+import struct
+from fractions import Fraction
+
+MP4_EXTENSIONS = ('.mp4', '.m4v', '.mov')
+MKV_EXTENSIONS = ('.mkv', '.webm')
+
+# moov最大读取字节数，超过时交给ffprobe
+MAX_MOOV_SIZE = 64 * 1024 * 1024
+# MKV元素最大读取字节数
+MAX_ELEMENT_SIZE = 16 * 1024 * 1024
+
+MP4_CODECS = {
+    'avc1': 'h264', 'avc3': 'h264',
+    'hvc1': 'hevc', 'hev1': 'hevc',
+    'av01': 'av1',
+    'vp09': 'vp9', 'vp08': 'vp8',
+    'mp4v': 'mpeg4',
+}
+
+MKV_CODECS = {
+    'V_MPEG4/ISO/AVC': 'h264',
+    'V_MPEGH/ISO/HEVC': 'hevc',
+    'V_AV1': 'av1',
+    'V_VP9': 'vp9',
+    'V_VP8': 'vp8',
+    'V_MPEG4/ISO/ASP': 'mpeg4',
+    'V_MPEG2': 'mpeg2video',
+}
+
+# 结果中标记来源的键，ffprobe的结果没有该键
+BACKEND_KEY = 'probe_backend'
+
+class MediaHeaderError(Exception):
+    """容器头无法解析或信息不完整"""
+    pass
+
+def probe(path):
+    """解析视频文件的容器头，返回ffprobe兼容的结果
+
+    Raises:
+        MediaHeaderError: 不支持的容器或无法确定所需字段
+    """
+    extension = os.path.splitext(path)[1].lower()
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        try:
+            if extension in MP4_EXTENSIONS:
+                return _probe_mp4(f, file_size)
+            if extension in MKV_EXTENSIONS:
+                return _probe_mkv(f, file_size)
+        except (struct.error, IndexError, ValueError) as e:
+            raise MediaHeaderError("容器头损坏: %s" % str(e))
+    raise MediaHeaderError("不支持的容器格式: %s" % extension)
+
+def _build_result(stream, duration, file_size, format_name):
+    """组装ffprobe格式的结果，码率缺失时与ffprobe一样用文件大小估算format码率"""
+    stream['index'] = 0
+    stream['codec_type'] = 'video'
+    format_info = {
+        'format_name': format_name,
+        'size': str(file_size),
+        'nb_streams': 1,
+    }
+    if duration:
+        format_info['duration'] = '%.6f' % duration
+        format_info['bit_rate'] = str(int(file_size * 8 / duration))
+    return {'streams': [stream], 'format': format_info, BACKEND_KEY: 'native'}
+
+def is_partial(probe):
+    """探测结果是否来自容器头解析（只有视频流，没有音频流和nb_streams等完整信息）"""
+    return probe.get(BACKEND_KEY) == 'native'
+
+def _format_frame_rate(rate):
+    return '%d/%d' % (rate.numerator, rate.denominator)
+
+# ---------------------------------------------------------------- MP4
+
+def _read_box_header(f, offset, end):
+    """读取offset处的box头，返回 (box类型, 数据起始位置, box结束位置)"""
+    f.seek(offset)
+    header = f.read(8)
+    if len(header) < 8:
+        return None
+    size, box_type = struct.unpack('>I4s', header)
+    data_start = offset + 8
+    if size == 1:
+        largesize = f.read(8)
+        if len(largesize) < 8:
+            return None
+        size = struct.unpack('>Q', largesize)[0]
+        data_start += 8
+    elif size == 0:
+        size = end - offset
+    if size < data_start - offset:
+        raise MediaHeaderError("box大小无效: %r" % box_type)
+    return box_type.decode('latin-1'), data_start, offset + size
+
+def _iter_boxes(data, start=0, end=None):
+    """遍历内存中的子box，产出 (box类型, 数据起始位置, box结束位置)"""
+    end = len(data) if end is None else end
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, offset)
+        data_start = offset + 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, data_start)[0]
+            data_start += 8
+        elif size == 0:
+            size = end - offset
+        if size < data_start - offset or offset + size > end:
+            raise MediaHeaderError("box大小无效: %r" % box_type)
+        yield box_type.decode('latin-1'), data_start, offset + size
+        offset += size
+
+def _find_box(data, path, start=0, end=None):
+    """按路径查找子box，如 ['mdia', 'minf', 'stbl']，返回 (数据起始位置, box结束位置)"""
+    for box_type, data_start, box_end in _iter_boxes(data, start, end):
+        if box_type == path[0]:
+            if len(path) == 1:
+                return data_start, box_end
+            return _find_box(data, path[1:], data_start, box_end)
+    return None
+
+def _read_full_box_times(data, start):
+    """解析mvhd/mdhd的timescale和duration"""
+    version = data[start]
+    if version == 1:
+        timescale, duration = struct.unpack_from('>IQ', data, start + 20)
+    else:
+        timescale, duration = struct.unpack_from('>II', data, start + 12)
+    return timescale, duration
+
+def _probe_mp4(f, file_size):
+    # 顶层box中只读取moov，mdat等只读头部后跳过
+    offset = 0
+    moov = None
+    while offset < file_size:
+        header = _read_box_header(f, offset, file_size)
+        if header is None:
+            break
+        box_type, data_start, box_end = header
+        if box_type == 'moov':
+            if box_end - data_start > MAX_MOOV_SIZE:
+                raise MediaHeaderError("moov过大")
+            f.seek(data_start)
+            moov = f.read(box_end - data_start)
+            break
+        offset = box_end
+    if moov is None:
+        raise MediaHeaderError("未找到moov")
+    if _find_box(moov, ['mvex']) is not None:
+        raise MediaHeaderError("分片MP4")
+
+    movie_duration = 0
+    mvhd = _find_box(moov, ['mvhd'])
+    if mvhd is not None:
+        timescale, duration = _read_full_box_times(moov, mvhd[0])
+        if timescale:
+            movie_duration = duration / timescale
+
+    for box_type, trak_start, trak_end in _iter_boxes(moov):
+        if box_type != 'trak':
+            continue
+        hdlr = _find_box(moov, ['mdia', 'hdlr'], trak_start, trak_end)
+        if hdlr is None or moov[hdlr[0] + 8:hdlr[0] + 12] != b'vide':
+            continue
+        stream = _parse_mp4_video_track(moov, trak_start, trak_end)
+        duration = movie_duration or float(stream['duration'])
+        return _build_result(stream, duration, file_size, 'mov,mp4,m4a,3gp,3g2,mj2')
+    raise MediaHeaderError("未找到视频轨道")
+
+def _parse_mp4_video_track(moov, trak_start, trak_end):
+    mdhd = _find_box(moov, ['mdia', 'mdhd'], trak_start, trak_end)
+    stbl = _find_box(moov, ['mdia', 'minf', 'stbl'], trak_start, trak_end)
+    if mdhd is None or stbl is None:
+        raise MediaHeaderError("视频轨道缺少mdhd或stbl")
+    timescale, track_duration = _read_full_box_times(moov, mdhd[0])
+    if not timescale:
+        raise MediaHeaderError("timescale无效")
+
+    # stsd第一个样本描述：编码格式和分辨率
+    stsd = _find_box(moov, ['stsd'], *stbl)
+    if stsd is None:
+        raise MediaHeaderError("缺少stsd")
+    entry_start = stsd[0] + 8
+    entry_type = moov[entry_start + 4:entry_start + 8].decode('latin-1')
+    codec_name = MP4_CODECS.get(entry_type)
+    if codec_name is None:
+        raise MediaHeaderError("未知的编码格式: %s" % entry_type)
+    # VisualSampleEntry: 8字节box头 + 6字节保留 + 2字节索引 + 16字节预定义后是宽高
+    width, height = struct.unpack_from('>HH', moov, entry_start + 32)
+
+    # stts：样本数和总时长，用于计算平均帧率
+    stts = _find_box(moov, ['stts'], *stbl)
+    if stts is None:
+        raise MediaHeaderError("缺少stts")
+    entry_count = struct.unpack_from('>I', moov, stts[0] + 4)[0]
+    sample_count = 0
+    total_delta = 0
+    for i in range(entry_count):
+        count, delta = struct.unpack_from('>II', moov, stts[0] + 8 + i * 8)
+        sample_count += count
+        total_delta += count * delta
+    if not sample_count or not total_delta:
+        raise MediaHeaderError("视频轨道没有样本")
+
+    # stsz：样本总字节数，用于计算视频流码率
+    stream_bytes = None
+    stsz = _find_box(moov, ['stsz'], *stbl)
+    if stsz is not None:
+        sample_size, size_count = struct.unpack_from('>II', moov, stsz[0] + 4)
+        if sample_size:
+            stream_bytes = sample_size * size_count
+        else:
+            sizes = struct.unpack_from('>%dI' % size_count, moov, stsz[0] + 12)
+            stream_bytes = sum(sizes)
+
+    duration = (track_duration or total_delta) / timescale
+    stream = {
+        'codec_name': codec_name,
+        'codec_tag_string': entry_type,
+        'width': width,
+        'height': height,
+        'avg_frame_rate': _format_frame_rate(Fraction(sample_count * timescale, total_delta)),
+        'duration': '%.6f' % duration,
+        'nb_frames': str(sample_count),
+    }
+    if stream_bytes is not None and duration:
+        stream['bit_rate'] = str(int(stream_bytes * 8 / duration))
+    return stream
+
+# ---------------------------------------------------------------- Matroska
+
+EBML_HEADER = 0x1A45DFA3
+MKV_SEGMENT = 0x18538067
+MKV_SEEK_HEAD = 0x114D9B74
+MKV_SEEK = 0x4DBB
+MKV_SEEK_ID = 0x53AB
+MKV_SEEK_POSITION = 0x53AC
+MKV_INFO = 0x1549A966
+MKV_TIMESTAMP_SCALE = 0x2AD7B1
+MKV_DURATION = 0x4489
+MKV_TRACKS = 0x1654AE6B
+MKV_TRACK_ENTRY = 0xAE
+MKV_TRACK_UID = 0x73C5
+MKV_TRACK_TYPE = 0x83
+MKV_CODEC_ID = 0x86
+MKV_DEFAULT_DURATION = 0x23E383
+MKV_VIDEO = 0xE0
+MKV_PIXEL_WIDTH = 0xB0
+MKV_PIXEL_HEIGHT = 0xBA
+MKV_TAGS = 0x1254C367
+MKV_TAG = 0x7373
+MKV_TARGETS = 0x63C0
+MKV_TAG_TRACK_UID = 0x63C5
+MKV_SIMPLE_TAG = 0x67C8
+MKV_TAG_NAME = 0x45A3
+MKV_TAG_STRING = 0x4487
+MKV_CLUSTER = 0x1F43B675
+
+def _read_vint(data, offset, keep_marker):
+    """读取EBML变长整数，返回 (值, 长度)，未知长度返回值None"""
+    first = data[offset]
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first & mask:
+        length += 1
+        mask >>= 1
+    if length > 8 or offset + length > len(data):
+        raise MediaHeaderError("EBML变长整数无效")
+    value = first if keep_marker else first & (mask - 1)
+    all_ones = (first & (mask - 1)) == mask - 1
+    for i in range(1, length):
+        byte = data[offset + i]
+        value = (value << 8) | byte
+        all_ones = all_ones and byte == 0xFF
+    if not keep_marker and all_ones:
+        return None, length
+    return value, length
+
+def _read_element_header(f, offset):
+    """从文件读取offset处的元素头，返回 (元素ID, 数据起始位置, 数据大小)"""
+    f.seek(offset)
+    head = f.read(12)
+    if not head:
+        return None
+    element_id, id_length = _read_vint(head, 0, True)
+    size, size_length = _read_vint(head, id_length, False)
+    return element_id, offset + id_length + size_length, size
+
+def _iter_elements(data, start=0, end=None):
+    """遍历内存中的子元素，产出 (元素ID, 数据起始位置, 数据结束位置)"""
+    end = len(data) if end is None else end
+    offset = start
+    while offset < end:
+        element_id, id_length = _read_vint(data, offset, True)
+        size, size_length = _read_vint(data, offset + id_length, False)
+        data_start = offset + id_length + size_length
+        if size is None or data_start + size > end:
+            raise MediaHeaderError("EBML元素大小无效")
+        yield element_id, data_start, data_start + size
+        offset = data_start + size
+
+def _read_uint(data, start, end):
+    return int.from_bytes(data[start:end], 'big') if end > start else 0
+
+def _read_float(data, start, end):
+    if end - start == 4:
+        return struct.unpack('>f', data[start:end])[0]
+    if end - start == 8:
+        return struct.unpack('>d', data[start:end])[0]
+    return 0.0
+
+def _read_string(data, start, end):
+    return data[start:end].split(b'\x00', 1)[0].decode('utf-8', errors='replace')
+
+def _read_element(f, data_start, size):
+    if size is None or size > MAX_ELEMENT_SIZE:
+        raise MediaHeaderError("EBML元素过大")
+    f.seek(data_start)
+    data = f.read(size)
+    if len(data) < size:
+        raise MediaHeaderError("文件被截断")
+    return data
+
+def _probe_mkv(f, file_size):
+    header = _read_element_header(f, 0)
+    if header is None or header[0] != EBML_HEADER:
+        raise MediaHeaderError("不是EBML文件")
+    segment = _read_element_header(f, header[1] + header[2])
+    if segment is None or segment[0] != MKV_SEGMENT:
+        raise MediaHeaderError("未找到Segment")
+    segment_start = segment[1]
+    segment_end = file_size if segment[2] is None else min(file_size, segment_start + segment[2])
+
+    # 顺序读取Segment的一级元素直到遇到Cluster，其余位置通过SeekHead定位
+    wanted = {MKV_INFO: None, MKV_TRACKS: None, MKV_TAGS: None}
+    positions = {}
+    offset = segment_start
+    while offset < segment_end:
+        element = _read_element_header(f, offset)
+        if element is None:
+            break
+        element_id, data_start, size = element
+        if element_id == MKV_CLUSTER or size is None:
+            break
+        if element_id in wanted:
+            wanted[element_id] = _read_element(f, data_start, size)
+        elif element_id == MKV_SEEK_HEAD:
+            positions.update(_parse_seek_head(_read_element(f, data_start, size)))
+        offset = data_start + size
+
+    for element_id in wanted:
+        if wanted[element_id] is None and element_id in positions:
+            element = _read_element_header(f, segment_start + positions[element_id])
+            if element is not None and element[0] == element_id:
+                wanted[element_id] = _read_element(f, element[1], element[2])
+
+    if wanted[MKV_INFO] is None or wanted[MKV_TRACKS] is None:
+        raise MediaHeaderError("缺少Info或Tracks")
+    duration = _parse_mkv_info(wanted[MKV_INFO])
+    stream, track_uid = _parse_mkv_tracks(wanted[MKV_TRACKS])
+    if wanted[MKV_TAGS] is not None:
+        tags = _parse_mkv_tags(wanted[MKV_TAGS], track_uid)
+        if tags:
+            stream['tags'] = tags
+    return _build_result(stream, duration, file_size, 'matroska,webm')
+
+def _parse_seek_head(data):
+    positions = {}
+    for element_id, start, end in _iter_elements(data):
+        if element_id != MKV_SEEK:
+            continue
+        seek_id = None
+        seek_position = None
+        for child_id, child_start, child_end in _iter_elements(data, start, end):
+            if child_id == MKV_SEEK_ID:
+                seek_id = _read_uint(data, child_start, child_end)
+            elif child_id == MKV_SEEK_POSITION:
+                seek_position = _read_uint(data, child_start, child_end)
+        if seek_id is not None and seek_position is not None:
+            positions.setdefault(seek_id, seek_position)
+    return positions
+
+def _parse_mkv_info(data):
+    timestamp_scale = 1000000
+    duration = None
+    for element_id, start, end in _iter_elements(data):
+        if element_id == MKV_TIMESTAMP_SCALE:
+            timestamp_scale = _read_uint(data, start, end)
+        elif element_id == MKV_DURATION:
+            duration = _read_float(data, start, end)
+    if not duration:
+        raise MediaHeaderError("缺少时长")
+    return duration * timestamp_scale / 1e9
+
+def _parse_mkv_tracks(data):
+    """返回第一个视频轨道的stream信息和TrackUID"""
+    for element_id, start, end in _iter_elements(data):
+        if element_id != MKV_TRACK_ENTRY:
+            continue
+        track = {}
+        for child_id, child_start, child_end in _iter_elements(data, start, end):
+            if child_id in (MKV_TRACK_TYPE, MKV_TRACK_UID, MKV_DEFAULT_DURATION):
+                track[child_id] = _read_uint(data, child_start, child_end)
+            elif child_id == MKV_CODEC_ID:
+                track[child_id] = _read_string(data, child_start, child_end)
+            elif child_id == MKV_VIDEO:
+                for video_id, video_start, video_end in _iter_elements(data, child_start, child_end):
+                    if video_id in (MKV_PIXEL_WIDTH, MKV_PIXEL_HEIGHT):
+                        track[video_id] = _read_uint(data, video_start, video_end)
+        if track.get(MKV_TRACK_TYPE) != 1:
+            continue
+        codec_name = MKV_CODECS.get(track.get(MKV_CODEC_ID))
+        if codec_name is None:
+            raise MediaHeaderError("未知的编码格式: %s" % track.get(MKV_CODEC_ID))
+        if not track.get(MKV_DEFAULT_DURATION):
+            raise MediaHeaderError("缺少DefaultDuration，无法确定帧率")
+        if not track.get(MKV_PIXEL_WIDTH) or not track.get(MKV_PIXEL_HEIGHT):
+            raise MediaHeaderError("缺少分辨率")
+        # 与ffprobe一致，帧率按DefaultDuration换算并取常见的分母
+        frame_rate = Fraction(1000000000, track[MKV_DEFAULT_DURATION]).limit_denominator(1001)
+        stream = {
+            'codec_name': codec_name,
+            'width': track[MKV_PIXEL_WIDTH],
+            'height': track[MKV_PIXEL_HEIGHT],
+            'avg_frame_rate': _format_frame_rate(frame_rate),
+        }
+        return stream, track.get(MKV_TRACK_UID)
+    raise MediaHeaderError("未找到视频轨道")
+
+def _parse_mkv_tags(data, track_uid):
+    """读取视频轨道的统计标签（mkvmerge写入的BPS、DURATION等）"""
+    tags = {}
+    for element_id, start, end in _iter_elements(data):
+        if element_id != MKV_TAG:
+            continue
+        target_uid = None
+        simple_tags = {}
+        for child_id, child_start, child_end in _iter_elements(data, start, end):
+            if child_id == MKV_TARGETS:
+                for target_id, target_start, target_end in _iter_elements(data, child_start, child_end):
+                    if target_id == MKV_TAG_TRACK_UID:
+                        target_uid = _read_uint(data, target_start, target_end)
+            elif child_id == MKV_SIMPLE_TAG:
+                name = None
+                value = None
+                for tag_id, tag_start, tag_end in _iter_elements(data, child_start, child_end):
+                    if tag_id == MKV_TAG_NAME:
+                        name = _read_string(data, tag_start, tag_end)
+                    elif tag_id == MKV_TAG_STRING:
+                        value = _read_string(data, tag_start, tag_end)
+                if name is not None and value is not None:
+                    simple_tags[name] = value
+        if track_uid is not None and target_uid == track_uid:
+            tags.update(simple_tags)
+    return tags
@@ -0,0 +1,232 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import logging
+import threading
+
+DEFAULT_CACHE_PATH = os.path.join('cache', 'probe_cache.db')
+
+def compress_probe(probe):
+    """将ffprobe结果压缩为bytes"""
+    return zlib.compress(json.dumps(probe, separators=(',', ':')).encode('utf-8'))
+
+def decompress_probe(data):
+    """还原compress_probe压缩的ffprobe结果"""
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+def normalize_path(path):
+    """统一路径格式作为缓存键（大小写规则跟随操作系统，分隔符统一为/）"""
+    return os.path.normcase(os.path.abspath(path)).replace('\\', '/')
+
+class ProbeCache:
+    """基于本地SQLite的ffprobe结果缓存
+
+    以 (规范化路径, 文件大小, 修改时间) 判断缓存是否有效，
+    结果以zlib压缩的JSON保存，超过条数或字节上限时按最近访问时间淘汰。
+    每条记录带有产生它的解析方式：容器头解析（native）的结果缺少音频流等信息，只提供给native调用方；
+    ffprobe的完整结果两种调用方都可以使用。
+    另外记录探测失败的文件（负缓存），文件大小不变时不再重复探测
+    """
+
+    def __init__(self, db_path=DEFAULT_CACHE_PATH, max_entries=500000, max_bytes=512 * 1024 * 1024,
+                 touch_interval=86400):
+        """
+        Args:
+            touch_interval: 命中时只有上次访问时间早于该秒数才刷新，淘汰只需要粗略的访问顺序
+        """
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval
+        self.hits = 0
+        self.misses = 0
+        self._puts_since_evict = 0
+        self._touched = {}  # {path: 访问时间}，待批量写入的last_access
+        self._lock = threading.Lock()
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS probe_cache (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                data BLOB NOT NULL,
+                nbytes INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                backend TEXT NOT NULL DEFAULT 'ffprobe'
+            )
+        ''')
+        columns = {row[1] for row in self._conn.execute('PRAGMA table_info(probe_cache)')}
+        if 'backend' not in columns:
+            # 旧版本的缓存不区分解析方式，已有记录按native处理，ffprobe调用方会重新探测
+            self._conn.execute("ALTER TABLE probe_cache ADD COLUMN backend TEXT NOT NULL DEFAULT 'native'")
+        self._conn.execute('CREATE INDEX IF NOT EXISTS ix_probe_cache_last_access ON probe_cache (last_access)')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS probe_failure (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                error TEXT,
+                failures INTEGER NOT NULL,
+                last_failure REAL NOT NULL
+            )
+        ''')
+        self._conn.commit()
+
+    def get(self, path, size, mtime, backend='ffprobe'):
+        """查询缓存，文件大小或修改时间（秒级）不一致时视为未命中
+
+        Args:
+            backend: 调用方使用的解析方式，ffprobe调用方不会得到native的不完整结果
+        """
+        key = normalize_path(path)
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT data, backend, last_access FROM probe_cache WHERE path = ? AND size = ? AND mtime = ?',
+                (key, size, int(mtime))
+            ).fetchone()
+            if row is None or (backend != 'native' and row[1] == 'native'):
+                self.misses += 1
+                return None
+            self.hits += 1
+            now = time.time()
+            if now - row[2] >= self.touch_interval:
+                self._touched[key] = now
+                if len(self._touched) >= 1000:
+                    self._flush_touched()
+                    self._conn.commit()
+        return decompress_probe(row[0])
+
+    def put(self, path, size, mtime, probe, backend='ffprobe'):
+        """写入缓存，backend为实际产生结果的解析方式"""
+        data = compress_probe(probe)
+        with self._lock:
+            self._flush_touched()
+            self._conn.execute(
+                'INSERT OR REPLACE INTO probe_cache (path, size, mtime, data, nbytes, last_access, backend) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (normalize_path(path), size, int(mtime), data, len(data), time.time(), backend)
+            )
+            self._conn.commit()
+            self._puts_since_evict += 1
+            if self._puts_since_evict >= 1000:
+                self._evict()
+
+    def invalidate(self, path):
+        with self._lock:
+            self._conn.execute('DELETE FROM probe_cache WHERE path = ?', (normalize_path(path),))
+            self._conn.commit()
+
+    def is_known_failure(self, path, size):
+        """文件以相同大小探测失败过时返回True"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT 1 FROM probe_failure WHERE path = ? AND size = ?',
+                (normalize_path(path), size)
+            ).fetchone()
+        return row is not None
+
+    def record_failure(self, path, size, error):
+        """记录探测失败，文件大小变化前扫描不再重试"""
+        key = normalize_path(path)
+        with self._lock:
+            row = self._conn.execute('SELECT size, failures FROM probe_failure WHERE path = ?', (key,)).fetchone()
+            failures = row[1] + 1 if row is not None and row[0] == size else 1
+            self._conn.execute(
+                'INSERT OR REPLACE INTO probe_failure (path, size, error, failures, last_failure) VALUES (?, ?, ?, ?, ?)',
+                (key, size, str(error)[:1000], failures, time.time())
+            )
+            self._conn.commit()
+
+    def clear_failure(self, path):
+        with self._lock:
+            self._conn.execute('DELETE FROM probe_failure WHERE path = ?', (normalize_path(path),))
+            self._conn.commit()
+
+    def _flush_touched(self):
+        """批量写入命中时记下的访问时间（调用方持有锁并负责提交）"""
+        if not self._touched:
+            return
+        self._conn.executemany('UPDATE probe_cache SET last_access = ? WHERE path = ?',
+                               [(accessed, path) for path, accessed in self._touched.items()])
+        self._touched.clear()
+
+    def _evict(self):
+        """超出上限时删除最久未访问的记录，直到降到上限的90%（调用方持有锁）"""
+        self._puts_since_evict = 0
+        count, total_bytes = self._conn.execute('SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM probe_cache').fetchone()
+        if count <= self.max_entries and total_bytes <= self.max_bytes:
+            return
+        target_count = int(self.max_entries * 0.9)
+        target_bytes = int(self.max_bytes * 0.9)
+        evicted = 0
+        rows = self._conn.execute('SELECT path, nbytes FROM probe_cache ORDER BY last_access').fetchall()
+        doomed = []
+        for path, nbytes in rows:
+            if count <= target_count and total_bytes <= target_bytes:
+                break
+            doomed.append((path,))
+            count -= 1
+            total_bytes -= nbytes
+            evicted += 1
+        self._conn.executemany('DELETE FROM probe_cache WHERE path = ?', doomed)
+        self._conn.commit()
+        logging.info(f"ffprobe缓存淘汰 {evicted} 条记录")
+
+    def stats(self):
+        with self._lock:
+            if self._touched:
+                self._flush_touched()
+                self._conn.commit()
+            count, total_bytes = self._conn.execute('SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM probe_cache').fetchone()
+            failures = self._conn.execute('SELECT COUNT(*) FROM probe_failure').fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': count,
+            'bytes': total_bytes,
+            'failures': failures
+        }
+
+_default_cache = None
+_default_lock = threading.Lock()
+_default_settings = {
+    'enabled': os.environ.get('DVC_PROBE_CACHE', '').lower() not in ('0', 'off', 'false'),
+    'db_path': os.environ.get('DVC_PROBE_CACHE_PATH', DEFAULT_CACHE_PATH),
+    'max_entries': 500000,
+    'max_bytes': 512 * 1024 * 1024
+}
+
+def configure_default_cache(enabled=True, db_path=DEFAULT_CACHE_PATH, max_entries=500000, max_bytes=512 * 1024 * 1024):
+    """设置全局默认缓存，Video.get_video_info 使用该缓存"""
+    global _default_cache
+    with _default_lock:
+        _default_settings.update(enabled=enabled, db_path=db_path, max_entries=max_entries, max_bytes=max_bytes)
+        _default_cache = None
+
+def get_default_cache():
+    """获取全局默认缓存，未启用或无法打开时返回None"""
+    global _default_cache
+    if not _default_settings['enabled']:
+        return None
+    with _default_lock:
+        if _default_cache is None:
+            try:
+                _default_cache = ProbeCache(
+                    _default_settings['db_path'],
+                    max_entries=_default_settings['max_entries'],
+                    max_bytes=_default_settings['max_bytes']
+                )
+            except Exception as e:
+                logging.warning(f"打开ffprobe缓存失败，本次运行不使用缓存: {str(e)}")
+                _default_settings['enabled'] = False
+                return None
+        return _default_cache
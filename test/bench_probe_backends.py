@@ -0,0 +1,143 @@
+"""比较ffprobe和容器头解析（native）两种元数据获取方式的速度和结果
+
+默认用ffmpeg的testsrc生成一组测试视频，也可以用 --dir 指定已有的视频目录：
+    python test/bench_probe_backends.py
+    python test/bench_probe_backends.py --dir /path/to/videos --rounds 3
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+import shutil
+import subprocess
+import tempfile
+import time
+from fractions import Fraction
+import ffmpeg
+import media_header
+
+# (文件名, 编码参数, 容器参数)
+CLIPS = [
+    ('h264_30fps.mp4', ['-c:v', 'libx264', '-r', '30'], []),
+    ('h264_2997fps_faststart.mp4', ['-c:v', 'libx264', '-r', '30000/1001'], ['-movflags', '+faststart']),
+    ('hevc_25fps.mp4', ['-c:v', 'libx265', '-r', '25', '-tag:v', 'hvc1'], []),
+    ('h264_30fps.mkv', ['-c:v', 'libx264', '-r', '30'], []),
+    ('hevc_2997fps.mkv', ['-c:v', 'libx265', '-r', '30000/1001'], []),
+]
+
+def generate_clips(output_dir, duration, size):
+    """用testsrc生成测试视频（带一条音轨），不支持的编码器直接跳过"""
+    paths = []
+    for name, codec_args, container_args in CLIPS:
+        path = os.path.join(output_dir, name)
+        cmd = ['ffmpeg', '-y', '-loglevel', 'error',
+               '-f', 'lavfi', '-i', f'testsrc=duration={duration}:size={size}:rate=30',
+               '-f', 'lavfi', '-i', f'sine=duration={duration}',
+               *codec_args, '-c:a', 'aac', *container_args, path]
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode != 0:
+            print(f"跳过 {name}: {result.stderr.strip()}")
+            continue
+        paths.append(path)
+    return paths
+
+def summarize(probe):
+    """提取Video使用的字段"""
+    stream = probe['streams'][0]
+    bitrate = stream.get('bit_rate') or stream.get('tags', {}).get('BPS') or probe['format'].get('bit_rate')
+    duration = stream.get('duration') or probe['format'].get('duration')
+    return {
+        'codec': stream['codec_name'],
+        'resolution': (int(stream['width']), int(stream['height'])),
+        'fps': round(float(Fraction(stream['avg_frame_rate'])), 3),
+        'duration': round(float(duration), 2),
+        'bitrate_k': int(int(bitrate) / 1000),
+    }
+
+def compare(ffprobe_info, native_info):
+    """返回两种结果不一致的字段，码率允许5%误差，时长允许0.1秒误差"""
+    diffs = []
+    for key in ffprobe_info:
+        a = ffprobe_info[key]
+        b = native_info[key]
+        if key == 'bitrate_k':
+            same = abs(a - b) <= max(a, b) * 0.05
+        elif key == 'duration':
+            same = abs(a - b) <= 0.1
+        else:
+            same = a == b
+        if not same:
+            diffs.append(f"{key}: ffprobe={a} native={b}")
+    return diffs
+
+def run_backend(paths, backend, rounds):
+    """多轮获取元数据，返回 ({path: 结果摘要}, 每个文件平均耗时)"""
+    results = {}
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for path in paths:
+            if backend == 'native':
+                try:
+                    probe = media_header.probe(path)
+                except media_header.MediaHeaderError as e:
+                    results[path] = f"需要回退: {e}"
+                    continue
+            else:
+                probe = ffmpeg.probe(path)
+            results[path] = summarize(probe)
+    elapsed = time.perf_counter() - start
+    return results, elapsed / (rounds * len(paths))
+
+def main():
+    parser = argparse.ArgumentParser(description='比较ffprobe与容器头解析的速度和结果')
+    parser.add_argument('--dir', help='已有视频目录，不指定时生成测试视频')
+    parser.add_argument('--rounds', type=int, default=5, help='重复次数')
+    parser.add_argument('--duration', type=int, default=10, help='生成视频的时长（秒）')
+    parser.add_argument('--size', default='1280x720', help='生成视频的分辨率')
+    args = parser.parse_args()
+
+    temp_dir = None
+    if args.dir:
+        paths = []
+        for root, _, files in os.walk(args.dir):
+            for file in files:
+                if file.lower().endswith(media_header.MP4_EXTENSIONS + media_header.MKV_EXTENSIONS):
+                    paths.append(os.path.join(root, file))
+    else:
+        if shutil.which('ffmpeg') is None:
+            print("未找到ffmpeg，无法生成测试视频")
+            return
+        temp_dir = tempfile.mkdtemp(prefix='bench_probe_')
+        print(f"生成测试视频到 {temp_dir} ...")
+        paths = generate_clips(temp_dir, args.duration, args.size)
+
+    try:
+        if not paths:
+            print("没有可测试的视频")
+            return
+        ffprobe_results, ffprobe_avg = run_backend(paths, 'ffprobe', args.rounds)
+        native_results, native_avg = run_backend(paths, 'native', args.rounds)
+
+        mismatches = 0
+        for path in paths:
+            native = native_results[path]
+            if isinstance(native, str):
+                print(f"{os.path.basename(path)}: {native}")
+                continue
+            diffs = compare(ffprobe_results[path], native)
+            if diffs:
+                mismatches += 1
+                print(f"{os.path.basename(path)} 结果不一致: {'; '.join(diffs)}")
+            else:
+                print(f"{os.path.basename(path)}: {native}")
+
+        print(f"\n文件数: {len(paths)}，重复 {args.rounds} 次")
+        print(f"ffprobe: 平均 {ffprobe_avg * 1000:.2f} ms/文件")
+        print(f"native:  平均 {native_avg * 1000:.2f} ms/文件 ({ffprobe_avg / native_avg:.1f}x)")
+        print(f"结果不一致: {mismatches} 个")
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""在SQLite上测试 VideoManager.scan_videos 的冷启动和重复扫描耗时
+
+不指定 --root 时先用 gen_synthetic_library 生成一个临时的稀疏文件库，
+稀疏文件的元数据由清单提供（make_fake_probe），可以用 --probe-latency 模拟网络共享上的探测耗时：
+    python test/bench_scan.py
+    python test/bench_scan.py --actors 500 --videos 20 --probe-latency 0.05
+    python test/bench_scan.py --root /tmp/synthetic_lib --walk-workers 8 --probe-workers 8
+    python test/bench_scan.py --root /path/to/videos --real-probe
+
+依次执行：
+    cold: 空数据库、空探测缓存
+    warm: 没有任何变化的重复扫描（--rounds 次）
+    touch: 修改 --touch 个文件的大小后扫描
+    rebuild: 清空数据库但保留探测缓存（重建数据库后的首次扫描）
+每次扫描的阶段耗时来自scan_run.stats，处理数与扫描后存在的记录数不一致时输出提示
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'master'))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import argparse
+import json
+import random
+import shutil
+import statistics
+import tempfile
+import time
+import logging
+from flask import Flask
+from models import db, ScanRun, VideoInfo, upgrade_schema
+from video_manager import VideoManager
+from video_dir import get_dir_resolver
+from probe_cache import configure_default_cache
+import gen_synthetic_library
+
+def create_app(db_path):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    return app
+
+def reset_database():
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    upgrade_schema()
+    get_dir_resolver().reset()
+
+def touch_files(root, count, seed):
+    """用大1MB的新文件替换count个视频文件（写入临时文件后改名，与下载器替换文件的方式一致）"""
+    paths = []
+    for dirpath, _, files in os.walk(root):
+        for name in files:
+            if name.endswith(('.mp4', '.mkv')) and '-trailer' not in name.lower():
+                paths.append(os.path.join(dirpath, name))
+    paths.sort()
+    touched = random.Random(seed).sample(paths, min(count, len(paths)))
+    for path in touched:
+        temp_path = path + '.part'
+        gen_synthetic_library.create_sparse(temp_path, os.path.getsize(path) + 1024 * 1024)
+        os.replace(temp_path, path)
+    return len(touched)
+
+def run_scan(video_manager, label):
+    """执行一次全量扫描，返回结果摘要"""
+    start = time.perf_counter()
+    changes = video_manager.scan_videos()
+    elapsed = time.perf_counter() - start
+    run = ScanRun.query.order_by(ScanRun.id.desc()).first()
+    stats = json.loads(run.stats) if run is not None and run.stats else {}
+    # 每个存在的文件在一次扫描中只计数一次，处理数应等于存在的记录数
+    existing = VideoInfo.query.filter_by(exist=True).count()
+    result = {
+        'label': label,
+        'ok': changes is not None,
+        'elapsed': round(elapsed, 3),
+        'processed': run.processed_count if run is not None else 0,
+        'probed': run.probed_count if run is not None else 0,
+        'existing': existing,
+        'files_per_sec': round(run.processed_count / elapsed, 1) if run is not None and elapsed > 0 else 0,
+        'phases': stats.get('phases', {}),
+        'counts': stats.get('counts', {}),
+        'probe': (stats.get('probe') or {}).get('percentiles')
+    }
+    phases = '  '.join(f"{phase}={seconds:.2f}" for phase, seconds in result['phases'].items())
+    print(f"{label:<8} {'成功' if result['ok'] else '失败'}  耗时 {elapsed:8.2f}秒  "
+          f"处理 {result['processed']:6d}  探测 {result['probed']:6d}  {result['files_per_sec']:9.1f} 文件/秒  {phases}")
+    if result['processed'] != existing:
+        print(f"{label:<8} 处理数 {result['processed']} 与存在的记录数 {existing} 不一致")
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='测试扫描的冷启动和重复扫描耗时')
+    parser.add_argument('--root', help='视频库目录，不指定时生成临时合成库')
+    parser.add_argument('--actors', type=int, default=100, help='生成合成库时的演员目录数')
+    parser.add_argument('--videos', type=int, default=20, help='生成合成库时每个演员的番号数')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子')
+    parser.add_argument('--real-probe', action='store_true', help='使用真实的解析方式（真实视频库或ffmpeg模式的合成库）')
+    parser.add_argument('--probe-latency', type=float, default=0.0, help='模拟的每次探测耗时（秒）')
+    parser.add_argument('--probe-jitter', type=float, default=0.0, help='模拟探测耗时的随机增量上限（秒）')
+    parser.add_argument('--probe-backend', choices=['native', 'ffprobe'], default='native', help='元数据解析方式')
+    parser.add_argument('--walk-workers', type=int, default=4, help='目录遍历线程数')
+    parser.add_argument('--probe-workers', type=int, default=4, help='探测并发数')
+    parser.add_argument('--rounds', type=int, default=3, help='重复扫描次数')
+    parser.add_argument('--touch', type=int, default=50, help='touch阶段修改的文件数，0表示跳过')
+    parser.add_argument('--json', help='把结果写入该JSON文件，便于比较不同版本')
+    parser.add_argument('--keep', action='store_true', help='保留临时目录（数据库、缓存和生成的库）')
+    parser.add_argument('--verbose', action='store_true', help='输出扫描日志')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    work_dir = tempfile.mkdtemp(prefix='bench_scan_')
+    root = args.root
+    try:
+        if root is None:
+            root = os.path.join(work_dir, 'library')
+            counts = gen_synthetic_library.generate_library(root, actors=args.actors, videos=args.videos, seed=args.seed)
+            print(f"已生成合成库 {root}: {counts['videos']} 个视频文件")
+        root = os.path.abspath(root)
+        if not args.real_probe:
+            fake_probe = gen_synthetic_library.make_fake_probe(root, args.probe_latency, args.probe_jitter, args.seed)
+            gen_synthetic_library.install_fake_probe(fake_probe)
+
+        configure_default_cache(db_path=os.path.join(work_dir, 'probe_cache.db'))
+        app = create_app(os.path.join(work_dir, 'bench.db'))
+        video_manager = VideoManager(
+            [root],
+            probe_workers={root: args.probe_workers},
+            walk_workers=args.walk_workers,
+            probe_backend=args.probe_backend,
+            stable_seconds=0,
+            fingerprint_backfill=0
+        )
+
+        results = []
+        with app.app_context():
+            reset_database()
+            results.append(run_scan(video_manager, 'cold'))
+            for i in range(args.rounds):
+                results.append(run_scan(video_manager, f'warm{i + 1}'))
+            if args.touch and not os.path.exists(os.path.join(root, gen_synthetic_library.MANIFEST_NAME)):
+                # 只修改合成库中的文件
+                print("不是合成库，跳过touch阶段")
+            elif args.touch:
+                touched = touch_files(root, args.touch, args.seed)
+                results.append(run_scan(video_manager, 'touch'))
+                results[-1]['touched'] = touched
+            reset_database()
+            results.append(run_scan(video_manager, 'rebuild'))
+            video_count = VideoInfo.query.count()
+
+        warm = [result['elapsed'] for result in results if result['label'].startswith('warm')]
+        print(f"\n记录数: {video_count}")
+        if warm:
+            print(f"cold {results[0]['elapsed']:.2f}秒，warm 中位数 {statistics.median(warm):.2f}秒 "
+                  f"({results[0]['elapsed'] / max(statistics.median(warm), 1e-6):.1f}x)")
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump({'root': root, 'args': vars(args), 'records': video_count, 'results': results},
+                          f, ensure_ascii=False, indent=2)
+    finally:
+        if args.keep:
+            print(f"临时目录: {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
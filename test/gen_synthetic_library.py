@@ -0,0 +1,287 @@
+"""按项目的命名规则生成合成视频库，用于离线测试扫描性能
+
+目录结构与生产环境一致：演员/番号/番号.mp4，包含VR番号、分段（CD）文件、带字幕的 -C 文件、
+预告片、封面和nfo等非视频文件，以及无法识别番号的文件。
+
+两种生成方式：
+    sparse: 创建指定大小的稀疏文件（不占用磁盘空间），元数据写入清单文件，
+            扫描时用 make_fake_probe() 替换ffprobe和容器头解析
+    ffmpeg: 用testsrc生成几个很小的真实视频作为模板，复制为库中的文件，可以用真实的解析方式扫描
+
+    python test/gen_synthetic_library.py /tmp/synthetic_lib --actors 200 --videos 20
+    python test/gen_synthetic_library.py /tmp/synthetic_lib --mode ffmpeg --actors 20 --videos 5
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+import json
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import ffmpeg
+import media_header
+
+# 清单文件，位于生成的库的根目录，记录每个文件的元数据 {相对路径: {...}}
+MANIFEST_NAME = '.synthetic_library.json'
+
+PREFIXES = ['ABP', 'SSIS', 'IPX', 'MIDE', 'STARS', 'PRED', 'JUL', 'MIAA', 'CAWD', 'SONE', 'ADN', 'MEYD']
+VR_PREFIXES = ['SIVR', 'IPVR', 'DSVR', 'KAVR', 'MDVR', 'RSRVR']
+FAMILY_NAMES = ['Aoi', 'Hoshino', 'Kawakita', 'Mikami', 'Sakura', 'Shiina', 'Takahashi', 'Tsubasa', 'Yua', 'Ayami']
+GIVEN_NAMES = ['Rena', 'Saika', 'Yui', 'Mei', 'Nana', 'Rin', 'Hikari', 'Momo', 'Kana', 'Emi']
+
+# (编码, 分辨率, 帧率, 码率范围bps, 时长范围秒)
+NORMAL_PROFILES = [
+    ('h264', (1920, 1080), '30000/1001', (4000000, 12000000), (3600, 10800)),
+    ('h264', (1280, 720), '30/1', (2000000, 5000000), (3600, 7200)),
+    ('hevc', (1920, 1080), '30000/1001', (2000000, 6000000), (3600, 10800)),
+]
+VR_PROFILES = [
+    ('h264', (3840, 1920), '60/1', (15000000, 40000000), (3600, 7200)),
+    ('h264', (5760, 2880), '60/1', (25000000, 60000000), (3600, 7200)),
+    ('hevc', (7680, 3840), '60/1', (20000000, 50000000), (3600, 7200)),
+]
+
+# ffmpeg模式模板视频的编码参数 {编码: 参数}
+TEMPLATE_CODECS = {
+    'h264': ['-c:v', 'libx264', '-preset', 'ultrafast'],
+    'hevc': ['-c:v', 'libx265', '-preset', 'ultrafast', '-tag:v', 'hvc1'],
+}
+
+def actor_names(count, rng):
+    """生成不重复的演员目录名"""
+    names = [f"{family} {given}" for family in FAMILY_NAMES for given in GIVEN_NAMES]
+    rng.shuffle(names)
+    result = names[:count]
+    for i in range(len(result), count):
+        result.append(f"{rng.choice(FAMILY_NAMES)} {rng.choice(GIVEN_NAMES)} {i}")
+    return result
+
+def plan_title(rng, used_ids, vr_ratio, cd_ratio, subtitle_ratio, mkv_ratio):
+    """为一个番号规划文件名，返回 (番号, 是否VR, [视频文件名])"""
+    is_vr = rng.random() < vr_ratio
+    while True:
+        prefix = rng.choice(VR_PREFIXES if is_vr else PREFIXES)
+        identi = f"{prefix}-{rng.randint(1, 9999):03d}"
+        if identi not in used_ids:
+            used_ids.add(identi)
+            break
+    extension = '.mkv' if rng.random() < mkv_ratio else '.mp4'
+    parts = rng.randint(2, 4) if rng.random() < cd_ratio else 0
+    if is_vr:
+        # VR分段使用 -1/-2 或 _A/_B 后缀
+        if parts:
+            letters = rng.random() < 0.5
+            names = [f"{identi}_{chr(ord('A') + i)}{extension}" if letters else f"{identi}-{i + 1}{extension}"
+                     for i in range(parts)]
+        else:
+            names = [f"{identi}{extension}"]
+    else:
+        suffix = '-C' if rng.random() < subtitle_ratio else ''
+        if parts:
+            names = [f"{identi}{suffix}-cd{i + 1}{extension}" for i in range(parts)]
+        else:
+            names = [f"{identi}{suffix}{extension}"]
+    return identi, is_vr, names
+
+def plan_metadata(rng, is_vr):
+    codec, resolution, fps, bitrate_range, duration_range = rng.choice(VR_PROFILES if is_vr else NORMAL_PROFILES)
+    duration = rng.uniform(*duration_range)
+    bitrate = rng.randint(*bitrate_range)
+    return {
+        'codec': codec,
+        'width': resolution[0],
+        'height': resolution[1],
+        'fps': fps,
+        'bitrate': bitrate,
+        'duration': round(duration, 3),
+        'size': int(bitrate * duration / 8)
+    }
+
+def create_sparse(path, size):
+    """创建稀疏文件：只写入最后一个字节，实际不占用磁盘空间（文件系统支持时）"""
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+def create_templates(template_dir, duration, size):
+    """用testsrc生成模板视频 {(codec, extension): path}，不支持的编码器跳过"""
+    templates = {}
+    for codec, codec_args in TEMPLATE_CODECS.items():
+        for extension in ('.mp4', '.mkv'):
+            path = os.path.join(template_dir, f"{codec}{extension}")
+            cmd = ['ffmpeg', '-y', '-loglevel', 'error',
+                   '-f', 'lavfi', '-i', f'testsrc=duration={duration}:size={size}:rate=30',
+                   *codec_args, path]
+            result = subprocess.run(cmd, capture_output=True, text=True)
+            if result.returncode != 0:
+                print(f"跳过模板 {codec}{extension}: {result.stderr.strip()}")
+                continue
+            templates[(codec, extension)] = path
+    return templates
+
+def generate_library(root, actors=50, videos=10, mode='sparse', seed=0, vr_ratio=0.15, cd_ratio=0.1,
+                     subtitle_ratio=0.2, mkv_ratio=0.1, trailer_ratio=0.3, extra_ratio=0.5, unknown_ratio=0.02,
+                     clip_duration=1, clip_size='160x90'):
+    """生成合成视频库，返回统计信息
+
+    Args:
+        root: 输出目录（已存在时追加）
+        actors: 演员目录数
+        videos: 每个演员的番号数
+        mode: sparse 或 ffmpeg
+        seed: 随机种子，相同参数生成相同的库
+        vr_ratio: VR番号比例
+        cd_ratio: 分段文件比例
+        subtitle_ratio: 带字幕（-C）的比例
+        mkv_ratio: mkv容器的比例
+        trailer_ratio: 带预告片的比例
+        extra_ratio: 带封面和nfo的比例
+        unknown_ratio: 额外放置无法识别番号的视频文件的比例
+        clip_duration: ffmpeg模式模板视频的时长（秒）
+        clip_size: ffmpeg模式模板视频的分辨率
+    """
+    rng = random.Random(seed)
+    os.makedirs(root, exist_ok=True)
+    manifest_path = os.path.join(root, MANIFEST_NAME)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+
+    templates = {}
+    template_dir = None
+    if mode == 'ffmpeg':
+        if shutil.which('ffmpeg') is None:
+            raise RuntimeError("未找到ffmpeg，无法生成真实视频，请使用sparse模式")
+        template_dir = tempfile.mkdtemp(prefix='synthetic_templates_')
+        templates = create_templates(template_dir, clip_duration, clip_size)
+        if not templates:
+            raise RuntimeError("生成模板视频失败")
+
+    counts = {'videos': 0, 'vr': 0, 'trailers': 0, 'extras': 0, 'unknown': 0, 'bytes': 0}
+    used_ids = set()
+    try:
+        for actor in actor_names(actors, rng):
+            for _ in range(videos):
+                identi, is_vr, names = plan_title(rng, used_ids, vr_ratio, cd_ratio, subtitle_ratio, mkv_ratio)
+                title_dir = os.path.join(root, actor, identi)
+                os.makedirs(title_dir, exist_ok=True)
+                for name in names:
+                    path = os.path.join(title_dir, name)
+                    metadata = plan_metadata(rng, is_vr)
+                    if mode == 'ffmpeg':
+                        extension = os.path.splitext(name)[1]
+                        template = (templates.get((metadata['codec'], extension))
+                                    or templates.get(('h264', extension))
+                                    or next(iter(templates.values())))
+                        shutil.copyfile(template, path)
+                        metadata = None  # 使用真实的解析结果
+                    else:
+                        create_sparse(path, metadata['size'])
+                    if metadata is not None:
+                        manifest[os.path.relpath(path, root)] = metadata
+                    counts['videos'] += 1
+                    counts['bytes'] += os.path.getsize(path)
+                    if is_vr:
+                        counts['vr'] += 1
+                if rng.random() < trailer_ratio:
+                    # 预告片由扫描直接跳过，不写入清单
+                    create_sparse(os.path.join(title_dir, f"{identi}-trailer.mp4"), 50 * 1024 * 1024)
+                    counts['trailers'] += 1
+                if rng.random() < extra_ratio:
+                    for extra in (f"{identi}.jpg", f"{identi}.nfo"):
+                        with open(os.path.join(title_dir, extra), 'wb') as f:
+                            f.write(b'\0' * 1024)
+                    counts['extras'] += 1
+                if rng.random() < unknown_ratio:
+                    # 无法识别番号的视频文件不会被探测
+                    create_sparse(os.path.join(title_dir, 'sample.mp4'), 10 * 1024 * 1024)
+                    counts['unknown'] += 1
+    finally:
+        if template_dir:
+            shutil.rmtree(template_dir, ignore_errors=True)
+
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    return counts
+
+def load_manifest(root):
+    with open(os.path.join(root, MANIFEST_NAME), encoding='utf-8') as f:
+        return json.load(f)
+
+def make_fake_probe(root, latency=0.0, jitter=0.0, seed=0):
+    """根据清单返回ffprobe格式结果的探测函数，用于替换sparse模式下的真实解析
+
+    Args:
+        root: 生成的库的根目录
+        latency: 每次探测模拟的耗时（秒），用于模拟网络共享上的ffprobe
+        jitter: 在latency基础上随机增加的最大耗时（秒）
+
+    清单中没有的文件（预告片、无法识别的文件）抛出RuntimeError，与损坏的文件一样处理
+    """
+    manifest = load_manifest(root)
+    rng = random.Random(seed)
+    rng_lock = threading.Lock()
+
+    def fake_probe(path, *args, **kwargs):
+        if latency or jitter:
+            with rng_lock:
+                delay = latency + rng.uniform(0, jitter)
+            time.sleep(delay)
+        metadata = manifest.get(os.path.relpath(path, root))
+        if metadata is None:
+            raise RuntimeError(f"合成库清单中没有该文件: {path}")
+        file_size = os.path.getsize(path)
+        return {
+            'streams': [{
+                'index': 0,
+                'codec_type': 'video',
+                'codec_name': metadata['codec'],
+                'width': metadata['width'],
+                'height': metadata['height'],
+                'avg_frame_rate': metadata['fps'],
+                'bit_rate': str(metadata['bitrate']),
+                'duration': '%.6f' % metadata['duration']
+            }],
+            'format': {
+                'format_name': 'mov,mp4,m4a,3gp,3g2,mj2' if path.endswith('.mp4') else 'matroska,webm',
+                'size': str(file_size),
+                'duration': '%.6f' % metadata['duration'],
+                'bit_rate': str(int(file_size * 8 / metadata['duration']))
+            }
+        }
+
+    return fake_probe
+
+def install_fake_probe(fake_probe):
+    """用fake_probe替换容器头解析和ffprobe（native和ffprobe两种解析方式都生效）"""
+    media_header.probe = fake_probe
+    ffmpeg.probe = fake_probe
+
+def main():
+    parser = argparse.ArgumentParser(description='生成符合命名规则的合成视频库')
+    parser.add_argument('root', help='输出目录')
+    parser.add_argument('--actors', type=int, default=50, help='演员目录数')
+    parser.add_argument('--videos', type=int, default=10, help='每个演员的番号数')
+    parser.add_argument('--mode', choices=['sparse', 'ffmpeg'], default='sparse', help='生成方式')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子')
+    parser.add_argument('--vr-ratio', type=float, default=0.15, help='VR番号比例')
+    parser.add_argument('--cd-ratio', type=float, default=0.1, help='分段文件比例')
+    parser.add_argument('--trailer-ratio', type=float, default=0.3, help='带预告片的比例')
+    parser.add_argument('--clip-duration', type=int, default=1, help='ffmpeg模式模板视频的时长（秒）')
+    parser.add_argument('--clip-size', default='160x90', help='ffmpeg模式模板视频的分辨率')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    counts = generate_library(args.root, actors=args.actors, videos=args.videos, mode=args.mode, seed=args.seed,
+                              vr_ratio=args.vr_ratio, cd_ratio=args.cd_ratio, trailer_ratio=args.trailer_ratio,
+                              clip_duration=args.clip_duration, clip_size=args.clip_size)
+    print(f"已生成 {counts['videos']} 个视频文件（其中VR {counts['vr']} 个），"
+          f"预告片 {counts['trailers']} 个，封面和nfo {counts['extras']} 组，无法识别的文件 {counts['unknown']} 个，"
+          f"名义大小 {counts['bytes'] / 1024 ** 3:.1f}GB，耗时 {time.perf_counter() - start:.1f}秒")
+
+if __name__ == '__main__':
+    main()
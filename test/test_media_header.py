@@ -0,0 +1,157 @@
+"""media_header的容器头解析测试，测试文件在内存中按最小结构拼出
+
+    python -m pytest test/test_media_header.py
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import struct
+import pytest
+import media_header
+from media_header import MediaHeaderError
+
+# ---------------------------------------------------------------- MP4
+
+def box(box_type, payload=b''):
+    return struct.pack('>I4s', 8 + len(payload), box_type.encode('latin-1')) + payload
+
+def full_box(box_type, payload):
+    """version 0、flags 0的full box"""
+    return box(box_type, b'\x00\x00\x00\x00' + payload)
+
+def build_moov(extra=b''):
+    """1920x1080 h264，300帧，mdhd时长10.01秒，mvhd时长10秒"""
+    visual_entry = box('avc1', b'\x00' * 6 + struct.pack('>H', 1) + b'\x00' * 16
+                       + struct.pack('>HH', 1920, 1080) + b'\x00' * 50)
+    stbl = box('stbl',
+               full_box('stsd', struct.pack('>I', 1) + visual_entry)
+               + full_box('stts', struct.pack('>III', 1, 300, 1001))
+               + full_box('stsz', struct.pack('>II', 5000, 300)))
+    mdia = box('mdia',
+               full_box('mdhd', struct.pack('>IIII', 0, 0, 30000, 300300))
+               + full_box('hdlr', struct.pack('>I', 0) + b'vide' + b'\x00' * 13)
+               + box('minf', stbl))
+    return box('moov', full_box('mvhd', struct.pack('>IIII', 0, 0, 1000, 10000)) + extra + box('trak', mdia))
+
+def build_mp4(moov=None):
+    """moov放在mdat之后（未faststart的常见布局）"""
+    return box('ftyp', b'isom\x00\x00\x02\x00isom') + box('mdat', b'\x00' * 64) + (moov or build_moov())
+
+# ---------------------------------------------------------------- Matroska
+
+UNKNOWN_SIZE = b'\x01\xff\xff\xff\xff\xff\xff\xff'
+
+def element(element_id, payload, size=None):
+    """EBML元素，size为None时按实际长度写入，否则直接使用给定的大小字段"""
+    id_bytes = element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big')
+    if size is None:
+        size = bytes([0x80 | len(payload)]) if len(payload) < 0x7F else b'\x01' + len(payload).to_bytes(7, 'big')
+    return id_bytes + size + payload
+
+def uint_element(element_id, value):
+    return element(element_id, value.to_bytes(max(1, (value.bit_length() + 7) // 8), 'big'))
+
+def build_info(size=None):
+    """时长10010ms（TimestampScale为1ms）"""
+    return element(media_header.MKV_INFO,
+                   uint_element(media_header.MKV_TIMESTAMP_SCALE, 1000000)
+                   + element(media_header.MKV_DURATION, struct.pack('>d', 10010.0)), size)
+
+def build_tracks():
+    """一条音频轨道和一条3840x2160 hevc视频轨道（29.97fps）"""
+    audio = element(media_header.MKV_TRACK_ENTRY,
+                    uint_element(media_header.MKV_TRACK_TYPE, 2)
+                    + element(media_header.MKV_CODEC_ID, b'A_AAC'))
+    video = element(media_header.MKV_TRACK_ENTRY,
+                    uint_element(media_header.MKV_TRACK_UID, 12345)
+                    + uint_element(media_header.MKV_TRACK_TYPE, 1)
+                    + element(media_header.MKV_CODEC_ID, b'V_MPEGH/ISO/HEVC')
+                    + uint_element(media_header.MKV_DEFAULT_DURATION, 33366667)
+                    + element(media_header.MKV_VIDEO,
+                              uint_element(media_header.MKV_PIXEL_WIDTH, 3840)
+                              + uint_element(media_header.MKV_PIXEL_HEIGHT, 2160)))
+    return element(media_header.MKV_TRACKS, audio + video)
+
+def build_tags():
+    targets = element(media_header.MKV_TARGETS, uint_element(media_header.MKV_TAG_TRACK_UID, 12345))
+    simple_tag = element(media_header.MKV_SIMPLE_TAG,
+                         element(media_header.MKV_TAG_NAME, b'BPS')
+                         + element(media_header.MKV_TAG_STRING, b'8000000'))
+    return element(media_header.MKV_TAGS, element(media_header.MKV_TAG, targets + simple_tag))
+
+def build_mkv(info=None, segment_size=None):
+    ebml = element(media_header.EBML_HEADER, element(0x4282, b'matroska'))
+    body = (info or build_info()) + build_tracks() + build_tags() + element(media_header.MKV_CLUSTER, b'\x00' * 16)
+    return ebml + element(media_header.MKV_SEGMENT, body, segment_size)
+
+# ---------------------------------------------------------------- 测试
+
+@pytest.fixture
+def write_file(tmp_path):
+    def write(name, data):
+        path = tmp_path / name
+        path.write_bytes(data)
+        return str(path)
+    return write
+
+def test_mp4(write_file):
+    data = build_mp4()
+    result = media_header.probe(write_file('a.mp4', data))
+    stream = result['streams'][0]
+    assert stream['codec_name'] == 'h264'
+    assert (stream['width'], stream['height']) == (1920, 1080)
+    assert stream['avg_frame_rate'] == '30000/1001'
+    assert stream['duration'] == '10.010000'
+    assert stream['bit_rate'] == str(int(5000 * 300 * 8 / 10.01))
+    assert result['format']['duration'] == '10.000000'
+    assert result['format']['size'] == str(len(data))
+    assert media_header.is_partial(result)
+
+def test_mp4_fragmented(write_file):
+    moov = build_moov(extra=box('mvex', full_box('trex', b'\x00' * 20)))
+    with pytest.raises(MediaHeaderError, match='分片'):
+        media_header.probe(write_file('fragmented.mp4', build_mp4(moov)))
+
+def test_mp4_truncated(write_file):
+    with pytest.raises(MediaHeaderError, match='box大小无效'):
+        media_header.probe(write_file('truncated.mp4', build_mp4()[:-20]))
+
+def test_mp4_without_moov(write_file):
+    data = box('ftyp', b'isom\x00\x00\x02\x00isom') + box('mdat', b'\x00' * 64)
+    with pytest.raises(MediaHeaderError, match='moov'):
+        media_header.probe(write_file('no_moov.mp4', data))
+
+def test_mkv(write_file):
+    result = media_header.probe(write_file('a.mkv', build_mkv()))
+    stream = result['streams'][0]
+    assert stream['codec_name'] == 'hevc'
+    assert (stream['width'], stream['height']) == (3840, 2160)
+    assert stream['avg_frame_rate'] == '30000/1001'
+    assert stream['tags'] == {'BPS': '8000000'}
+    assert result['format']['duration'] == '10.010000'
+    assert media_header.is_partial(result)
+
+def test_mkv_unknown_size_segment(write_file):
+    """直播录制等写入方式的Segment大小未知，按文件大小处理"""
+    result = media_header.probe(write_file('live.mkv', build_mkv(segment_size=UNKNOWN_SIZE)))
+    assert result['streams'][0]['codec_name'] == 'hevc'
+    assert result['format']['duration'] == '10.010000'
+
+def test_mkv_unknown_size_info(write_file):
+    """Segment的一级元素大小未知时无法定位后续元素，交给ffprobe"""
+    with pytest.raises(MediaHeaderError, match='缺少Info或Tracks'):
+        media_header.probe(write_file('unknown_info.mkv', build_mkv(info=build_info(size=UNKNOWN_SIZE))))
+
+def test_mkv_truncated(write_file):
+    data = build_mkv()
+    # 截断在Tracks中间
+    cut = data.index(build_tracks()) + 10
+    with pytest.raises(MediaHeaderError, match='截断'):
+        media_header.probe(write_file('truncated.mkv', data[:cut]))
+
+def test_unsupported_extension(write_file):
+    with pytest.raises(MediaHeaderError, match='不支持'):
+        media_header.probe(write_file('a.avi', b'RIFF' + b'\x00' * 60))
+
+def test_ffprobe_result_is_not_partial():
+    assert not media_header.is_partial({'streams': [], 'format': {}})
@@ -1,19 +1,47 @@
 import os,time
+import shutil
 import ffmpeg
 from tqdm import tqdm
 import logging
 import subprocess
 import re
 from datetime import datetime
+from probe_cache import get_default_cache
+import media_header
+from ffmpeg_progress import FFmpegRunner, add_progress_args
 
 class Video:
-    def __init__(self, video_path):
+    vr_code = ['SIVR','IPVR','DSVR','KAVR','MDVR','RSRVR','SSR','VR',"FSVSS"]
+    exclusion_vr_code = ['DVRT']
+    # 元数据解析方式：ffprobe 或 native（解析容器头，失败时回退到ffprobe）
+    default_probe_backend = 'ffprobe'
+    # 由探测结果得到的字段，LazyVideo在首次访问这些字段时才探测
+    STREAM_FIELDS = ('video_info', 'video_codec', 'video_bitrate', 'video_resolution',
+                     'video_duration', 'video_fps', 'video_size')
+
+    def __init__(self, video_path, probe_backend=None):
         self.video_path = video_path
         if not os.path.exists(video_path):
             raise FileNotFoundError("File not found: %s" % video_path)
-        self.vr_code = ['SIVR','IPVR','DSVR','KAVR','MDVR','RSRVR','SSR','VR',"FSVSS"]
-        self.exclusion_vr_code = ['DVRT']
-        self.video_info = self.get_video_info(video_path)
+        # 先根据文件名识别番号，识别不了的文件不再执行ffprobe
+        self._init_name_fields(video_path)
+        if self.identi is None:
+            raise Exception("%s Identify not found" % self.video_name)
+        self._init_stream_fields(self.get_video_info(video_path, backend=probe_backend or self.default_probe_backend))
+
+    @classmethod
+    def from_probe(cls, video_path, probe):
+        """用已有的探测结果创建Video，不再执行ffprobe"""
+        video = cls.__new__(cls)
+        video.video_path = video_path
+        video._init_name_fields(video_path)
+        video._init_stream_fields(probe)
+        return video
+
+    def _init_stream_fields(self, video_info):
+        """根据探测结果初始化流信息相关字段"""
+        video_path = self.video_path
+        self.video_info = video_info
         self.video_codec = self.video_info['streams'][0]['codec_name']
         
         # 处理bit_rate不存在的情况，按优先级尝试不同来源
@@ -62,15 +90,32 @@ class Video:
         
         num, den = map(int, self.video_info['streams'][0]['avg_frame_rate'].split('/'))
         self.video_fps = num / den
-        self.video_size = os.path.getsize(video_path)
+        try:
+            self.video_size = int(self.video_info['format']['size'])
+        except (KeyError, TypeError, ValueError):
+            self.video_size = os.path.getsize(video_path)
+
+    def _init_name_fields(self, video_path):
+        """根据文件名初始化名称相关字段（不访问文件）"""
         self.video_name = os.path.basename(video_path)
         self.video_folder = os.path.dirname(video_path)
         self.video_extension = os.path.splitext(video_path)[1]
         self.video_name_noext = os.path.splitext(self.video_name)[0]
         self.is_vr = self.JudgeVR()
-        self.identi = self.GetIdentify()
-        if self.identi is None:
-            raise Exception("%s Identify not found" % self.video_name)
+        try:
+            self.identi = self.GetIdentify()
+        except Exception:
+            self.identi = None
+
+    @classmethod
+    def identify_from_name(cls, video_path):
+        """只根据文件名识别番号，不访问文件
+
+        Returns:
+            tuple: (identi, is_vr)，无法识别时identi为None
+        """
+        video = LazyVideo(video_path)
+        return video.identi, video.is_vr
         
     def __str__(self):
         return "Video: %s, Codec: %s, Bitrate: %s, Resolution: %s, Duration: %s, Size: %s, fps: %s" % (self.video_name, self.video_codec, self.convert_bitrate(self.video_bitrate), self.video_resolution, self.video_duration, self.video_size, round(self.video_fps,2))
@@ -102,12 +147,38 @@ class Video:
             return f'{bitrate:.{dec}f}{unit}'
 
     @staticmethod
-    def get_video_info(video_path):
-        try:
-            return ffmpeg.probe(video_path)
-        except ffmpeg.Error as e:
-            print(e.stderr)
-            raise e
+    def get_video_info(video_path, use_cache=True, backend='ffprobe'):
+        # 文件大小和修改时间未变时直接使用本地缓存的探测结果
+        cache = get_default_cache() if use_cache else None
+        if cache is not None:
+            try:
+                file_stat = os.stat(video_path)
+                cached = cache.get(video_path, file_stat.st_size, file_stat.st_mtime, backend=backend)
+                if cached is not None:
+                    return cached
+            except Exception as e:
+                logging.warning(f"读取ffprobe缓存失败: {str(e)}")
+                cache = None
+        probe = None
+        probe_backend = 'ffprobe'
+        if backend == 'native':
+            try:
+                probe = media_header.probe(video_path)
+                probe_backend = 'native'
+            except media_header.MediaHeaderError as e:
+                logging.debug(f"容器头解析失败，使用ffprobe: {video_path} ({str(e)})")
+        if probe is None:
+            try:
+                probe = ffmpeg.probe(video_path)
+            except ffmpeg.Error as e:
+                print(e.stderr)
+                raise e
+        if cache is not None:
+            try:
+                cache.put(video_path, file_stat.st_size, file_stat.st_mtime, probe, backend=probe_backend)
+            except Exception as e:
+                logging.warning(f"写入ffprobe缓存失败: {str(e)}")
+        return probe
     
     @staticmethod
     def get_video_pathlist_from_path(video_path, exclude_trailer=True, include_substitle=False):
@@ -158,147 +229,59 @@ class Video:
             logging.error(f"解析时间字符串时出错: {str(e)}, 输入: {time_str}")
             return 0
 
-    def convert_video_with_progress(self, cmd, progress_callback=None): 
+    def convert_video_with_progress(self, cmd, progress_callback=None, stats_callback=None):
+        """执行ffmpeg命令并报告进度
+
+        命令会加上 -progress pipe:1 -nostats，进度由读取线程从stdout的key=value输出解析，
+        stderr只保留最后若干行，失败时写入日志
+
+        Args:
+            cmd: ffmpeg命令
+            progress_callback: progress_callback(进度百分比, 已用秒数, 剩余秒数)
+            stats_callback: stats_callback(FFmpegProgress)，每组进度数据调用一次，抛出的异常会终止ffmpeg并向上抛出
+        """
+        runner = FFmpegRunner(add_progress_args(cmd))
+        start = time.monotonic()
+        duration = getattr(self, 'video_duration', 0) or 0
+        runner.start()
         try:
-            loggingfile_name = "logs/ffmpeglog-%s-%s.txt" % (self.video_name_noext, time.strftime("%Y-%m-%d-%H-%M", time.localtime()))
-            # 使用 errors='replace' 来处理无法解码的字符
-            loggingfile = open(loggingfile_name, "w", encoding='utf-8', errors='replace')
-            loggingfile = open(loggingfile_name, "a+", encoding='utf-8', errors='replace')
-            loggingread = open(loggingfile_name, "r", encoding='utf-8', errors='replace')
-            p = subprocess.Popen(cmd, shell=True, stdout=loggingfile, stderr=loggingfile)
-            duration = -1
-            
-            def clean_log_line(line):
-                try:
-                    # 移除ANSI转义序列
-                    ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
-                    line = ansi_escape.sub('', line)
-                    # 移除控制字符
-                    line = ''.join(char for char in line if ord(char) >= 32 or char == '\n')
-                    return line.strip()
-                except Exception as e:
-                    logging.warning(f"清理日志行时出错: {str(e)}")
-                    return ""
-            
-            # 尝试获取视频时长
-            try:
-                while duration == -1 and p.poll() is None:
-                    log = loggingread.readline()
-                    if not log:
-                        time.sleep(0.1)
+            with tqdm(total=int(duration * 1000) or None, desc="Converting %s" % self.video_name) as pbar:
+                for progress in runner.iter_progress():
+                    if duration <= 0 and runner.duration:
+                        duration = runner.duration
+                        pbar.total = int(duration * 1000)
+                    if stats_callback:
+                        stats_callback(progress)
+                    if progress.out_time_us is None:
                         continue
-                        
-                    log = clean_log_line(log)
-                    if not log:
-                        continue
-                        
-                    if "Duration:" in log:
+                    out_time_ms = progress.out_time_us // 1000
+                    if out_time_ms > pbar.n:
+                        pbar.update(out_time_ms - pbar.n)
+                    pbar.set_postfix_str("speed=%sx bitrate=%skbps" % (progress.speed, progress.bitrate))
+                    if progress_callback and duration > 0:
+                        out_time = min(progress.out_time, duration)
+                        remaining_time = (duration - out_time) / progress.speed if progress.speed else None
                         try:
-                            duration_match = re.search(r'Duration:\s*(\d+):(\d+):(\d+\.\d+)', log)
-                            if duration_match:
-                                h, m, s = duration_match.groups()
-                                duration_str = f"{h}:{m}:{s}"
-                                duration = self.GetTimeFromString(duration_str)
-                                duration_ms = self.GetTimeFromString(duration_str, usems=True)
-                                logging.info(f"Duration解析成功: {duration}s ({duration_ms}ms)")
-                            else:
-                                logging.warning(f"无法从行中解析Duration: {log}")
-                                continue
+                            progress_callback(out_time / duration * 100, time.monotonic() - start, remaining_time)
                         except Exception as e:
-                            logging.warning(f"解析Duration时出错: {str(e)}")
-                            continue
-                
-                if duration == -1:
-                    logging.warning("无法获取视频时长，将不显示进度条")
-                    # 如果获取不到时长，就只记录日志
-                    while p.poll() is None:
-                        log = loggingread.readline()
-                        if log:
-                            logging.info(clean_log_line(log))
-                else:
-                    # 显示进度条
-                    try:
-                        with tqdm(total=duration_ms, desc="Converting %s" % self.video_name) as pbar:
-                            while p.poll() is None:
-                                try:
-                                    log = loggingread.readline()
-                                    if not log:
-                                        time.sleep(0.1)
-                                        continue
-                                        
-                                    log = clean_log_line(log)
-                                    if not log:
-                                        continue
-                                        
-                                    if "time=" in log:
-                                        try:
-                                            time_match = re.search(r'time=\s*(\d+):(\d+):(\d+\.\d+)', log)
-                                            if time_match:
-                                                h, m, s = time_match.groups()
-                                                timestr = f"{h}:{m}:{s}"
-                                                timems = self.GetTimeFromString(timestr, usems=True)
-                                                if 0 <= timems <= duration_ms:
-                                                    progress = (timems / duration_ms) * 100
-                                                    pbar.update(timems - pbar.n)
-                                                    if progress_callback:
-                                                        try:
-                                                            elapsed_time = pbar.format_dict['elapsed']
-                                                            its = pbar.format_dict['rate']
-                                                            remain = pbar.format_dict['total'] - pbar.format_dict['n']
-                                                            remaining_time = remain/its if its and its > 0 else None
-                                                            progress_callback(progress, elapsed_time, remaining_time)
-                                                        except Exception as e:
-                                                            logging.warning(f"回调进度时出错: {str(e)}")
-                                        except Exception as e:
-                                            logging.warning(f"处理时间信息时出错: {str(e)}")
-                                            continue
-                                            
-                                    if "bitrate=" in log:
-                                        try:
-                                            bitrate_match = re.search(r'bitrate=\s*([\d.]+\s*\w+)', log)
-                                            if bitrate_match:
-                                                bitrate = bitrate_match.group(1)
-                                                pbar.set_postfix_str("Bitrate: %s" % bitrate)
-                                        except Exception as e:
-                                            logging.warning(f"处理比特率信息时出错: {str(e)}")
-                                            continue
-                                except Exception as e:
-                                    logging.warning(f"处理进度信息时出错: {str(e)}")
-                                    continue
-                            
-                            # 确保进度条到达100%
-                            try:
-                                if pbar.n < duration_ms:
-                                    pbar.update(duration_ms - pbar.n)
-                                if progress_callback:
-                                    progress_callback(100, pbar.format_dict['elapsed'], 0)
-                            except Exception as e:
-                                logging.warning(f"更新最终进度时出错: {str(e)}")
-                    except Exception as e:
-                        logging.warning(f"显示进度条时出错: {str(e)}")
-                        # 如果进度条显示出错，继续读取输出直到结束
-                        while p.poll() is None:
-                            log = loggingread.readline()
-                            if log:
-                                logging.info(clean_log_line(log))
-            except Exception as e:
-                logging.warning(f"处理ffmpeg输出时出错: {str(e)}")
-                # 确保进程继续运行到结束
-                p.wait()
+                            logging.warning(f"回调进度时出错: {str(e)}")
 
-            if p.returncode != 0:
-                raise Exception("Error in ffmpeg")
-            
-            loggingfile.write("=================%s Done=================\n" % self.video_name)
-            loggingfile.close()
-            loggingread.close()
-                        
+            returncode = runner.wait()
+            if returncode != 0:
+                logging.error("ffmpeg退出码 %s，最后的输出:\n%s" % (returncode, runner.stderr_tail()))
+                last_line = runner.stderr[-1] if runner.stderr else ''
+                raise Exception("Error in ffmpeg: %s" % last_line)
+            if progress_callback:
+                try:
+                    progress_callback(100, time.monotonic() - start, 0)
+                except Exception as e:
+                    logging.warning(f"更新最终进度时出错: {str(e)}")
         except Exception as e:
             logging.error(f"转码过程中出错: {str(e)}")
-            p.kill()
+            runner.kill()
             raise e
-        
-        return p.returncode
+
+        return returncode
 
     def check_output_path(self, output_folder):
         if output_folder is None or self.are_paths_same(output_folder, self.video_folder):
@@ -374,7 +357,7 @@ class Video:
         
         Args:
             codec_params (dict): 编码参数字典，必须包含以下键：
-                - codec: 编码器名称 (如 'hevc_qsv', 'hevc_nvenc', 'libx265', 'libsvtav1')
+                - codec: 编码器名称 (如 'hevc_qsv', 'hevc_nvenc', 'libx265', 'libsvtav1')，'copy'表示只转封装
                 - output_path: 输出文件路径
                 其他可选参数：
                 - global_quality: QSV的质量参数
@@ -385,6 +368,9 @@ class Video:
                 - extra_params: 额外的编码参数字典
                 - hw_decode: 是否启用硬件解码，默认False
                 - ffmpeg_path: ffmpeg可执行文件路径，默认为'ffmpeg'
+                - start: 从该位置（秒）开始编码，与duration一起用于编码采样
+                - duration: 只编码该时长（秒）
+                - no_audio: 不输出音频
         
         Returns:
             str: 完整的ffmpeg命令
@@ -393,6 +379,10 @@ class Video:
         output_path = codec_params['output_path']
         hw_decode = codec_params.get('hw_decode', False)
         ffmpeg_path = codec_params.get('ffmpeg_path', 'ffmpeg')
+
+        # 转封装：直接复制音视频流，avi等容器缺少时间戳时重新生成
+        if codec == 'copy':
+            return '%s -y -fflags +genpts -i "%s" -c copy "%s"' % (ffmpeg_path, self.video_path, output_path)
         
         # 根据编码器和硬件解码设置选择解码参数
         if hw_decode:
@@ -405,6 +395,10 @@ class Video:
                 base_cmd = '%s -y -i "%s"' % (ffmpeg_path, self.video_path)
         else:
             base_cmd = '%s -y -i "%s"' % (ffmpeg_path, self.video_path)
+
+        # 在输入端定位，只解码需要的部分
+        if codec_params.get('start') is not None:
+            base_cmd = base_cmd.replace(' -i "', ' -ss %.3f -i "' % codec_params['start'], 1)
         
         # 编码器特定参数
         encode_params = []
@@ -562,12 +556,62 @@ class Video:
             if value is not None:
                 encode_params.append(f'-{key} {value}')
         
+        if codec_params.get('duration') is not None:
+            encode_params.append('-t %.3f' % codec_params['duration'])
+
         # 音频编码（默认复制）
-        encode_params.append('-c:a copy')
+        encode_params.append('-an' if codec_params.get('no_audio') else '-c:a copy')
         
         # 组装完整命令
         return '%s %s "%s"' % (base_cmd, ' '.join(encode_params), output_path)
 
+    def sample_encode_bitrate(self, codec_params, sample_dir, samples=3, sample_seconds=10):
+        """用与完整转码相同的参数编码几段均匀分布的片段，估算转码后的视频码率
+
+        片段不含音频，码率与探测结果中视频流的码率可比
+
+        Args:
+            codec_params (dict): build_ffmpeg_command的参数，output_path会被替换为片段路径
+            sample_dir (str): 片段的临时目录，估算完成后删除片段
+            samples (int): 片段数
+            sample_seconds (float): 每段的时长（秒）
+
+        Returns:
+            dict: {'bitrate': 估算的码率(bps), 'seconds': 编码的总时长, 'elapsed': 耗时, 'samples': [每段的码率]}，
+                  视频太短（不足片段总时长的2倍）时返回None
+        """
+        duration = self.video_duration or 0
+        if samples <= 0 or duration < samples * sample_seconds * 2:
+            return None
+
+        start = time.monotonic()
+        total_bits = 0
+        total_seconds = 0
+        sample_bitrates = []
+        extension = os.path.splitext(codec_params['output_path'])[1] or '.mp4'
+        for i in range(samples):
+            sample_path = os.path.join(sample_dir, "%s.sample%d%s" % (self.video_name_noext, i, extension))
+            last_progress = []
+            params = dict(codec_params, output_path=sample_path, no_audio=True,
+                          start=duration * (i + 1) / (samples + 1) - sample_seconds / 2, duration=sample_seconds)
+            try:
+                self.convert_video_with_progress(self.build_ffmpeg_command(params), stats_callback=last_progress.append)
+                seconds = last_progress[-1].out_time if last_progress and last_progress[-1].out_time else sample_seconds
+                bits = os.path.getsize(sample_path) * 8
+            finally:
+                if os.path.exists(sample_path):
+                    os.remove(sample_path)
+            total_bits += bits
+            total_seconds += seconds
+            sample_bitrates.append(int(bits / seconds))
+
+        return {
+            'bitrate': int(total_bits / total_seconds),
+            'seconds': round(total_seconds, 3),
+            'elapsed': round(time.monotonic() - start, 3),
+            'samples': sample_bitrates
+        }
+
     def convert_to_hevc_qsv(self, global_quality=23, preset="medium", rate="", output_folder=None, remove_original=False, progress_callback=None, hw_decode=False):
         output_path = self.check_output_path(output_folder)
         logging.info("Converting %s to h265 with global_quality %s" % (self.video_name, global_quality))
@@ -691,9 +735,9 @@ class Video:
     def copy(self, dest_folder, new_name=""):
         if new_name == "":
             new_name = self.video_name
-        dest_path = os.path.join(dest_folder, self.video_name)
-        os.copy(self.video_path, dest_path)
-        return Video(dest_path)
+        dest_path = os.path.join(dest_folder, new_name)
+        shutil.copy2(self.video_path, dest_path)
+        return LazyVideo(dest_path, probe_backend=self.__dict__.get('probe_backend'))
     
     def JudgeVR(self):
         is_vr = False
@@ -865,3 +909,32 @@ class Video:
         if remove_original:
             os.remove(self.video_path)
 
+
+class LazyVideo(Video):
+    """只根据文件名初始化的Video
+
+    identi、is_vr、video_name_noext等名称字段立即可用，
+    流信息字段（STREAM_FIELDS）在首次访问时才探测并缓存，
+    只用到名称字段的调用方不会执行ffprobe
+    """
+
+    def __init__(self, video_path, probe_backend=None):
+        self.video_path = video_path
+        self.probe_backend = probe_backend
+        self._init_name_fields(video_path)
+
+    def load(self):
+        """立即探测流信息，已探测过时直接返回"""
+        if 'video_info' not in self.__dict__:
+            if not os.path.exists(self.video_path):
+                raise FileNotFoundError("File not found: %s" % self.video_path)
+            backend = self.__dict__.get('probe_backend') or self.default_probe_backend
+            self._init_stream_fields(self.get_video_info(self.video_path, backend=backend))
+        return self
+
+    def __getattr__(self, name):
+        # 只有实例上还没有该属性时才会调用
+        if name in Video.STREAM_FIELDS:
+            self.load()
+            return self.__dict__[name]
+        raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__, name))
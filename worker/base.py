@@ -8,6 +8,7 @@ import os
 from datetime import datetime
 from datetime import time as Time
 import sys
+from .progress_reporter import ProgressReporter
 
 class WorkerType(Enum):
     CPU = 0
@@ -46,7 +47,11 @@ class BasicWorker:
                  start_time: Optional[Time] = None,
                  end_time: Optional[Time] = None,
                  hw_decode: bool = False,
-                 ffmpeg_path: Optional[str] = None):
+                 ffmpeg_path: Optional[str] = None,
+                 accept_probe: bool = False,
+                 probe_batch: int = 20,
+                 progress_interval: float = 10.0,
+                 progress_delta: float = 5.0):
         """初始化worker
         Args:
             worker_name: worker名称
@@ -71,6 +76,10 @@ class BasicWorker:
             end_time: 工作结束时间
             hw_decode: 是否启用硬件解码 (对于CPU编码器会被忽略)
             ffmpeg_path: ffmpeg可执行文件路径 (如果不指定则直接使用ffmpeg命令)
+            accept_probe: 是否领取探测任务 (在本地探测master分发的一批路径并回传结果)
+            probe_batch: 每次领取的探测路径数
+            progress_interval: 转码进度的最长上报间隔（秒）
+            progress_delta: 进度增加达到该百分点时立即上报
         """
         self.name = worker_name
         self.worker_type = worker_type
@@ -139,6 +148,18 @@ class BasicWorker:
         # ffmpeg路径设置
         self.ffmpeg_path = self._normalize_path(ffmpeg_path) if ffmpeg_path else "ffmpeg"
 
+        # 探测任务设置
+        self.accept_probe = accept_probe
+        self.probe_batch = probe_batch
+
+        # 进度上报设置，master超过60秒未收到进度会判定任务超时
+        if progress_interval >= 60:
+            logging.warning(f"进度上报间隔({progress_interval}秒)不能超过master的任务超时时间，已改为30秒")
+            progress_interval = 30
+        self.progress_interval = progress_interval
+        self.progress_delta = progress_delta
+        self.progress_reporter = None
+
         # 设置当前进程为较高优先级，确保网络请求等关键操作不受影响
         self._set_process_priority()
 
@@ -329,6 +350,9 @@ class BasicWorker:
                 "support_vr": 1 if self.support_vr else 0,
                 "dest_path": self.save_path
             }
+            if self.accept_probe:
+                request_data["accept_probe"] = 1
+                request_data["probe_batch"] = self.probe_batch
             logging.debug(f"正在请求新任务: {request_data}")
             
             response = requests.post(
@@ -375,9 +399,41 @@ class BasicWorker:
             logging.error(f"获取任务失败: 未知错误 - {str(e)}")
             return None
 
+    def start_progress_reporter(self, task_id: str) -> ProgressReporter:
+        """为任务启动后台进度上报线程，转码过程中的进度通过它合并后上报"""
+        self.stop_progress_reporter()
+
+        def send(progress: float, elapsed_time: int, remaining_time: int):
+            self.update_task_status(
+                task_id=task_id,
+                status=TaskStatus.RUNNING,
+                progress=progress,
+                elapsed_time=elapsed_time,
+                remaining_time=remaining_time
+            )
+
+        self.progress_reporter = ProgressReporter(send, self.progress_interval, self.progress_delta)
+        return self.progress_reporter
+
+    def stop_progress_reporter(self):
+        """停止进度上报线程，丢弃尚未上报的进度"""
+        reporter, self.progress_reporter = self.progress_reporter, None
+        if reporter is not None:
+            reporter.close()
+            logging.info(f"进度上报: 收到 {reporter.update_count} 次进度，上报 {reporter.sent_count} 次")
+
     def update_task_status(self, task_id: str, status: TaskStatus, progress: float = 0.0, 
-                          error_message: str = None, elapsed_time: int = 0, remaining_time: int = 0):
-        """更新任务状态"""
+                          error_message: str = None, elapsed_time: int = 0, remaining_time: int = 0,
+                          output_name: str = None):
+        """更新任务状态
+
+        完成和失败状态立即发送，发送前先停止进度上报线程，避免之后再上报运行中的进度
+
+        Args:
+            output_name: 输出文件替换了源文件且文件名不同时（转封装为mkv），完成时告知master新的文件名
+        """
+        if status in [TaskStatus.COMPLETED, TaskStatus.FAILED]:
+            self.stop_progress_reporter()
         try:
             data = {
                 "worker_id": self.worker_id,
@@ -388,6 +444,8 @@ class BasicWorker:
             }
             if error_message:
                 data["error_message"] = error_message
+            if output_name:
+                data["output_name"] = output_name
 
             response = requests.patch(
                 f"{self.master_url}/api/v1/tasks/{task_id}",
@@ -420,6 +478,61 @@ class BasicWorker:
         """处理任务的抽象方法，需要被子类实现"""
         raise NotImplementedError("Subclasses must implement process_task method")
 
+    def probe_video(self, video_path: str) -> str:
+        """探测视频的抽象方法，返回base64编码的压缩探测结果，需要被子类实现"""
+        raise NotImplementedError("Subclasses must implement probe_video method")
+
+    def process_probe_task(self, task):
+        """探测master分发的一批路径并批量回传结果
+
+        Args:
+            task: 探测任务，包含task_id和paths: [{id, video_path, size}]
+        """
+        try:
+            start_time = time.time()
+            results = []
+            for item in task["paths"]:
+                result = {"id": item["id"]}
+                try:
+                    full_path = self._get_full_video_path(item["video_path"])
+                    result["probe"] = self.probe_video(full_path)
+                except Exception as e:
+                    logging.warning(f"探测失败 {item['video_path']}: {str(e)}")
+                    result["error"] = str(e)
+                results.append(result)
+            logging.info(f"探测任务 {task['task_id']} 完成: {len(results)} 个文件，耗时 {time.time() - start_time:.1f}秒")
+            return self.submit_probe_results(task["task_id"], results)
+        finally:
+            self.status = WorkerStatus.PENDING
+            self.current_task = None
+
+    def submit_probe_results(self, task_id: str, results: list):
+        """批量回传探测结果"""
+        try:
+            response = requests.post(
+                f"{self.master_url}/api/v1/tasks/{task_id}/probe",
+                json={
+                    "worker_id": self.worker_id,
+                    "results": results
+                }
+            )
+            response.raise_for_status()
+            data = response.json()
+            if data["code"] == 200:
+                logging.info(f"探测结果已回传: 成功 {data['data']['applied']} 个，失败 {data['data']['failed']} 个")
+                return True
+            else:
+                logging.error(f"回传探测结果失败: 服务器返回错误 - code: {data.get('code')}, message: {data.get('message')}")
+                return False
+        except requests.exceptions.RequestException as e:
+            logging.error(f"回传探测结果失败: 网络错误 - {str(e)}")
+            if hasattr(e.response, 'text'):
+                logging.error(f"服务器响应: {e.response.text}")
+            return False
+        except Exception as e:
+            logging.error(f"回传探测结果失败: 未知错误 - {str(e)}")
+            return False
+
     def run(self):
         """运行worker的主循环"""
         if not self.register():
@@ -454,7 +567,10 @@ class BasicWorker:
 
                 if self.status == WorkerStatus.PENDING:
                     task = self.get_new_task()
-                    if task:
+                    if task and task.get("task_type") == "probe":
+                        # 探测任务不计入转码次数和连续失败次数
+                        self.process_probe_task(task)
+                    elif task:
                         try:
                             success = self.process_task(task)
                             if success:
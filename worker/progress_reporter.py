@@ -0,0 +1,78 @@
+import time
+import logging
+import threading
+from typing import Callable, Optional
+
+class ProgressReporter:
+    """在后台线程中上报转码进度
+
+    转码线程调用update()只记录最新的进度，不等待网络请求；后台线程在距上次上报超过interval秒，
+    或进度比上次上报增加了min_delta（百分点）时发送最新的一次，中间的进度直接丢弃。
+    终态（完成/失败）不经过本类：调用方先close()，再直接发送，保证不会有运行中的进度晚于终态到达master。
+    """
+
+    def __init__(self, send: Callable[[float, int, int], None], interval: float = 10.0, min_delta: float = 5.0):
+        """
+        Args:
+            send: send(progress, elapsed_time, remaining_time)，在后台线程中调用
+            interval: 最长上报间隔（秒），需要小于master判定任务超时的60秒
+            min_delta: 进度增加达到该百分点时不等interval立即上报，0表示只按间隔上报
+        """
+        self.send = send
+        self.interval = interval
+        self.min_delta = min_delta
+        self.sent_count = 0
+        self.update_count = 0
+        self._pending = None  # (progress, elapsed_time, remaining_time)
+        self._last_sent_time = None
+        self._last_sent_progress = 0.0
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def update(self, progress: float, elapsed_time: int, remaining_time: Optional[int]):
+        """记录最新的进度（不阻塞）"""
+        with self._cond:
+            self._pending = (progress, elapsed_time, remaining_time if remaining_time is not None else 0)
+            self.update_count += 1
+            self._cond.notify()
+
+    def close(self):
+        """停止上报并丢弃未发送的进度，等待正在发送的请求结束"""
+        with self._cond:
+            self._stopped = True
+            self._pending = None
+            self._cond.notify()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        logging.debug(f"进度上报已停止: 收到 {self.update_count} 次进度，上报 {self.sent_count} 次")
+
+    def _wait_time(self):
+        """距下一次可以上报的秒数，没有待发送的进度时返回None（一直等待）"""
+        if self._pending is None:
+            return None
+        if self._last_sent_time is None:
+            return 0
+        if self.min_delta > 0 and self._pending[0] - self._last_sent_progress >= self.min_delta:
+            return 0
+        return max(0, self.interval - (time.monotonic() - self._last_sent_time))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    wait_time = self._wait_time()
+                    if wait_time == 0:
+                        break
+                    self._cond.wait(timeout=wait_time)
+                if self._stopped:
+                    return
+                pending, self._pending = self._pending, None
+                self._last_sent_time = time.monotonic()
+                self._last_sent_progress = pending[0]
+            try:
+                self.send(*pending)
+                self.sent_count += 1
+            except Exception as e:
+                logging.warning(f"上报进度失败: {str(e)}")
@@ -5,12 +5,66 @@ import argparse
 import time
 from datetime import datetime
 from .base import BasicWorker, WorkerType, TaskStatus
-from video import Video
+from video import Video, LazyVideo
+import media_header
+from probe_cache import configure_default_cache, compress_probe, decompress_probe, DEFAULT_CACHE_PATH
 import re
+import base64
+
+class EncodeAborted(Exception):
+    """转码过程中预测的码率超过阈值，提前终止转码"""
+    def __init__(self, projection: dict, threshold: float):
+        self.projection = projection
+        self.threshold = threshold
+        super().__init__(
+            f"已转码{projection['progress']:.1f}%，预测码率({projection['bitrate']/1000:.2f}kbps)高于阈值"
+            f"({threshold/1000:.2f}kbps)，预测文件大小{projection['size']/1024/1024:.1f}MB，提前终止转码"
+        )
 
 class Worker(BasicWorker):
-    def __init__(self, worker_name: str, worker_type: WorkerType, master_url: str, prefix_path: str, save_path: str, tmp_path: str = None, support_vr: bool = False, crf: int = None, preset: str = None, rate: int = None, numa_param: str = None, remove_original: bool = False, num: int = -1, start_time=None, end_time=None, hw_decode: bool = False, ffmpeg_path: str = None):
-        super().__init__(worker_name, worker_type, master_url, prefix_path, save_path, tmp_path, support_vr, crf, preset, rate, numa_param, None, remove_original, num, start_time, end_time, hw_decode, ffmpeg_path)
+    # 各编码器的质量参数，编码采样预测的码率超过阈值时按SAMPLE_QUALITY_STEP调高后重新采样
+    QUALITY_PARAMS = {'libx265': 'crf', 'hevc_nvenc': 'qmin', 'hevc_qsv': 'global_quality', 'hevc_ni_logan': 'crf'}
+    SAMPLE_QUALITY_STEP = 2
+
+    def __init__(self, worker_name: str, worker_type: WorkerType, master_url: str, prefix_path: str, save_path: str, tmp_path: str = None, support_vr: bool = False, crf: int = None, preset: str = None, rate: int = None, numa_param: str = None, remove_original: bool = False, num: int = -1, start_time=None, end_time=None, hw_decode: bool = False, ffmpeg_path: str = None, fresh_probe: bool = False, accept_probe: bool = False, probe_batch: int = 20, progress_interval: float = 10.0, progress_delta: float = 5.0, sample_count: int = 3, sample_seconds: float = 10.0, sample_retries: int = 1, early_abort: bool = True, abort_margin: float = 0.1, abort_min_progress: float = 10.0):
+        super().__init__(worker_name, worker_type, master_url, prefix_path, save_path, tmp_path, support_vr, crf, preset, rate, numa_param, None, remove_original, num, start_time, end_time, hw_decode, ffmpeg_path, accept_probe, probe_batch, progress_interval, progress_delta)
+        # 忽略任务附带的探测结果，总是重新探测源文件
+        self.fresh_probe = fresh_probe
+        # 完整转码前的编码采样，sample_count为0时不采样
+        self.sample_count = sample_count
+        self.sample_seconds = sample_seconds
+        self.sample_retries = sample_retries
+        self.sample_prediction = None  # 当前任务的码率预测
+        self.prediction_errors = []  # 历次码率预测相对实际码率的误差（%）
+        # 转码过程中按已输出的大小预测最终码率，转码进度达到abort_min_progress（%）后
+        # 预测码率超过阈值的(1 + abort_margin)倍时提前终止
+        self.early_abort = early_abort
+        self.abort_margin = abort_margin
+        self.abort_min_progress = abort_min_progress
+        self.encode_projection = None  # 当前任务最后一次的预测
+
+    def _build_video(self, video_path: str, task: dict) -> Video:
+        """创建源视频的Video对象
+
+        任务附带master扫描时的探测结果且文件大小一致时直接使用，否则重新探测
+        """
+        if task.get("probe") and not self.fresh_probe:
+            try:
+                probe = decompress_probe(base64.b64decode(task["probe"]))
+                probe_size = int(probe['format']['size'])
+                file_size = os.path.getsize(video_path)
+                if probe_size == file_size:
+                    logging.info("使用任务附带的探测结果")
+                    return Video.from_probe(video_path, probe)
+                logging.info(f"文件大小已变化({probe_size} -> {file_size})，重新探测")
+            except Exception as e:
+                logging.warning(f"任务附带的探测结果不可用，重新探测: {str(e)}")
+        return Video(video_path)
+
+    def probe_video(self, video_path: str) -> str:
+        """探测master分发的视频（优先只解析容器头），返回base64编码的压缩探测结果"""
+        probe = Video.get_video_info(video_path, backend='native')
+        return base64.b64encode(compress_probe(probe)).decode('ascii')
 
     def process_task(self, task):
         """处理转码任务
@@ -19,6 +73,7 @@ class Worker(BasicWorker):
             task: 任务信息，包含以下字段：
                 task_id: 任务ID
                 video_path: 视频相对路径
+                probe: 可选，master扫描时的探测结果（base64编码的压缩JSON）
         """
         try:
             # 记录开始时间
@@ -54,7 +109,7 @@ class Worker(BasicWorker):
             logging.info(f"日志目录: {log_dir}")
             
             # 创建Video对象
-            video = Video(video_path)
+            video = self._build_video(video_path, task)
             logging.info(f"视频信息: {str(video)}")
             logging.info(f"是否为VR视频: {video.is_vr}")
             
@@ -69,7 +124,10 @@ class Worker(BasicWorker):
             logging.info("任务状态已更新为运行中")
             
             # 处理任务
-            success = self._process_transcode_task(video, task, start_time, task_tmp_path)
+            if task.get("task_type") == "remux":
+                success = self._process_remux_task(video, task, start_time, task_tmp_path)
+            else:
+                success = self._process_transcode_task(video, task, start_time, task_tmp_path)
                 
             return success
                 
@@ -127,6 +185,7 @@ class Worker(BasicWorker):
     def _process_transcode_task(self, video: Video, task: dict, start_time: float, task_tmp_path: str):
         """处理转码任务"""
         logging.info(f"开始转码任务: {'VR视频' if video.is_vr else '普通视频'}")
+        reporter = self.start_progress_reporter(task["task_id"])
         
         def progress_callback(progress: float, elapsed_time: int, remaining_time: Optional[int]):
             # 使用实际经过的时间
@@ -139,13 +198,8 @@ class Worker(BasicWorker):
                 if remaining_time is None or abs(remaining_time - estimated_remaining) > estimated_remaining * 0.5:
                     remaining_time = estimated_remaining
             
-            self.update_task_status(
-                task_id=task["task_id"],
-                status=TaskStatus.RUNNING,
-                progress=progress,
-                elapsed_time=real_elapsed_time,
-                remaining_time=remaining_time if remaining_time is not None else 0
-            )
+            # 只记录最新进度，由后台线程按间隔合并上报，不阻塞ffmpeg输出的读取
+            reporter.update(progress, real_elapsed_time, remaining_time)
         
         try:
             # 根据worker类型设置编码器和参数
@@ -215,6 +269,30 @@ class Worker(BasicWorker):
                 else video.video_name_noext + "_h265.mp4"
             )
             codec_params['output_path'] = self._normalize_path(output_path)
+
+            # 完整转码前编码采样，预测的码率超过阈值时不再转码
+            self.sample_prediction = None
+            if self.sample_count > 0:
+                try:
+                    sampled_params, self.sample_prediction = self._check_sample_bitrate(video, task, codec_params, task_tmp_path)
+                except Exception as e:
+                    logging.warning(f"编码采样失败，直接转码: {str(e)}")
+                    sampled_params = codec_params
+                if sampled_params is None:
+                    prediction = self.sample_prediction
+                    error_msg = (f"编码采样预测码率({prediction['bitrate']/1000:.2f}kbps)高于阈值"
+                                 f"({prediction['threshold']/1000:.2f}kbps)，跳过转码")
+                    logging.error(error_msg)
+                    self.update_task_status(
+                        task_id=task["task_id"],
+                        status=TaskStatus.FAILED,
+                        progress=0.0,
+                        error_message=error_msg,
+                        elapsed_time=int(time.time() - start_time),
+                        remaining_time=0
+                    )
+                    return True
+                codec_params = sampled_params
             
             # 获取ffmpeg命令
             cmd = video.build_ffmpeg_command(codec_params)
@@ -226,8 +304,28 @@ class Worker(BasicWorker):
                 log_message=f"FFmpeg command: {cmd}"
             )
             
-            # 执行转码
-            video.convert_video_with_progress(cmd, progress_callback)
+            # 执行转码，按已输出的大小预测最终码率，超过阈值时提前终止
+            self.encode_projection = None
+            threshold = self._get_bitrate_threshold(video, 'hevc')
+            audio_bitrate = self._get_audio_bitrate(video)
+
+            def projection_callback(progress):
+                projection = self._project_output(video, progress, audio_bitrate)
+                if projection is None:
+                    return
+                # 保留开始判断时的预测，转码完成后与实际码率对比
+                if self.encode_projection is None or self.encode_projection['progress'] < self.abort_min_progress:
+                    self.encode_projection = projection
+                if (self.early_abort and projection['progress'] >= self.abort_min_progress
+                        and projection['bitrate'] > threshold * (1 + self.abort_margin)):
+                    raise EncodeAborted(projection, threshold)
+
+            try:
+                video.convert_video_with_progress(cmd, progress_callback, projection_callback)
+            except EncodeAborted as e:
+                self._handle_abort(e, task, start_time, codec_params['output_path'])
+                return True
+            self.stop_progress_reporter()
 
             # 转码完成后的处理
             self._handle_completion(video, task, start_time, task_tmp_path)
@@ -235,21 +333,169 @@ class Worker(BasicWorker):
             
         except Exception as e:
             raise e
+        finally:
+            self.stop_progress_reporter()
+
+    def _process_remux_task(self, video: Video, task: dict, start_time: float, task_tmp_path: str):
+        """处理转封装任务：把流直接复制到mkv，不重新编码，任何类型的worker都可以处理"""
+        logging.info("开始转封装任务")
+        reporter = self.start_progress_reporter(task["task_id"])
+        try:
+            codec_params = {
+                'codec': 'copy',
+                'output_path': self._normalize_path(os.path.join(task_tmp_path, video.video_name_noext + ".mkv")),
+                'ffmpeg_path': self.ffmpeg_path
+            }
+            cmd = video.build_ffmpeg_command(codec_params)
+            self.update_task_log(
+                task_id=task["task_id"],
+                log_level=1,  # info级别
+                log_message=f"FFmpeg command: {cmd}"
+            )
+            video.convert_video_with_progress(
+                cmd, lambda progress, elapsed_time, remaining_time: reporter.update(
+                    progress, int(time.time() - start_time), remaining_time)
+            )
+            self.stop_progress_reporter()
+
+            self._handle_completion(video, task, start_time, task_tmp_path, remux=True)
+            return True
+        finally:
+            self.stop_progress_reporter()
+
+    def _get_bitrate_threshold(self, video: Video, output_codec: str) -> float:
+        """转码后码率的上限：不能高于原码率，H.264转H.265时为原码率的75%"""
+        if video.video_codec.lower() == 'h264' and output_codec.lower() in ['hevc', 'h265']:
+            return video.video_bitrate * 0.75
+        return video.video_bitrate
+
+    def _check_sample_bitrate(self, video: Video, task: dict, codec_params: dict, task_tmp_path: str):
+        """编码采样预测转码后的码率，超过阈值时调高质量参数重新采样（最多sample_retries次）
+
+        Returns:
+            (codec_params, prediction): 预测通过时返回完整转码使用的参数（可能调高了质量参数），不通过时参数为None；
+                                        视频太短不采样时prediction为None
+        """
+        threshold = self._get_bitrate_threshold(video, 'hevc')
+        quality_key = self.QUALITY_PARAMS.get(codec_params['codec'])
+        params = dict(codec_params)
+        prediction = None
+        for attempt in range(self.sample_retries + 1):
+            prediction = video.sample_encode_bitrate(params, task_tmp_path, self.sample_count, self.sample_seconds)
+            if prediction is None:
+                logging.info("视频时长不足，跳过编码采样")
+                return codec_params, None
+            prediction['threshold'] = int(threshold)
+            prediction['quality'] = params.get(quality_key)
+            message = (f"编码采样: {quality_key}={prediction['quality']}，预测码率 {prediction['bitrate']/1000:.2f}kbps，"
+                       f"阈值 {threshold/1000:.2f}kbps，各段 {[round(b / 1000) for b in prediction['samples']]}kbps，"
+                       f"采样 {prediction['seconds']}秒耗时 {prediction['elapsed']}秒")
+            logging.info(message)
+            self.update_task_log(task_id=task["task_id"], log_level=1, log_message=message)
+            if prediction['bitrate'] <= threshold:
+                return params, prediction
+            if quality_key is None or params.get(quality_key) is None or attempt == self.sample_retries:
+                break
+            adjusted = min(51, params[quality_key] + self.SAMPLE_QUALITY_STEP)
+            if adjusted == params[quality_key]:
+                break
+            logging.info(f"预测码率高于阈值，{quality_key}调整为{adjusted}后重新采样")
+            params[quality_key] = adjusted
+        return None, prediction
+
+    def _get_audio_bitrate(self, video: Video) -> int:
+        """源文件音频的码率（音频直接复制），用于从已输出的大小中扣除"""
+        probe = video.video_info
+        if media_header.is_partial(probe):
+            # 容器头解析的结果（任务附带或native缓存）没有音频流，改用ffprobe获取完整的流信息
+            try:
+                probe = Video.get_video_info(video.video_path)
+            except Exception as e:
+                logging.warning(f"ffprobe获取音频流失败，按总码率估算音频码率: {str(e)}")
+        streams = probe.get('streams', [])
+        audio_bitrates = [int(s['bit_rate']) for s in streams if s.get('codec_type') == 'audio' and s.get('bit_rate')]
+        if audio_bitrates:
+            return sum(audio_bitrates)
+        try:
+            return max(0, int(probe['format']['bit_rate']) - video.video_bitrate)
+        except (KeyError, TypeError, ValueError):
+            return 0
 
-    def _handle_completion(self, video: Video, task: dict, start_time: float, task_tmp_path: str):
-        """处理转码完成后的操作"""
+    def _project_output(self, video: Video, progress, audio_bitrate: int) -> Optional[dict]:
+        """根据ffmpeg已输出的大小和时长预测转码后的视频码率和文件大小"""
+        duration = video.video_duration
+        if not duration or not progress.out_time or progress.total_size is None:
+            return None
+        fraction = min(1.0, progress.out_time / duration)
+        return {
+            'progress': fraction * 100,
+            'bitrate': max(0, int(progress.total_size * 8 / progress.out_time - audio_bitrate)),
+            'size': int(progress.total_size / fraction),
+            'encoded_seconds': round(progress.out_time, 3),
+            'encoded_bytes': progress.total_size
+        }
+
+    def _handle_abort(self, error: EncodeAborted, task: dict, start_time: float, output_path: str):
+        """提前终止转码后删除未完成的文件并上报失败，worker随后领取下一个任务"""
+        projection = error.projection
+        error_msg = (f"{str(error)}（已输出 {projection['encoded_seconds']}秒 "
+                     f"{projection['encoded_bytes']/1024/1024:.1f}MB）")
+        logging.error(error_msg)
+        try:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+                logging.info(f"已删除未完成的文件: {output_path}")
+        except Exception as e:
+            logging.warning(f"删除未完成的文件失败: {str(e)}")
+        self.update_task_status(
+            task_id=task["task_id"],
+            status=TaskStatus.FAILED,
+            progress=projection['progress'],
+            error_message=error_msg,
+            elapsed_time=int(time.time() - start_time),
+            remaining_time=0
+        )
+
+    def _log_prediction_accuracy(self, task: dict, actual_bitrate: int):
+        """记录转码中和编码采样预测的码率与实际码率的差异"""
+        projection, self.encode_projection = self.encode_projection, None
+        if projection and actual_bitrate:
+            message = (f"转码中预测码率 {projection['bitrate']/1000:.2f}kbps（{projection['progress']:.1f}%时），"
+                       f"预测大小 {projection['size']/1024/1024:.1f}MB，实际码率 {actual_bitrate/1000:.2f}kbps")
+            logging.info(message)
+            self.update_task_log(task_id=task["task_id"], log_level=1, log_message=message)
+        prediction, self.sample_prediction = self.sample_prediction, None
+        if not prediction or not actual_bitrate:
+            return
+        error = (prediction['bitrate'] - actual_bitrate) / actual_bitrate * 100
+        self.prediction_errors.append(error)
+        mean_abs_error = sum(abs(e) for e in self.prediction_errors) / len(self.prediction_errors)
+        message = (f"码率预测误差: 预测 {prediction['bitrate']/1000:.2f}kbps，实际 {actual_bitrate/1000:.2f}kbps，"
+                   f"误差 {error:+.1f}%（本worker {len(self.prediction_errors)} 次预测的平均绝对误差 {mean_abs_error:.1f}%）")
+        logging.info(message)
+        self.update_task_log(task_id=task["task_id"], log_level=1, log_message=message)
+
+    def _handle_completion(self, video: Video, task: dict, start_time: float, task_tmp_path: str, remux: bool = False):
+        """处理转码完成后的操作
+
+        Args:
+            remux: 转封装任务，输出为同名的mkv文件，不检查码率
+        """
         logging.info("开始处理转码完成后的操作")
+        output_name = video.video_name_noext + ".mkv" if remux else video.video_name
         
         # 获取临时文件路径
-        if os.path.dirname(video.video_path) == task_tmp_path:
+        if remux:
+            temp_output = self._normalize_path(os.path.join(task_tmp_path, output_name))
+        elif os.path.dirname(video.video_path) == task_tmp_path:
             temp_output = self._normalize_path(os.path.join(task_tmp_path, video.video_name_noext + "_h265.mp4"))
         else:
             temp_output = self._normalize_path(os.path.join(task_tmp_path, video.video_name))
         logging.info(f"临时文件路径: {temp_output}")
         
         try:
-            # 检查转码后的文件
-            new_video = Video(temp_output)
+            # 检查转码后的文件（只按需探测流信息，临时文件名不需要能识别出番号）
+            new_video = LazyVideo(temp_output)
             
             # 检查视频时长
             original_duration = video.video_duration
@@ -288,16 +534,14 @@ class Worker(BasicWorker):
             
             logging.info(f"原始文件编码: {video.video_codec}, 码率: {original_bitrate/1000:.2f}kbps")
             logging.info(f"转码后文件编码: {new_video.video_codec}, 码率: {new_bitrate/1000:.2f}kbps")
+            self._log_prediction_accuracy(task, new_bitrate)
             
             # 根据编码格式确定码率阈值
-            bitrate_threshold = original_bitrate
-            if video.video_codec.lower() == 'h264' and new_video.video_codec.lower() in ['hevc', 'h265']:
-                # H.264 转 H.265，允许码率为原码率的75%
-                bitrate_threshold = original_bitrate * 0.75
-                logging.info(f"H.264转H.265，码率阈值设为原码率的75%: {bitrate_threshold/1000:.2f}kbps")
+            bitrate_threshold = self._get_bitrate_threshold(video, new_video.video_codec)
+            logging.info(f"码率阈值: {bitrate_threshold/1000:.2f}kbps")
             
-            # 如果转码后的码率高于阈值，标记为失败
-            if new_bitrate > bitrate_threshold:
+            # 如果转码后的码率高于阈值，标记为失败（转封装不改变码率）
+            if not remux and new_bitrate > bitrate_threshold:
                 error_msg = f"转码后文件码率({new_bitrate/1000:.2f}kbps)高于阈值({bitrate_threshold/1000:.2f}kbps)，转码失败"
                 logging.error(error_msg)
                 
@@ -320,13 +564,17 @@ class Worker(BasicWorker):
                 return
             
             # 码率检查通过，继续处理文件移动
+            replaced_name = None  # 替换源文件的输出文件名与源文件不同时告知master
             if self.save_path == "!replace":
                 logging.info("使用替换模式")
                 backup_path = self._normalize_path(video.video_path + ".bak")
                 logging.info(f"备份原文件到: {backup_path}")
                 os.rename(video.video_path, backup_path)
-                logging.info(f"移动新文件到: {video.video_path}")
-                os.rename(temp_output, video.video_path)
+                dest_path = self._normalize_path(os.path.join(video.video_folder, output_name))
+                logging.info(f"移动新文件到: {dest_path}")
+                os.rename(temp_output, dest_path)
+                if output_name != video.video_name:
+                    replaced_name = output_name
                 if self.remove_original:
                     logging.info("删除备份文件")
                     os.remove(backup_path)
@@ -337,7 +585,7 @@ class Worker(BasicWorker):
                     rel_path = rel_path[1:]
                     
                 save_dir = self._normalize_path(os.path.join(self.prefix_path, self.save_path, os.path.dirname(rel_path)))
-                save_path = self._normalize_path(os.path.join(save_dir, video.video_name))
+                save_path = self._normalize_path(os.path.join(save_dir, output_name))
                 
                 logging.info(f"创建目标目录: {save_dir}")
                 os.makedirs(save_dir, exist_ok=True)
@@ -359,7 +607,8 @@ class Worker(BasicWorker):
                 status=TaskStatus.COMPLETED,
                 progress=100.0,
                 elapsed_time=total_elapsed_time,
-                remaining_time=0
+                remaining_time=0,
+                output_name=replaced_name
             )
             
         except Exception as e:
@@ -411,10 +660,25 @@ if __name__ == "__main__":
     parser.add_argument('--hw-decode', action='store_true', help='是否启用硬件解码（仅NVENC和QSV模式有效）')
     parser.add_argument('--shutdown', action='store_true', help='任务完成后关机')
     parser.add_argument('--ffmpeg', help='ffmpeg可执行文件路径，如果不指定则直接使用ffmpeg命令')
+    parser.add_argument('--probe-cache', default=DEFAULT_CACHE_PATH, help='本地ffprobe缓存文件路径')
+    parser.add_argument('--no-probe-cache', action='store_true', help='禁用本地ffprobe缓存')
+    parser.add_argument('--fresh-probe', action='store_true', help='忽略任务附带的探测结果，总是重新探测源文件')
+    parser.add_argument('--probe-jobs', action='store_true', help='领取master分发的探测任务，在本地探测后回传结果')
+    parser.add_argument('--probe-batch', type=int, default=20, help='每次领取的探测路径数')
+    parser.add_argument('--progress-interval', type=float, default=10.0, help='转码进度的最长上报间隔（秒）')
+    parser.add_argument('--progress-delta', type=float, default=5.0, help='进度增加达到该百分点时立即上报，0表示只按间隔上报')
+    parser.add_argument('--sample-count', type=int, default=3, help='转码前编码采样的片段数，0表示不采样')
+    parser.add_argument('--sample-seconds', type=float, default=10.0, help='每个采样片段的时长（秒）')
+    parser.add_argument('--sample-retries', type=int, default=1, help='预测码率超过阈值时调高质量参数重新采样的次数')
+    parser.add_argument('--no-early-abort', action='store_true', help='转码过程中预测码率超过阈值时不提前终止')
+    parser.add_argument('--abort-margin', type=float, default=0.1, help='预测码率超过阈值的比例达到该值时提前终止，默认0.1即10%%')
+    parser.add_argument('--abort-min-progress', type=float, default=10.0, help='转码进度达到该百分比后才判断是否提前终止')
 
     # 解析参数
     args = parser.parse_args()
     
+    configure_default_cache(enabled=not args.no_probe_cache, db_path=args.probe_cache)
+
     # 验证并转换numa参数格式
     if args.numa:
         numa_pattern = r'^[01]+$'
@@ -464,7 +728,18 @@ if __name__ == "__main__":
             start_time=start_time,
             end_time=end_time,
             hw_decode=args.hw_decode,
-            ffmpeg_path=args.ffmpeg
+            ffmpeg_path=args.ffmpeg,
+            fresh_probe=args.fresh_probe,
+            accept_probe=args.probe_jobs,
+            probe_batch=args.probe_batch,
+            progress_interval=args.progress_interval,
+            progress_delta=args.progress_delta,
+            sample_count=args.sample_count,
+            sample_seconds=args.sample_seconds,
+            sample_retries=args.sample_retries,
+            early_abort=not args.no_early_abort,
+            abort_margin=args.abort_margin,
+            abort_min_progress=args.abort_min_progress
         )
 
         # 运行worker